@@ -90,6 +90,13 @@
 #define CONTROLLER_THRESHOLD 1    // The minimum error which the dynamics controller tries to achieve
 #define MAX_SERIAL_LENGTH 5       // Maximum number of characters that can be received
 
+// Binary serial protocol (see web_interface/serial_protocol.py)
+#define FRAME_SYNC 0xA5           // First byte of every binary frame
+#define FRAME_COMMAND 0x01        // Single command: char, int16
+#define FRAME_DRIVE 0x02          // Both drive axes: int8 X, int8 Y
+#define FRAME_SERVOS 0x03         // Servo mask followed by one value per servo
+#define MAX_FRAME_LENGTH 8        // Maximum payload length of a binary frame
+
 
 
 /// Instantiate Objects
@@ -137,6 +144,10 @@ bool autoMode = false;
 char firstChar;
 char serialBuffer[MAX_SERIAL_LENGTH];
 uint8_t serialLength = 0;
+bool binaryMode = false;
+uint8_t frameBuffer[MAX_FRAME_LENGTH + 4];
+uint8_t frameLength = 0;
+const char servoCommands[] = "GTBUELR";   // Servo command order used by FRAME_SERVOS
 
 
 // ****** SERVO MOTOR CALIBRATION *********************
@@ -218,6 +229,12 @@ void setup() {
 
 void readSerial() {
 
+	// Binary frames are handled separately
+	if (binaryMode) {
+		readFrame();
+		return;
+	}
+
 	// Read incoming byte
 	char inchar = Serial.read();
 
@@ -248,6 +265,78 @@ void readSerial() {
 
 
 
+// -------------------------------------------------------------------
+/// Read a binary frame from the serial port
+///
+/// Frame format: [SYNC] [TYPE] [LENGTH] [PAYLOAD...] [CHECKSUM]
+/// The checksum is the XOR of the type, length and payload bytes.
+// -------------------------------------------------------------------
+
+void readFrame() {
+
+	uint8_t inbyte = Serial.read();
+
+	// Wait for the start of a frame
+	if (frameLength == 0 && inbyte != FRAME_SYNC) return;
+	frameBuffer[frameLength++] = inbyte;
+
+	// Discard frames which are too long to be valid
+	if (frameLength == 3 && frameBuffer[2] > MAX_FRAME_LENGTH) {
+		frameLength = 0;
+		return;
+	}
+
+	// Evaluate the frame once it is complete
+	if (frameLength > 3 && frameLength == frameBuffer[2] + 4) {
+		uint8_t checksum = 0;
+		for (uint8_t i = 1; i < frameLength - 1; i++) checksum ^= frameBuffer[i];
+
+		if (checksum == frameBuffer[frameLength - 1]) evaluateFrame();
+		else Serial.println(F("Error: checksum"));
+		frameLength = 0;
+	}
+}
+
+
+
+// -------------------------------------------------------------------
+/// Evaluate a binary frame
+///
+/// Each frame is acknowledged with a single line "K<type>", instead
+/// of echoing every command it contains.
+// -------------------------------------------------------------------
+
+void evaluateFrame() {
+
+	uint8_t type = frameBuffer[1];
+	uint8_t length = frameBuffer[2];
+	uint8_t *payload = &frameBuffer[3];
+
+	Serial.print('K'); Serial.println(type);
+
+	if (type == FRAME_COMMAND && length == 3) {
+		firstChar = payload[0];
+		evaluateCommand(int16_t(payload[1] | (payload[2] << 8)));
+
+	} else if (type == FRAME_DRIVE && length == 2) {
+		firstChar = 'X';
+		evaluateCommand(int8_t(payload[0]));
+		firstChar = 'Y';
+		evaluateCommand(int8_t(payload[1]));
+
+	} else if (type == FRAME_SERVOS && length >= 1) {
+		uint8_t index = 1;
+		for (uint8_t i = 0; i < NUMBER_OF_SERVOS && index < length; i++) {
+			if (payload[0] & (1 << i)) {
+				firstChar = servoCommands[i];
+				evaluateCommand(payload[index++]);
+			}
+		}
+	}
+}
+
+
+
 // -------------------------------------------------------------------
 /// Evaluate input from serial port
 ///
@@ -262,10 +351,31 @@ void evaluateSerial() {
 
 	Serial.print(firstChar); Serial.println(number);
 
+	evaluateCommand(number);
+}
+
+
+
+// -------------------------------------------------------------------
+/// Evaluate a single command
+///
+/// @param  number  The value of the command stored in "firstChar"
+// -------------------------------------------------------------------
+
+void evaluateCommand(int number) {
+
+	// Serial protocol selection
+	// -- -- -- -- -- -- -- -- -- -- -- -- -- --
+	if (firstChar == 'P' && (number == 0 || number == 1)) {
+		binaryMode = (number == 1);
+		frameLength = 0;
+		Serial.print(F("Protocol_")); Serial.println(number);
+	}
+
 
 	// Motor Inputs and Offsets
 	// -- -- -- -- -- -- -- -- -- -- -- -- -- --
-	if      (firstChar == 'X' && number >= -100 && number <= 100) turnValue = int(number * 2.55);       // Left/right control
+	else if (firstChar == 'X' && number >= -100 && number <= 100) turnValue = int(number * 2.55);       // Left/right control
 	else if (firstChar == 'Y' && number >= -100 && number <= 100) moveValue = int(number * 2.55);       // Forward/reverse control
 	else if (firstChar == 'S' && number >= -100 && number <= 100) turnOffset = number;                  // Steering offset
 	else if (firstChar == 'O' && number >=    0 && number <= 250) motorDeadzone = int(number);          // Motor deadzone offset
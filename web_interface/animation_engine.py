@@ -0,0 +1,367 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	animation_engine.py
+# @brief      	Keyframe servo animations played from the Raspberry Pi
+#
+# Animations are JSON files in the animations folder, for example:
+#
+#   {
+#     "name": "Nod",
+#     "easing": "ease-in-out",
+#     "keyframes": [
+#       {"time": 0,    "G": 50, "T": 40, "B": 20},
+#       {"time": 600,  "T": 80},
+#       {"time": 1200, "T": 40, "easing": "linear"}
+#     ]
+#   }
+#
+# Times are in milliseconds and servo positions between 0 and 100, using
+# the same letters as the manual servo commands: G = head rotation, T = neck
+# top, B = neck bottom, U = eye right, E = eye left, L = arm left and
+# R = arm right. A servo which is left out of a keyframe keeps moving
+# towards its next keyframe. The easing of a keyframe is used for the
+# movement towards it, and defaults to the easing of the animation.
+#
+# The positions are interpolated in advance for the tick rate of the player
+# and cached, so playing an animation only has to compare and send values.
+#############################################
+
+import json
+import os
+import threading
+import time
+from serial_protocol import SERVO_ORDER
+
+
+ANIMATION_EXTENSION = ".json"
+
+
+##
+# Easing curves, mapping the progress between two keyframes (0-1) onto the
+# fraction of the movement which has been completed
+#
+EASINGS = {
+	'linear': lambda x: x,
+	'ease-in': lambda x: x * x,
+	'ease-out': lambda x: x * (2 - x),
+	'ease-in-out': lambda x: x * x * (3 - 2 * x),
+	'step': lambda x: 1.0 if x >= 1.0 else 0.0
+}
+
+
+##
+# Keyframe animation loaded from a file
+#
+class Animation:
+
+	##
+	# Constructor
+	#
+	# @param  name       Name of the animation
+	# @param  keyframes  List of keyframe dictionaries, sorted by time
+	# @param  easing     Default easing curve
+	# @throws ValueError if the keyframes are invalid
+	#
+	def __init__(self, name, keyframes, easing='ease-in-out'):
+		if easing not in EASINGS:
+			raise ValueError("Unknown easing: " + str(easing))
+		if not keyframes:
+			raise ValueError("Animation has no keyframes")
+
+		self.name = name
+		self.easing = easing
+		self.keyframes = []
+		lastTime = -1
+		for keyframe in keyframes:
+			frameTime = keyframe.get('time')
+			if not isinstance(frameTime, (int, float)) or frameTime <= lastTime:
+				raise ValueError("Keyframe times must be increasing numbers")
+			frameEasing = keyframe.get('easing', easing)
+			if frameEasing not in EASINGS:
+				raise ValueError("Unknown easing: " + str(frameEasing))
+			positions = {}
+			for servo in SERVO_ORDER:
+				if servo in keyframe:
+					value = keyframe[servo]
+					if not isinstance(value, (int, float)) or not 0 <= value <= 100:
+						raise ValueError("Servo position out of range: " + servo + str(value))
+					positions[servo] = value
+			self.keyframes.append((frameTime / 1000.0, frameEasing, positions))
+			lastTime = frameTime
+
+		self.duration = self.keyframes[-1][0]
+
+
+	##
+	# Interpolate the animation into the positions for each tick
+	#
+	# @param  tickRate  Number of ticks per second
+	# @return List of ticks, each a tuple with the position of every servo
+	#         in SERVO_ORDER (or None if the servo is not animated yet)
+	#
+	def track(self, tickRate):
+		# Keyframes of each servo: list of (time, easing, position)
+		servoKeys = {servo: [] for servo in SERVO_ORDER}
+		for frameTime, easing, positions in self.keyframes:
+			for servo, value in positions.items():
+				servoKeys[servo].append((frameTime, easing, value))
+
+		ticks = int(self.duration * tickRate) + 1
+		columns = [self.servo_track(servoKeys[servo], tickRate, ticks) for servo in SERVO_ORDER]
+		return list(zip(*columns))
+
+
+	##
+	# Interpolate the positions of one servo
+	#
+	# @param  keys      List of (time, easing, position) keyframes of the servo
+	# @param  tickRate  Number of ticks per second
+	# @param  ticks     Number of ticks in the track
+	# @return List of the position at each tick
+	#
+	def servo_track(self, keys, tickRate, ticks):
+		values = []
+		index = 0
+		for tick in range(ticks):
+			now = min(tick / float(tickRate), self.duration)
+			while index < len(keys) and keys[index][0] <= now:
+				index += 1
+
+			if index == 0:
+				# Before the first keyframe of this servo
+				values.append(None)
+			elif index == len(keys):
+				values.append(int(round(keys[-1][2])))
+			else:
+				startTime, startEasing, startValue = keys[index - 1]
+				endTime, easing, endValue = keys[index]
+				progress = EASINGS[easing]((now - startTime) / (endTime - startTime))
+				values.append(int(round(startValue + (endValue - startValue) * progress)))
+
+		# The last tick always reaches the final keyframe
+		if ticks and keys:
+			values[-1] = int(round(keys[-1][2]))
+		return values
+
+
+##
+# Load an animation from a JSON file
+#
+# @param  path  Path of the file
+# @return The Animation object
+# @throws ValueError if the file is not a valid animation
+#
+def load_animation(path):
+	try:
+		with open(path) as f:
+			data = json.load(f)
+	except OSError as e:
+		raise ValueError(str(e))
+
+	name = os.path.splitext(os.path.basename(path))[0]
+	if not isinstance(data, dict) or not isinstance(data.get('keyframes'), list):
+		raise ValueError("Animation file must contain a list of keyframes")
+	return Animation(data.get('name', name), data['keyframes'], data.get('easing', 'ease-in-out'))
+
+
+##
+# Library of the animation files, with their interpolated tracks cached
+#
+# The folder is only scanned again when its modification time changes, and
+# a track is only interpolated again when its file changes.
+#
+class AnimationLibrary:
+
+	##
+	# Constructor
+	#
+	# @param  folder  Folder containing the animation files
+	#
+	def __init__(self, folder):
+		self.folder = folder
+		self.lock = threading.Lock()
+		self.mtime = None
+		self.animations = {}
+		self.tracks = {}
+
+
+	##
+	# Get the available animations, rescanning the folder if it has changed
+	#
+	# @return Dictionary of file name (without extension) -> Animation
+	#
+	def get(self):
+		with self.lock:
+			try:
+				mtime = os.stat(self.folder).st_mtime_ns
+			except OSError:
+				mtime = None
+
+			if mtime != self.mtime:
+				self.animations = {}
+				try:
+					items = sorted(os.listdir(self.folder))
+				except OSError:
+					items = []
+				for item in items:
+					if item.endswith(ANIMATION_EXTENSION):
+						try:
+							self.animations[item[:-len(ANIMATION_EXTENSION)]] = load_animation(os.path.join(self.folder, item))
+						except ValueError as e:
+							print("Unable to load animation", item, e)
+				self.mtime = mtime
+			return self.animations
+
+
+	##
+	# Get the list of animations for the web-interface
+	#
+	# @return List of (file name, animation name, duration in seconds) tuples
+	#
+	def list(self):
+		return [(key, animation.name, animation.duration) for key, animation in self.get().items()]
+
+
+	##
+	# Get the interpolated track of an animation
+	#
+	# @param  key       File name of the animation, without the extension
+	# @param  tickRate  Number of ticks per second
+	# @return List of ticks (see Animation.track), or None if the animation does not exist
+	#
+	def track(self, key, tickRate):
+		# Only the animations in the folder, so the key cannot name another file
+		if key not in self.get():
+			return None
+		path = os.path.join(self.folder, key + ANIMATION_EXTENSION)
+		try:
+			mtime = os.stat(path).st_mtime_ns
+		except OSError:
+			return None
+
+		with self.lock:
+			cached = self.tracks.get((key, tickRate))
+			if cached is not None and cached[0] == mtime:
+				return cached[1]
+
+		try:
+			track = load_animation(path).track(tickRate)
+		except ValueError as e:
+			print("Unable to load animation", key, e)
+			return None
+
+		with self.lock:
+			self.tracks[(key, tickRate)] = (mtime, track)
+		return track
+
+
+##
+# Streams the servo positions of an animation at a fixed tick rate
+#
+# Only positions which changed since they were last sent are queued. If the
+# commands of the previous tick are still waiting to be sent (the serial
+# link is busy), the tick is skipped; the next tick sends the newest
+# positions, so the servos still end up in the right place.
+#
+class AnimationPlayer:
+
+	##
+	# Constructor
+	#
+	# @param  send      Function called with each servo command, for example "L80"
+	# @param  backlog   Function returning the number of commands waiting to be sent
+	# @param  tickRate  Number of ticks per second
+	#
+	def __init__(self, send, backlog, tickRate=25):
+		self.send = send
+		self.backlog = backlog
+		self.tickRate = tickRate
+		self.lock = threading.Lock()
+		self.thread = None
+		self.stopEvent = threading.Event()
+		self.name = None
+		self.ticks = 0
+		self.skipped = 0
+		self.commands = 0
+
+
+	##
+	# Start playing a track, stopping any animation which is playing
+	#
+	# @param  name   Name of the animation, for the status
+	# @param  track  List of ticks returned by AnimationLibrary.track()
+	#
+	def play(self, name, track):
+		self.stop()
+		with self.lock:
+			self.stopEvent = threading.Event()
+			self.name = name
+			self.ticks = 0
+			self.skipped = 0
+			self.commands = 0
+			self.thread = threading.Thread(target=self.run, args=(track, self.stopEvent), name="AnimationPlayer", daemon=True)
+			self.thread.start()
+
+
+	##
+	# Stop the animation and wait for the thread to finish
+	#
+	def stop(self):
+		with self.lock:
+			thread = self.thread
+			self.stopEvent.set()
+		if thread is not None and thread is not threading.current_thread():
+			thread.join()
+
+
+	##
+	# Check whether an animation is playing
+	#
+	def playing(self):
+		thread = self.thread
+		return thread is not None and thread.is_alive()
+
+
+	##
+	# Send the positions of each tick at its scheduled time
+	#
+	# @param  track      List of ticks
+	# @param  stopEvent  Event which is set to stop the animation
+	#
+	def run(self, track, stopEvent):
+		sent = [None] * len(SERVO_ORDER)
+		start = time.perf_counter()
+
+		for index, positions in enumerate(track):
+			delay = start + index / float(self.tickRate) - time.perf_counter()
+			if delay > 0 and stopEvent.wait(delay):
+				return
+			if stopEvent.is_set():
+				return
+
+			# Skip the tick if the link has not caught up, except the last one
+			if index < len(track) - 1 and self.backlog() > 0:
+				self.skipped += 1
+				continue
+
+			for servo, value, previous in zip(SERVO_ORDER, positions, sent):
+				if value is not None and value != previous:
+					self.send(servo + str(value))
+					self.commands += 1
+			sent = list(positions)
+			self.ticks += 1
+
+
+	##
+	# Get the status of the player
+	#
+	def status(self):
+		return {
+			'playing': self.playing(),
+			'animation': self.name,
+			'tickRate': self.tickRate,
+			'ticks': self.ticks,
+			'skipped': self.skipped,
+			'commands': self.commands
+		}
@@ -19,17 +19,39 @@
 # - rec, play, stop and 'sun' tactile buttons handling
 #############################################
 
-from flask import Flask, request, session, redirect, url_for, jsonify, render_template, current_app
-import queue 		# for serial command queue
+from flask import Flask, request, session, redirect, url_for, jsonify, render_template, current_app, g, Response
 import threading 	# for multiple threads
 import os
 import pygame		# for sound
 import serial 		# for Arduino serial access
-import serial.tools.list_ports
 import subprocess 	# for shell commands
 import time
+import json
+import queue 		# for the queue.Full exception
+import atexit		# for releasing the camera on exit
+import asyncio		# for running the serial link on the async server's event loop
+import logging		# for the camera pipeline statistics
 import RPi.GPIO as GPIO
+from serial_link import SerialLink, AsyncSerialLink # for event-driven Arduino communication
+from command_queue import CommandStore, parse_control_message, STOP_COMMAND, NO_DEADLINE # for serial command queue
+from arduino_simulator import ArduinoSimulator, SIMULATOR_DESCRIPTION # for testing without hardware
+import streaming_server	# for the camera stream
+from sound_catalog import SoundCatalog # for the list of audio files
+from sound_engine import SoundEngine # for low-latency sound playback
+from port_inventory import PortInventory, Port # for the cached list of serial ports
+from telemetry import TelemetryStore # for the battery and link history
+from metrics import MetricsRegistry, CONTENT_TYPE # for the /metrics endpoint
+from latency_tracker import RoundTripTracker # for the command round-trip times
+from session_recorder import SessionRecorder, SessionPlayer # for recording and replaying control sessions
+from animation_engine import AnimationLibrary, AnimationPlayer # for keyframe animations played from the Raspberry Pi
+from serial_broker import BrokerClient # for sharing the serial link between worker processes
+from link_supervisor import LinkSupervisor # for reconnecting the Arduino when the link is lost
 app = Flask(__name__)
+try:
+	from flask_sock import Sock # for the WebSocket control channel
+	sock = Sock(app)
+except ImportError:
+	sock = None	# WebSocket not available; the web-interface uses the POST routes instead
 from gpiozero import PWMLED # for status/battery LED
 from gpiozero import Button # for buttons handling
 
@@ -37,28 +59,130 @@ from gpiozero import Button # for buttons handling
 loginPassword = "put_password_here"                                            	# Password for web-interface
 arduinoPort = "ARDUINO"                                                         # Default port which will be selected. Replace the text ARDUINO with the name of your device.
                                                                                 # The name must match the one which appears in the drop-down menu in the “Settings” tab of the web-interface.
-streamScript = "/home/pi/walle-replica/web_interface/streaming_server.py"       # Location of script used to start/stop video stream
 soundFolder = "/home/pi/walle-replica/web_interface/static/sounds/"             # Location of the folder containing all audio files
+recordingFolder = "/home/pi/walle-replica/web_interface/recordings/"            # Location of the folder where recorded control sessions are stored
+animationFolder = "/home/pi/walle-replica/web_interface/animations/"            # Location of the folder containing the keyframe animation files
 app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)      	        # Secret key used for login session cookies
 autoStartArduino = False                                              	        # False = no auto connect, True = automatically try to connect to default port
 autoStartCamera = False                                            	            # False = no auto start, True = automatically start up the camera
 enableLED = False                                                               # False = LED functionality off, True = LED fuctionality on
 enableButtons = False                                                           # False = Rec, Play, Stop and 'Sun' buttons functionality off, True = Rec, Play, Stop and 'Sun' buttons functionality on
+binaryProtocol = False                                                          # False = text serial commands, True = use the compact binary protocol if the Arduino supports it
+enableSimulator = False                                                         # False = only real serial ports, True = also offer a simulated Arduino (for testing without hardware)
+serverMode = "threaded"                                                         # "threaded" = Flask server with a thread per request, "async" = one asyncio event loop for the web server and serial link (needs aiohttp)
+commandQueueSize = 64                                                           # Maximum number of commands waiting to be sent to the Arduino; when it is full, new commands are rejected
+serialBroker = None                                                             # None = app.py opens the serial port itself, path of a Unix socket (for example "/tmp/walle-serial.sock") = use the port owned by serial_broker.py, so the web-interface can run as several worker processes
+cameraRecordingFolder = None                                                    # None = camera stream not recorded, folder path (for example "/home/pi/walle-replica/web_interface/camera/") = record the stream while it is running
+cameraRecordingBudget = 2048                                                    # Disk space in MB for the camera recordings; the oldest segments are deleted to stay below it
+cameraStatsInterval = None                                                      # None = camera pipeline statistics not logged, number of seconds (for example 10) = log the frame rate, frame size, encode latency and client statistics at this interval once the camera stream has been started
+metricsPublic = False                                                           # False = login needed to read /metrics, True = /metrics can be read by a Prometheus server without logging in (exposes link, command and latency data to anyone on the network)
 ##########################################
 
+# The worker processes sharing the broker must all sign the login cookies
+# with the same key, otherwise each worker rejects the cookies of the others
+if serialBroker is not None and not os.environ.get("SECRET_KEY"):
+	raise SystemExit("The SECRET_KEY environment variable must be set when serialBroker is used")
+
+# Log the camera pipeline statistics once the stream has been started
+if cameraStatsInterval is not None:
+	logging.basicConfig(level=logging.INFO)
+	streaming_server.stats_interval = cameraStatsInterval
+
 # Start sound mixer
 pygame.mixer.init()
 
+# Start the simulated Arduino, which will appear in the list of serial ports
+simulator = None
+if enableSimulator:
+	simulator = ArduinoSimulator()
+	print("Simulated Arduino on port:", simulator.start())
+
+# Catalog of audio files, only rescanned when the sound folder changes
+soundCatalog = SoundCatalog(soundFolder)
+
+# Decode the audio files in the background, so that they are ready to play
+soundEngine = SoundEngine(soundFolder)
+threading.Thread(target=soundEngine.preload, args=([item[1] for item in soundCatalog.get()],), daemon=True).start()
+
+# History of the readings received from the Arduino
+telemetry = TelemetryStore()
+telemetry.add_channel('battery', unit="%")
+telemetry.add_channel('echoes', counter=True)
+telemetry.add_channel('linkErrors', counter=True)
+
 # Set up runtime variables and queues
 exitFlag = 0
 arduinoActive = 0
-streaming = 0
 volume = 5
 batteryLevel = -999
 queueLock = threading.Lock()
-workQueue = queue.Queue()
+recorder = SessionRecorder(recordingFolder)
 threads = []
+serialLink = None
+serialLoop = None	# event loop of the async server, if it is used
 initialStartup = False
+linkSettings = {}	# settings commands sent again when the link is reopened, by command character
+
+#############################################
+# Metrics for the /metrics endpoint
+#############################################
+
+##
+# Get the counters of the current serial link
+#
+# @param  key  Name of the counter in SerialLink.stats()
+#
+def link_stat(key):
+	if serialLink is None:
+		return None
+	return serialLink.stats()[key]
+
+metrics = MetricsRegistry()
+metrics.callback('walle_arduino_connected', 'Whether the Arduino serial link is active', lambda: int(bool(arduinoActive and not exitFlag)))
+metrics.callback('walle_queue_depth', 'Commands waiting to be sent to the Arduino', lambda: workQueue.qsize())
+metrics.callback('walle_queue_received_total', 'Commands added to the work queue', lambda: workQueue.stats()['received'], 'counter')
+metrics.callback('walle_queue_coalesced_total', 'Commands replaced by a newer value before being sent', lambda: workQueue.stats()['coalesced'], 'counter')
+metrics.callback('walle_serial_commands_sent_total', 'Commands sent to the Arduino since it was connected, by command character',
+	lambda: {(char,): count for char, count in (link_stat('commandsSent') or {}).items()}, 'counter', ('command',))
+metrics.callback('walle_serial_bytes_sent_total', 'Bytes written to the serial port since the Arduino was connected', lambda: link_stat('bytesSent'), 'counter')
+metrics.callback('walle_serial_bytes_received_total', 'Bytes read from the serial port since the Arduino was connected', lambda: link_stat('bytesReceived'), 'counter')
+metrics.callback('walle_serial_parse_errors_total', 'Over-long lines discarded since the Arduino was connected', lambda: link_stat('parseErrors'), 'counter')
+metrics.callback('walle_serial_link_errors_total', 'Serial links which stopped because of an error', lambda: telemetry.channels['linkErrors'].total, 'counter')
+metrics.callback('walle_battery_percent', 'Last battery level reported by the Arduino', lambda: telemetry.latest('battery'))
+metrics.callback('walle_sound_clips_loaded', 'Sound clips decoded in memory', lambda: soundEngine.stats()['loaded'])
+metrics.callback('walle_sound_memory_bytes', 'Memory used by the decoded sound clips', lambda: soundEngine.stats()['memoryUsed'])
+metrics.callback('walle_sound_cache_hits_total', 'Sound clips played without decoding the file', lambda: soundEngine.stats()['hits'], 'counter')
+metrics.callback('walle_sound_cache_misses_total', 'Sound clips decoded when they were played or preloaded', lambda: soundEngine.stats()['misses'], 'counter')
+controlErrors = metrics.counter('walle_control_errors_total', 'Control messages which could not be parsed')
+requestDuration = metrics.histogram('walle_http_request_duration_seconds', 'Time taken to handle each request', ('route', 'method'))
+
+# Time between sending each command and receiving its echo from the Arduino
+roundTrips = RoundTripTracker(
+	histogram=metrics.histogram('walle_serial_roundtrip_seconds', 'Time between sending a command and receiving its echo', ('command',),
+		(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)),
+	lostCounter=metrics.counter('walle_serial_commands_lost_total', 'Commands which were never echoed by the Arduino', ('command',)))
+
+# Reopens the serial port when the link to the Arduino is lost
+linkSupervisor = LinkSupervisor(lambda portId: getattr(portInventory.find(portId), 'device', None),
+	onConnected=lambda link: linkConnected(link), onLost=lambda error: linkLost(error),
+	histogram=metrics.histogram('walle_serial_recovery_seconds', 'Time from losing the Arduino link to reopening it', (),
+		(0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)))
+metrics.callback('walle_serial_link_losses_total', 'Times the Arduino link was lost', lambda: linkSupervisor.losses, 'counter')
+metrics.callback('walle_serial_link_recoveries_total', 'Times the Arduino link was reopened after it was lost', lambda: linkSupervisor.recoveries, 'counter')
+metrics.callback('walle_serial_reconnecting', 'Whether the Arduino link was lost and is being reopened', lambda: int(linkSupervisor.reconnecting()))
+
+# Commands waiting to be sent to the Arduino, sent in order of their priority class
+workQueue = CommandStore(observer=recorder.record_command, maxSize=commandQueueSize,
+	waitHistogram=metrics.histogram('walle_queue_wait_seconds', 'Time commands waited in the work queue, by priority class', ('class',),
+		(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)))
+metrics.callback('walle_queue_class_depth', 'Commands waiting to be sent to the Arduino, by priority class',
+	lambda: {(name,): count for name, count in workQueue.stats()['pendingPerClass'].items()}, 'gauge', ('class',))
+metrics.callback('walle_queue_capacity', 'Maximum number of commands waiting to be sent to the Arduino', lambda: workQueue.maxSize)
+metrics.callback('walle_queue_rejected_total', 'Commands rejected because the work queue was full', lambda: workQueue.stats()['rejected'], 'counter')
+metrics.callback('walle_queue_expired_total', 'Commands dropped because they waited past their deadline, by priority class',
+	lambda: {(name,): count for name, count in workQueue.stats()['expiredPerClass'].items()}, 'counter', ('class',))
+metrics.callback('walle_queue_cancelled_total', 'Waiting commands cancelled by a stop command, by priority class',
+	lambda: {(name,): count for name, count in workQueue.stats()['cancelledPerClass'].items()}, 'counter', ('class',))
 
 #############################################
 # Set up the multithreading stuff here
@@ -75,71 +199,95 @@ class arduino (threading.Thread):
 	# @param  threadID  The thread identification number
 	# @param  name      Name of the thread
 	# @param  q         Queue containing the message to be sent
-	# @param  port      The serial port where the Arduino is connected
+	# @param  portId    Identifier of the serial port where the Arduino is connected
 	#
-	def __init__(self, threadID, name, q, port):
+	def __init__(self, threadID, name, q, portId):
 		threading.Thread.__init__(self)
 		self.threadID = threadID
 		self.name = name
 		self.q = q
-		self.port = port
+		self.portId = portId
 
 
 	##
 	# Run the thread
 	#
+	# The link supervisor keeps the link running, and reopens the port if
+	# the link is lost, until the Arduino is disconnected.
+	#
 	def run(self):
+		global exitFlag
+
 		print("Starting Arduino Thread", self.name)
-		process_data(self.name, self.q, self.port)
+		error = linkSupervisor.run(self.portId, lambda port: process_data(self.name, self.q, port))
+		if error is not None:
+			print("Unable to connect to the Arduino:", error)
+			telemetry.record('linkErrors', 1)
+		exitFlag = 1
 		print("Exiting Arduino Thread", self.name)
 
 """ End of class: Arduino """
 
 
 ##
-# Send data to the Arduino from a buffer queue
+# Open the serial port and set up the link which sends data to the Arduino
+# from a buffer queue
+#
+# Commands are written as soon as they are queued and incoming messages are
+# parsed as soon as they arrive; see serial_link.py for details.
 #
 # @param  threadName Name of the thread
 # @param  q          Queue containing the messages to be sent
 # @param  port       The serial port where the Arduino is connected
+# @return The SerialLink, which the link supervisor runs until it stops
 #
 def process_data(threadName, q, port):
-	global exitFlag
+	global serialLink
 	
 	ser = serial.Serial(port,115200)
 	ser.flushInput()
-	dataString = ""
 
-	# Keep this thread running until the exitFlag changes
-	while not exitFlag:
+	if serialLoop is not None:
+		# The serial I/O runs on the event loop of the async server; the Arduino thread only waits
+		serialLink = AsyncSerialLink(ser, q, parseArduinoMessage, serialLoop, binary=binaryProtocol, tracker=roundTrips)
+	else:
+		serialLink = SerialLink(ser, q, parseArduinoMessage, binary=binaryProtocol, tracker=roundTrips)
+	return serialLink
+
+
+##
+# Restore the settings of the Arduino after the link was (re)opened
+#
+# The Arduino resets when its USB connection is lost, so the motor
+# deadzone, steering offset and animation mode are sent again. They have
+# no deadline, since opening the port and negotiating the protocol can
+# take longer than the drive commands may wait.
+#
+# @param  link  The SerialLink which is about to run
+#
+def linkConnected(link):
+	for command in linkSettings.values():
 		try:
-			# If there are any messages in the queue, send them
-			queueLock.acquire()
-			if not workQueue.empty():
-				data = q.get() + '\n'
-				queueLock.release()
-				ser.write(data.encode())
-				print(data)
-			else:
-				queueLock.release()
-
-			# Read any incomming messages
-			while (ser.inWaiting() > 0):
-				data = ser.read()
-				if (data.decode() == '\n' or data.decode() == '\r'):
-					print(dataString)
-					parseArduinoMessage(dataString)
-					dataString = ""
-				else:
-					dataString += data.decode()
+			link.q.put(command, NO_DEADLINE)
+		except queue.Full:
+			pass
 
-			time.sleep(0.01)
 
-		# If an error occured in the Arduino Communication
-		except Exception as e: 
-			print(e)
-			exitFlag = 1
-	ser.close()
+##
+# Clean up after the link was lost, before it is reopened
+#
+# @param  error  The exception which stopped the link
+#
+def linkLost(error):
+	global batteryLevel
+
+	telemetry.record('linkErrors', 1)
+	batteryLevel = -999
+
+	# Do not send movements which were queued for the old link
+	queueLock.acquire()
+	workQueue.clear()
+	queueLock.release()
 
 
 #############################################
@@ -173,44 +321,49 @@ if enableLED:
 #dtoverlay=gpio-shutdown,gpio_pin=21
 #############################################
 # Buttons handler
-# If you want to use this function uncomment the lines from 179-210.
-# Currently the buttons are mapped to play sounds hardcoded below in lines: recBtn.when_pressed, playBtn.when_pressed and stopBtn.when_pressed.
-# You can replace sound names with your own.
+# Rec starts (or stops) recording everything sent to the Arduino and every sound played,
+# Play replays the newest recording and Stop stops both the recording and the playback.
 
 if enableButtons:
     # GPIO setup
     GPIO.setmode(GPIO.BCM)
     GPIO.setwarnings(False)
 
-    # Initialize last pressed time for each button
-    last_pressed_time_rec = 0
-    last_pressed_time_play = 0
-    last_pressed_time_stop = 0
+    # Last pressed time for each button
+    last_pressed_times = {'Rec': 0, 'Play': 0, 'Stop': 0}
 
     # Setup buttons
     recBtn = Button(19, pull_up=True)
     playBtn = Button(13, pull_up=True)
     stopBtn = Button(16, pull_up=True)
 
-    def button_pressed(button, last_pressed_time, sound):
-        global last_pressed_time_rec, last_pressed_time_play, last_pressed_time_stop
+    def button_pressed(button, action):
         current_time = time.time()
         # Check if the time difference since the last press is greater than 0.5 seconds
-        if current_time - last_pressed_time > 0.5:
+        if current_time - last_pressed_times[button] > 0.5:
             print(f"{button} button pressed")
-            last_pressed_time = current_time
-            playSound(sound)
+            last_pressed_times[button] = current_time
+            action()
+
+    def toggleRecording():
+        if recorder.recording():
+            print("Stopped recording:", recorder.stop_recording())
+        else:
+            print("Recording to:", recorder.start_recording())
 
-    recBtn.when_pressed = lambda: button_pressed('Rec', last_pressed_time_rec, 'Voice_Walle-1_1950')
-    playBtn.when_pressed = lambda: button_pressed('Play', last_pressed_time_play, 'Voice_Walle-2_3900')
-    stopBtn.when_pressed = lambda: button_pressed('Stop', last_pressed_time_stop, 'Voice_Walle-3_1700')
+    def playRecording():
+        path = recorder.find()
+        if path is not None:
+            recorder.stop_recording()
+            player.play(path)
 
-    def playSound(sound):
-        clip = soundFolder + sound + ".ogg"
-        pygame.mixer.music.load(clip)
-        pygame.mixer.music.set_volume(volume/10.0)
-        pygame.mixer.music.play()
-        print("Play music clip:", clip)
+    def stopAll():
+        recorder.stop_recording()
+        player.stop()
+
+    recBtn.when_pressed = lambda: button_pressed('Rec', toggleRecording)
+    playBtn.when_pressed = lambda: button_pressed('Play', playRecording)
+    stopBtn.when_pressed = lambda: button_pressed('Stop', stopAll)
 
 #############################################
 
@@ -226,37 +379,99 @@ def parseArduinoMessage(dataString):
 	if "Battery" in dataString:
 		dataList = dataString.split('_')
 		if len(dataList) > 1 and dataList[1].isdigit():
-			batteryLevel = dataList[1]
+			batteryLevel = int(dataList[1])
+			telemetry.record('battery', batteryLevel)
 			# ####################################################
 			# Start pulsing LED if battery level drops below 49
-			if enableLED and (batteryLevel < "50"):
-				led.pulse()
-			else:
-			    led.value = 0.1
+			if enableLED:
+				if batteryLevel < 50:
+					led.pulse()
+				else:
+					led.value = 0.1
 			# ####################################################
 
+	# Echo of a command, such as "X-37" (or "K2" for a binary frame)
+	elif len(dataString) > 1 and dataString[1:].lstrip('-').isdigit():
+		telemetry.record('echoes', 1)
+
+##
+# Get the simulated Arduino port, if the simulator is enabled
+#
+# @return List of additional Port tuples
+#
+def simulator_ports():
+	if simulator is None or simulator.port is None:
+		return []
+	return [Port("simulator", simulator.port, SIMULATOR_DESCRIPTION)]
+
+# Serial ports are only enumerated again when a device is plugged in or out
+portInventory = PortInventory(extra=simulator_ports)
+
+
+##
+# Follow the state of the serial link owned by the broker
+#
+# While the broker reconnects a lost link, the Arduino stays active and the
+# broker answers the commands with the reconnecting error.
+#
+# @param  link  Dictionary with the "connected" and "reconnecting" state and the "device" of the link
+#
+def brokerLinkChanged(link):
+	global arduinoActive
+	global batteryLevel
+
+	arduinoActive = 1 if link['connected'] or link.get('reconnecting') else 0
+	if not link['connected']:
+		batteryLevel = -999
+
+# When serial_broker.py owns the serial port, every worker process receives the Arduino messages from it
+broker = None
+if serialBroker is not None:
+	broker = BrokerClient(serialBroker)
+	broker.subscribe(parseArduinoMessage, brokerLinkChanged)
+
+
 ##
 # Turn on/off the Arduino background communications thread
 #
-# @param  q    Queue object containing the messages to be sent
-# @param  port The serial port where the Arduino is connected
+# @param  q       Queue object containing the messages to be sent
+# @param  portId  Identifier of the serial port where the Arduino is connected
 #
-def onoff_arduino(q, portNum):
+def onoff_arduino(q, portId):
 	global arduinoActive
 	global exitFlag
 	global threads
 	global batteryLevel
 	
+	# The serial port is opened and closed by the broker
+	if broker is not None:
+		if not arduinoActive:
+			port = portInventory.find(portId)
+			if port is None:
+				print("Serial port not found:", portId)
+				return 1
+			error = broker.connect(port.device, port.id)
+			if error is not None:
+				print("Unable to connect to the Arduino:", error)
+				return 1
+			arduinoActive = 1
+		else:
+			broker.disconnect()
+			batteryLevel = -999
+			arduinoActive = 0
+		return 0
+
 	# Set up thread and connect to Arduino
 	if not arduinoActive:
 		exitFlag = 0
 
-		usb_ports = [
-			p.device
-			for p in serial.tools.list_ports.comports()
-		]
+		port = portInventory.find(portId)
+		if port is None:
+			print("Serial port not found:", portId)
+			return 1
 		
-		thread = arduino(1, "Arduino", q, usb_ports[portNum])
+		linkSupervisor.reset()
+		thread = arduino(1, "Arduino", q, port.id)
 		thread.start()
 		threads.append(thread)
 
@@ -267,16 +482,18 @@ def onoff_arduino(q, portNum):
 		exitFlag = 1
 		batteryLevel = -999
 
-		# Clear the queue
-		queueLock.acquire()
-		while not workQueue.empty():
-			q.get()
-		queueLock.release()
+		# Stop the link and any reconnection attempts, so that the threads can exit
+		linkSupervisor.stop()
 
 		# Join any active threads up
 		for t in threads:
 			t.join()
 
+		# Clear the queue
+		queueLock.acquire()
+		q.clear()
+		queueLock.release()
+
 		threads = []
 		arduinoActive = 0
 
@@ -296,31 +513,57 @@ def test_arduino():
 	if arduinoActive and not exitFlag:
 		return 1
 	elif exitFlag and arduinoActive:
-		onoff_arduino(workQueue, 0)
+		onoff_arduino(workQueue, None)
 	else:
 		return 0
 
 
 ##
-# Turn on/off the webcam MJPG Streamer
+# Turn on/off the camera stream
+#
+# The camera and its HTTP server run inside this process. Stopping the
+# stream only pauses the encoders, so the camera stays initialised and the
+# stream can be restarted almost instantly.
+#
+# @return 0 if successful, 1 if the camera could not be started
 #
 #####################################################################################################################################
 
 def onoff_streamer():
-    global streaming
-    
-    if not streaming:
-        # Turn on stream
-        subprocess.Popen(["python3", streamScript], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        print("Camera stream: STARTED")
-        streaming = 1
-        return 0
-    else:
-        # Turn off stream
-        subprocess.Popen(["pkill", "-f", "streaming_server.py"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        print("Camera stream: STOPPED")
-        streaming = 0
+    try:
+        if not streaming_server.streaming:
+            # Turn on stream
+            streaming_server.start_server()
+            if cameraRecordingFolder is not None:
+                streaming_server.start_recording(cameraRecordingFolder, budget=cameraRecordingBudget * 1024 ** 2)
+            streaming_server.start_streaming()
+            print("Camera stream: STARTED in %.1f ms" % (streaming_server.toggle_times['start'] * 1000))
+        else:
+            # Turn off stream
+            streaming_server.stop_streaming()
+            print("Camera stream: STOPPED in %.1f ms" % (streaming_server.toggle_times['stop'] * 1000))
         return 0
+    except Exception as e:
+        print("Camera stream error:", e)
+        return 1
+
+atexit.register(streaming_server.close_camera)
+
+
+##
+# Change the frame rate and/or JPEG quality of the camera stream
+#
+# @param  framerate  Maximum frame rate, or None to keep the current value
+# @param  quality    JPEG quality (1-100), or None to keep the current value
+# @return 0 if successful, 1 if the camera could not be updated
+#
+def update_stream_settings(framerate=None, quality=None):
+    try:
+        streaming_server.apply_settings(framerate, quality)
+    except Exception as e:
+        print("Unable to update camera stream settings:", e)
+        return 1
+    return 0
 
 #####################################################################################################################################
 
@@ -328,6 +571,26 @@ def onoff_streamer():
 # Flask Pages and Functions
 #############################################
 
+##
+# Record the start time of each request
+#
+@app.before_request
+def start_timer():
+	g.requestStart = time.perf_counter()
+
+
+##
+# Add the time taken by each request to the latency histogram
+#
+@app.after_request
+def record_duration(response):
+	# WebSocket connections stay open, so their duration is not a latency
+	if 'requestStart' in g and request.environ.get('HTTP_UPGRADE', '').lower() != 'websocket':
+		route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+		requestDuration.observe(time.perf_counter() - g.requestStart, route, request.method)
+	return response
+
+
 ##
 # Show the main web-interface page
 #
@@ -338,46 +601,13 @@ def index():
 		return redirect(url_for('login'))
 
 	# Get list of audio files
-	files = []
-	for item in sorted(os.listdir(soundFolder)):
-		if item.endswith(".ogg"):
-			audiofiles = os.path.splitext(os.path.basename(item))[0]
-			
-			# Set up default details
-			audiogroup = "Other"
-			audionames = audiofiles
-			audiotimes = 0
-			
-			# Get item details from name, and make sure they are valid
-			if len(audiofiles.split('_')) == 2:
-				if audiofiles.split('_')[1].isdigit():
-					audionames = audiofiles.split('_')[0]
-					audiotimes = float(audiofiles.split('_')[1])/1000.0
-				else:
-					audiogroup = audiofiles.split('_')[0]
-					audionames = audiofiles.split('_')[1]
-			elif len(audiofiles.split('_')) == 3:
-				audiogroup = audiofiles.split('_')[0]
-				audionames = audiofiles.split('_')[1]
-				if audiofiles.split('_')[2].isdigit():
-					audiotimes = float(audiofiles.split('_')[2])/1000.0
-			
-			# Add the details to the list
-			files.append((audiogroup,audiofiles,audionames,audiotimes))
+	files = soundCatalog.get()
 	
 	# Get list of connected USB devices
-	ports = serial.tools.list_ports.comports()
-	usb_ports = [
-		p.description
-		for p in serial.tools.list_ports.comports()
-		#if 'ttyACM0' in p.description
-	]
+	usb_ports = portInventory.ports()
 	
 	# Ensure that the preferred Arduino port is selected by default
-	selectedPort = 0
-	for index, item in enumerate(usb_ports):
-		if arduinoPort in item:
-			selectedPort = index
+	selectedPort = portInventory.preferred(arduinoPort)
 	
 	# Only automatically connect systems on startup
 	global initialStartup
@@ -385,9 +615,9 @@ def index():
 		initialStartup = True
 
 		# If user has selected for the camera stream to be active by default, turn it on now
-		if autoStartCamera and not streaming:
+		if autoStartCamera and not streaming_server.streaming:
 			cameraAutoStartValue = autoStartCamera
-			streamingValue = streaming
+			streamingValue = streaming_server.streaming
 			print("Auto Start Camera is set to", cameraAutoStartValue, "and Streaming value is set to", streamingValue)
 			print("Automaticaly starting camera stream")
 			onoff_streamer()
@@ -398,7 +628,26 @@ def index():
 			print("Started Arduino comms")
 
 
-	return render_template('index.html',sounds=files,ports=usb_ports,portSelect=selectedPort,connected=arduinoActive,cameraActive=streaming)
+	return render_template('index.html',sounds=files,animations=animationLibrary.list(),ports=usb_ports,portSelect=selectedPort,connected=arduinoActive,cameraActive=int(streaming_server.streaming),cameraFramerate=streaming_server.settings['framerate'],cameraQuality=streaming_server.settings['quality'])
+
+##
+# Get the list of audio files
+#
+# The response has an ETag, so the browser only downloads the list
+# again when the contents of the sound folder have changed.
+#
+# @return JSON containing the (group, file, name, duration) of each file
+#
+@app.route('/sounds')
+def sounds():
+	if session.get('active') != True:
+		return redirect(url_for('login'))
+
+	response = jsonify({'status': 'OK','sounds':soundCatalog.get()})
+	response.set_etag(soundCatalog.get_etag())
+	response.headers['Cache-Control'] = 'private, no-cache'
+	return response.make_conditional(request)
+
 
 ##
 # Show the Login page
@@ -439,14 +688,11 @@ def motor():
 		yVal = int(float(stickY)*100)
 		print("Motors:", xVal, ",", yVal)
 
-		if test_arduino() == 1:
-			queueLock.acquire()
-			workQueue.put("X" + str(xVal))
-			workQueue.put("Y" + str(yVal))
-			queueLock.release()
+		error = queue_commands(["X" + str(xVal), "Y" + str(yVal)])
+		if error is None:
 			return jsonify({'status': 'OK' })
 		else:
-			return jsonify({'status': 'Error','msg':'Arduino not connected'})
+			return jsonify({'status': 'Error','msg':error})
 	else:
 		print("Error: unable to read POST data from motor command")
 		return jsonify({'status': 'Error','msg':'Unable to read POST data'})
@@ -467,32 +713,26 @@ def settings():
 		# Motor deadzone threshold
 		if thing == "motorOff":
 			print("Motor Offset:", value)
-			if test_arduino() == 1:
-				queueLock.acquire()
-				workQueue.put("O" + value)
-				queueLock.release()
-			else:
-				return jsonify({'status': 'Error','msg':'Arduino not connected'})
+			error = queue_commands(["O" + value])
+			if error is not None:
+				return jsonify({'status': 'Error','msg':error})
+			linkSettings['O'] = "O" + value
 
 		# Motor steering offset/trim
 		elif thing == "steerOff":
 			print("Steering Offset:", value)
-			if test_arduino() == 1:
-				queueLock.acquire()
-				workQueue.put("S" + value)
-				queueLock.release()
-			else:
-				return jsonify({'status': 'Error','msg':'Arduino not connected'})
+			error = queue_commands(["S" + value])
+			if error is not None:
+				return jsonify({'status': 'Error','msg':error})
+			linkSettings['S'] = "S" + value
 
 		# Automatic/manual animation mode
 		elif thing == "animeMode":
 			print("Animation Mode:", value)
-			if test_arduino() == 1:
-				queueLock.acquire()
-				workQueue.put("M" + value)
-				queueLock.release()
-			else:
-				return jsonify({'status': 'Error','msg':'Arduino not connected'})
+			error = queue_commands(["M" + value])
+			if error is not None:
+				return jsonify({'status': 'Error','msg':error})
+			linkSettings['M'] = "M" + value
 
 		# Sound mode currently doesn't do anything
 		elif thing == "soundMode":
@@ -510,10 +750,26 @@ def settings():
 			if onoff_streamer() == 1:
 				return jsonify({'status': 'Error', 'msg': 'Unable to start the stream'})
 
-			if streaming == 1:
-				return jsonify({'status': 'OK','streamer': 'Active'})
+			if streaming_server.streaming:
+				return jsonify({'status': 'OK','streamer': 'Active','camera': streaming_server.camera_status()})
 			else:
-				return jsonify({'status': 'OK','streamer': 'Offline'})
+				return jsonify({'status': 'OK','streamer': 'Offline','camera': streaming_server.camera_status()})
+
+		# Camera stream frame rate
+		elif thing == "cameraFps":
+			print("Camera Frame Rate:", value)
+			if not value.isdigit() or not 1 <= int(value) <= 60:
+				return jsonify({'status': 'Error','msg': 'Frame rate must be between 1 and 60'})
+			if update_stream_settings(framerate=int(value)) == 1:
+				return jsonify({'status': 'Error','msg': 'Unable to update the camera stream'})
+
+		# Camera stream JPEG quality
+		elif thing == "cameraQuality":
+			print("Camera Quality:", value)
+			if not value.isdigit() or not 1 <= int(value) <= 100:
+				return jsonify({'status': 'Error','msg': 'Quality must be between 1 and 100'})
+			if update_stream_settings(quality=int(value)) == 1:
+				return jsonify({'status': 'Error','msg': 'Unable to update the camera stream'})
 
 		# Shut down the Raspberry Pi
 		elif thing == "shutdown":
@@ -530,6 +786,45 @@ def settings():
 		return jsonify({'status': 'Error','msg': 'Unable to read POST data'})
 
 
+##
+# Play an audio clip from the sound folder
+#
+# The volume setting (0-10) is scaled in the same way for the web-interface
+# and the physical buttons.
+#
+# @param  clip  Name of the clip (file name without the extension)
+#
+def playClip(clip):
+	print("Play music clip:", clip)
+	recorder.record_sound(clip)
+	soundEngine.play(clip, volume/20.0)
+
+
+##
+# Queue a command from a recording, if the Arduino is connected
+#
+# A command which does not fit in the queue is dropped; the following
+# events of the recording or animation send newer values.
+#
+# @param  command  The command string, for example "X-37"
+#
+def playCommand(command):
+	if broker is not None:
+		broker.send([command])
+	elif arduinoActive and not exitFlag and not linkSupervisor.reconnecting():
+		try:
+			workQueue.put(command)
+		except queue.Full:
+			pass
+
+# Plays recorded sessions back on its own thread
+player = SessionPlayer(playCommand, playClip)
+
+# Keyframe animations, interpolated in advance and streamed as servo commands
+animationLibrary = AnimationLibrary(animationFolder)
+animationPlayer = AnimationPlayer(playCommand, workQueue.qsize)
+
+
 ##
 # Play an Audio clip on the Raspberry Pi
 #
@@ -541,16 +836,51 @@ def audio():
 		
 	clip =  request.form.get('clip')
 	if clip is not None:
-		clip = soundFolder + clip + ".ogg"
-		print("Play music clip:", clip)
-		pygame.mixer.music.load(clip)
-		pygame.mixer.music.set_volume(volume/20.0) # zmiana z 10.0
-		pygame.mixer.music.play()
+		if clip not in [item[1] for item in soundCatalog.get()]:
+			return jsonify({'status': 'Error','msg':'Unknown audio clip'})
+		playClip(clip)
 		return jsonify({'status': 'OK' })
 	else:
 		return jsonify({'status': 'Error','msg':'Unable to read POST data'})
 
 
+##
+# Record and replay control sessions
+#
+# @return JSON containing the recorder and player status
+#
+@app.route('/recorder', methods=['POST'])
+def recorderControl():
+	if session.get('active') != True:
+		return redirect(url_for('login'))
+
+	action = request.form.get('action')
+	name = request.form.get('name') or None
+
+	if action == "record":
+		try:
+			path = recorder.start_recording(name)
+		except FileExistsError:
+			return jsonify({'status': 'Error','msg':'A recording with this name already exists'})
+		player.stop()
+		print("Recording to:", path)
+	elif action == "play":
+		path = recorder.find(name)
+		if path is None:
+			return jsonify({'status': 'Error','msg':'Recording not found'})
+		recorder.stop_recording()
+		player.play(path, loop=request.form.get('loop') == "1")
+	elif action == "stop":
+		recorder.stop_recording()
+		player.stop()
+	elif action == "list":
+		return jsonify({'status': 'OK','recordings':recorder.list()})
+	elif action != "status":
+		return jsonify({'status': 'Error','msg':'Unable to read POST data'})
+
+	return jsonify({'status': 'OK','recorder':recorder.status(),'player':player.status()})
+
+
 ##
 # Send an Animation command to the Arduino
 #
@@ -564,9 +894,18 @@ def animate():
 		print("Animate:", clip)
 
 		if test_arduino() == 1:
-			queueLock.acquire()
-			workQueue.put("A" + clip)
-			queueLock.release()
+			# Animations stored on the Arduino are numbered
+			if clip.isdigit():
+				error = queue_commands(["A" + clip])
+				if error is not None:
+					return jsonify({'status': 'Error','msg':error})
+				return jsonify({'status': 'OK' })
+
+			# Keyframe animation files are played from the Raspberry Pi
+			track = animationLibrary.track(clip, animationPlayer.tickRate)
+			if track is None:
+				return jsonify({'status': 'Error','msg':'Unknown animation'})
+			animationPlayer.play(clip, track)
 			return jsonify({'status': 'OK' })
 		else:
 			return jsonify({'status': 'Error','msg':'Arduino not connected'})
@@ -588,17 +927,133 @@ def servoControl():
 		print("servo:", servo)
 		print("value:", value)
 		
-		if test_arduino() == 1:
-			queueLock.acquire()
-			workQueue.put(servo + value)
-			queueLock.release()
+		error = queue_commands([servo + value])
+		if error is None:
 			return jsonify({'status': 'OK' })
 		else:
-			return jsonify({'status': 'Error','msg':'Arduino not connected'})
+			return jsonify({'status': 'Error','msg':error})
 	else:
 		return jsonify({'status': 'Error','msg':'Unable to read POST data'})
 
 
+##
+# Queue the commands contained in a control message
+#
+# @param  message  Compact control message, for example "X37;Y-50"
+# @return Error message, or None if the commands were queued
+#
+def queue_control_message(message):
+	try:
+		commands = parse_control_message(message)
+	except ValueError as e:
+		controlErrors.inc()
+		return str(e)
+
+	return queue_commands(commands)
+
+
+##
+# Queue commands to be sent to the Arduino
+#
+# An animation stored on the Arduino ("A" command) stops the keyframe
+# animation played from the Raspberry Pi, so the two do not move the
+# servos at the same time. A stop command also stops the keyframe
+# animation and the session being replayed, before the stop cancels the
+# commands they have queued.
+#
+# @param  commands  List of command strings
+# @return Error message if a command is empty, the Arduino is not connected
+#         or the queue is full (commands before the one which did not fit are
+#         still sent), or None
+#
+def queue_commands(commands):
+	if not all(commands):
+		return 'Invalid command'
+
+	if STOP_COMMAND in commands:
+		animationPlayer.stop()
+		player.stop()
+	elif any(command.startswith("A") for command in commands):
+		animationPlayer.stop()
+
+	if broker is not None:
+		error = broker.send(commands)
+		if error is None:
+			for command in commands:
+				recorder.record_command(command)
+		return error
+
+	if test_arduino() != 1:
+		return 'Arduino not connected'
+	if linkSupervisor.reconnecting():
+		return 'Arduino link lost; reconnecting'
+
+	queueLock.acquire()
+	try:
+		for command in commands:
+			workQueue.put(command)
+	except queue.Full:
+		return 'Command queue full; the Arduino is not keeping up'
+	finally:
+		queueLock.release()
+	return None
+
+
+##
+# Get the status messages which have to be pushed to a control channel client
+#
+# @param  state  Dictionary holding what was last pushed to the client
+# @return List of JSON messages to send
+#
+def control_updates(state):
+	updates = []
+	status = {'status': 'OK','arduino': 'Connected' if arduinoActive and not exitFlag else 'Disconnected','battery':batteryLevel,'link':linkSupervisor.state,
+		'animation':animationPlayer.name if animationPlayer.playing() else None}
+	if status != state.get('status'):
+		updates.append(json.dumps(status))
+		state['status'] = status
+
+	# Push the battery and link telemetry when new readings arrive
+	if telemetry.version != state.get('version') and time.monotonic() - state.get('pushed', 0) >= 1.0:
+		state['version'] = telemetry.version
+		state['pushed'] = time.monotonic()
+		summary = telemetry.summary(['battery', 'linkErrors'])
+		if summary != state.get('telemetry'):
+			updates.append(json.dumps({'status': 'OK','telemetry':summary}))
+			state['telemetry'] = summary
+	return updates
+
+
+##
+# Persistent control channel for the joystick, servos and animations
+#
+# The session is checked once when the WebSocket is opened. Afterwards the
+# client sends compact control messages (see queue_control_message). Between
+# messages, and at least once a second, the server checks the Arduino status
+# and battery telemetry and sends them to the client when they have changed.
+#
+# @param  ws  The WebSocket connection
+#
+def control(ws):
+	if session.get('active') != True:
+		ws.close()
+		return
+
+	state = {}
+	while True:
+		message = ws.receive(timeout=1)
+		if message is not None:
+			error = queue_control_message(message)
+			if error is not None:
+				ws.send(json.dumps({'status': 'Error','msg':error}))
+
+		for update in control_updates(state):
+			ws.send(update)
+
+if sock is not None:
+	sock.route('/control')(control)
+
+
 ##
 # Connect/Disconnect the Arduino Serial Port
 #
@@ -615,18 +1070,10 @@ def arduinoConnect():
 			print("Reload list of connected USB ports")
 			
 			# Get list of connected USB devices
-			ports = serial.tools.list_ports.comports()
-			usb_ports = [
-				p.description
-				for p in serial.tools.list_ports.comports()
-				#if 'ttyACM0' in p.description
-			]
+			usb_ports = [{'id': port.id, 'name': port.description} for port in portInventory.ports(refresh=True)]
 			
 			# Ensure that the preferred Arduino port is selected by default
-			selectedPort = 0
-			for index, item in enumerate(usb_ports):
-				if arduinoPort in item:
-					selectedPort = index
+			selectedPort = portInventory.preferred(arduinoPort)
 					
 			return jsonify({'status': 'OK','ports':usb_ports,'portSelect':selectedPort})
 		
@@ -636,26 +1083,22 @@ def arduinoConnect():
 			print("Reconnect to Arduino")
 			
 			if test_arduino():
-				onoff_arduino(workQueue, 0)
+				onoff_arduino(workQueue, None)
 				return jsonify({'status': 'OK','arduino': 'Disconnected'})
 				
 			else:	
-				port = request.form.get('port')
-				if port is not None and port.isdigit():
-					portNum = int(port)
+				portId = request.form.get('port')
+				if portId is not None:
 					# Test whether connection to the selected port is possible
-					usb_ports = [
-						p.device
-						for p in serial.tools.list_ports.comports()
-					]
-					if portNum >= 0 and portNum < len(usb_ports):
+					port = portInventory.find(portId)
+					if port is not None:
 						# Try opening and closing port to see if connection is possible
 						try:
-							ser = serial.Serial(usb_ports[portNum],115200)
+							ser = serial.Serial(port.device,115200)
 							if (ser.inWaiting() > 0):
 								ser.flushInput()
 							ser.close()
-							onoff_arduino(workQueue, portNum)
+							onoff_arduino(workQueue, portId)
 							return jsonify({'status': 'OK','arduino': 'Connected'})
 						except:
 							return jsonify({'status': 'Error','msg':'Unable to connect to selected serial port'})
@@ -672,7 +1115,8 @@ def arduinoConnect():
 ##
 # Update the Arduino Status
 #
-# @return JSON containing the current battery level
+# @return JSON containing the current battery level, or the queue, link,
+#         latency, animation or telemetry status
 #
 @app.route('/arduinoStatus', methods=['POST'])
 def arduinoStatus():
@@ -687,15 +1131,79 @@ def arduinoStatus():
 				return jsonify({'status': 'OK','battery':batteryLevel})
 			else:
 				return jsonify({'status': 'Error','msg':'Arduino not connected'})
+
+		# Counters of the serial command queue
+		elif action == "queue":
+			return jsonify({'status': 'OK','queue':workQueue.stats()})
+
+		# State of the serial link and its reconnections
+		elif action == "link":
+			return jsonify({'status': 'OK','link':linkSupervisor.status()})
+
+		# Round-trip times of the commands sent to the Arduino
+		elif action == "latency":
+			if request.form.get('reset') == "1":
+				roundTrips.reset()
+			return jsonify({'status': 'OK','latency':roundTrips.report()})
+
+		# Keyframe animation played from the Raspberry Pi, if any
+		elif action == "animation":
+			return jsonify({'status': 'OK','animation':animationPlayer.status()})
+
+		# Latest, smoothed and rate of change of the telemetry readings
+		elif action == "telemetry":
+			return jsonify({'status': 'OK','telemetry':telemetry.summary()})
+
+		# Readings of one telemetry channel as an array of [time, value] pairs
+		elif action == "history":
+			channel = request.form.get('channel', 'battery')
+			if channel not in telemetry.channels:
+				return jsonify({'status': 'Error','msg':'Unknown telemetry channel'})
+			try:
+				since = float(request.form.get('since', 0))
+			except ValueError:
+				return jsonify({'status': 'Error','msg':'Invalid [since] POST data'})
+			return jsonify({'status': 'OK','channel':channel,'history':telemetry.history(channel, since)})
 	
 	return jsonify({'status': 'Error','msg':'Unable to read POST data'})
 
 
+##
+# Get the real state of the camera stream
+#
+# @return JSON containing the camera, encoder and streaming server status
+#
+@app.route('/cameraStatus', methods=['POST'])
+def cameraStatus():
+	if session.get('active') != True:
+		return redirect(url_for('login'))
+
+	return jsonify({'status': 'OK','streamer': 'Active' if streaming_server.streaming else 'Offline','camera': streaming_server.camera_status()})
+
+
+##
+# Metrics of the web-interface and the camera stream
+#
+# @return Prometheus text format
+#
+@app.route('/metrics')
+def metricsPage():
+	if not metricsPublic and session.get('active') != True:
+		return redirect(url_for('login'))
+
+	return Response(metrics.render() + streaming_server.metrics.render(), content_type=CONTENT_TYPE)
+
+
 ##
 # Program start code, which initialises the web-interface
 #
 if __name__ == '__main__':
 
-	app.run(threaded=True, debug=False, host='0.0.0.0')
+	if serverMode == "async":
+		import sys
+		import async_server
+		async_server.run(sys.modules[__name__], host='0.0.0.0', port=5000)
+	else:
+		app.run(threaded=True, debug=False, host='0.0.0.0')
 
 # ####################################################
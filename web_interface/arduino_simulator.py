@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	arduino_simulator.py
+# @brief      	Fake Arduino running on a pseudo-terminal
+#
+# Speaks the same serial protocol as evaluateSerial() in wall-e.ino, so the
+# web-interface can be tested and load-tested without any hardware:
+# - every text command is echoed back as <char><number>
+# - binary frames are acknowledged with K<type> (after "P1")
+# - a Battery_NN status line is sent at regular intervals
+# - optional response latency and baud rate throttling
+#
+# It can be run on its own, after which the printed port can be opened by
+# any serial program:
+#
+#   python3 arduino_simulator.py [--latency 5] [--baud 115200]
+#
+# or enabled in app.py with "enableSimulator = True", after which it appears
+# in the list of serial ports in the "Settings" tab. drop() disconnects it
+# for a while, to test how the web-interface recovers from a lost link.
+#############################################
+
+import argparse
+import heapq 		# for the queue of delayed replies
+import os
+import select
+import threading
+import time
+import tty 		# for setting the pseudo-terminal to raw mode
+from serial_protocol import FrameDecoder, PROTOCOL_REPLY, SERVO_ORDER, split_command
+
+
+SIMULATOR_DESCRIPTION = "Arduino Simulator"
+MAX_SERIAL_LENGTH = 5       # Maximum number of characters that can be received
+
+
+##
+# Simulated Arduino, connected to one end of a pseudo-terminal
+#
+class ArduinoSimulator:
+
+	##
+	# Constructor
+	#
+	# @param  latency        Delay in seconds before each reply is sent
+	# @param  baud           Baud rate used to throttle the data, or 0 for no limit
+	# @param  batteryPeriod  Seconds between battery messages, or 0 to disable them
+	# @param  batteryLevel   Initial battery level in percent
+	#
+	def __init__(self, latency=0.0, baud=115200, batteryPeriod=10.0, batteryLevel=100):
+		self.latency = latency
+		self.baud = baud
+		self.batteryPeriod = batteryPeriod
+		self.batteryLevel = batteryLevel
+
+		self.master = None
+		self.slave = None
+		self.port = None
+		self.running = False
+		self.threads = []
+
+		self.replies = []
+		self.replyCondition = threading.Condition()
+		self.replyCount = 0
+
+		# Robot state, updated by the received commands
+		self.binaryMode = False
+		self.state = {}
+		self.received = 0
+		self.commands = []
+		self.recordCommands = False
+
+
+	##
+	# Open the pseudo-terminal and start the simulator threads
+	#
+	# @return Device path of the simulated serial port
+	#
+	def start(self):
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+		self.running = True
+
+		self.threads = [
+			threading.Thread(target=self.read_loop, name="SimulatorReader", daemon=True),
+			threading.Thread(target=self.write_loop, name="SimulatorWriter", daemon=True)
+		]
+		for thread in self.threads:
+			thread.start()
+
+		self.reply("--- Wall-E Control Sketch ---")
+		self.reply("Sartup complete; entering main loop")
+		return self.port
+
+
+	##
+	# Stop the simulator and close the pseudo-terminal
+	#
+	def stop(self):
+		if not self.running:
+			return
+		self.running = False
+		with self.replyCondition:
+			self.replyCondition.notify()
+		for thread in self.threads:
+			thread.join()
+		os.close(self.master)
+		os.close(self.slave)
+		self.port = None
+
+
+	##
+	# Drop the link, as when the USB connection browns out
+	#
+	# The pseudo-terminal is closed, so the reader of the other end gets an
+	# error, and the Arduino comes back after the given time on a new device
+	# path, reset to the text protocol and its start-up state.
+	#
+	# @param  duration  Seconds until the simulated Arduino is available again
+	# @return Thread which restarts the simulator
+	#
+	def drop(self, duration=1.0):
+		self.stop()
+		self.binaryMode = False
+		self.state = {}
+		with self.replyCondition:
+			self.replies = []
+
+		thread = threading.Timer(duration, self.start)
+		thread.daemon = True
+		thread.start()
+		return thread
+
+
+	##
+	# Queue a line to be sent back after the configured latency
+	#
+	# @param  line  The text line to be sent
+	#
+	def reply(self, line):
+		with self.replyCondition:
+			self.replyCount += 1
+			heapq.heappush(self.replies, (time.monotonic() + self.latency, self.replyCount, (line + "\r\n").encode()))
+			self.replyCondition.notify()
+
+
+	##
+	# Wait for the time it takes to transfer data at the configured baud rate
+	#
+	# @param  length  Number of bytes
+	#
+	def throttle(self, length):
+		if self.baud:
+			time.sleep(length * 10.0 / self.baud)
+
+
+	##
+	# Send queued replies and the periodic battery messages
+	#
+	def write_loop(self):
+		nextBattery = time.monotonic() + self.batteryPeriod
+		while self.running:
+			with self.replyCondition:
+				now = time.monotonic()
+				if self.batteryPeriod and now >= nextBattery:
+					nextBattery = now + self.batteryPeriod
+					self.batteryLevel = max(0, self.batteryLevel - 1)
+					self.replyCount += 1
+					heapq.heappush(self.replies, (now, self.replyCount, ("Battery_" + str(self.batteryLevel) + "\r\n").encode()))
+
+				if not self.replies or self.replies[0][0] > now:
+					wakeup = nextBattery if self.batteryPeriod else None
+					if self.replies:
+						wakeup = self.replies[0][0] if wakeup is None else min(wakeup, self.replies[0][0])
+					self.replyCondition.wait(None if wakeup is None else max(0, wakeup - now))
+					continue
+				data = heapq.heappop(self.replies)[2]
+
+			self.throttle(len(data))
+			try:
+				os.write(self.master, data)
+			except OSError:
+				pass
+
+
+	##
+	# Receive and evaluate the data sent to the simulated Arduino
+	#
+	def read_loop(self):
+		firstChar = None
+		serialBuffer = ""
+		decoder = FrameDecoder()
+
+		while self.running:
+			if not select.select([self.master], [], [], 0.1)[0]:
+				continue
+			try:
+				data = os.read(self.master, 4096)
+			except OSError:
+				continue
+			self.throttle(len(data))
+
+			if self.binaryMode:
+				self.evaluate_frames(decoder, data)
+				continue
+
+			for index, byte in enumerate(data):
+				char = chr(byte)
+				if char == '\n' or char == '\r':
+					if firstChar is not None:
+						self.evaluate_serial(firstChar, serialBuffer)
+					firstChar = None
+					serialBuffer = ""
+				else:
+					if firstChar is None:
+						firstChar = char
+					else:
+						serialBuffer += char
+
+					# To prevent overflows, evaluate the buffer if it is full
+					if 1 + len(serialBuffer) == MAX_SERIAL_LENGTH:
+						self.evaluate_serial(firstChar, serialBuffer)
+						firstChar = None
+						serialBuffer = ""
+
+				# The rest of the data is binary after switching protocol
+				if self.binaryMode:
+					self.evaluate_frames(decoder, data[index + 1:])
+					break
+
+
+	##
+	# Evaluate binary frames, in the same way as evaluateFrame()
+	#
+	# @param  decoder  FrameDecoder holding any incomplete frame
+	# @param  data     Bytes received
+	#
+	def evaluate_frames(self, decoder, data):
+		for frameType, commands in decoder.feed_frames(data):
+			self.reply("K" + str(frameType))
+			for command in commands:
+				self.evaluate_command(command)
+
+
+	##
+	# Evaluate a text command, in the same way as evaluateSerial()
+	#
+	# @param  firstChar     The command character
+	# @param  serialBuffer  The characters following the command character
+	#
+	def evaluate_serial(self, firstChar, serialBuffer):
+		number = atoi(serialBuffer)
+		self.reply(firstChar + str(number))
+		self.evaluate_command(firstChar + str(number))
+
+
+	##
+	# Update the simulated robot state with a command
+	#
+	# @param  command  The command string, for example "X-37"
+	#
+	def evaluate_command(self, command):
+		char, number = split_command(command)
+		self.received += 1
+		if self.recordCommands:
+			self.commands.append(command)
+
+		if char == 'P' and number in (0, 1):
+			self.binaryMode = (number == 1)
+			self.reply(PROTOCOL_REPLY + str(number))
+		elif char == 'M' and number in (0, 1):
+			self.state['autoMode'] = bool(number)
+		elif char in "XYSOA" or char in SERVO_ORDER:
+			self.state[char] = number
+		else:
+			self.state['lastKey'] = char
+
+
+##
+# Convert the start of a string to an integer, in the same way as atoi()
+#
+# @param  text  The string to be converted
+# @return The integer, or 0 if the string does not start with a number
+#
+def atoi(text):
+	text = text.strip()
+	end = 1 if text[:1] in ('-', '+') else 0
+	while end < len(text) and text[end].isdigit():
+		end += 1
+	try:
+		return int(text[:end])
+	except ValueError:
+		return 0
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Simulated Wall-E Arduino on a pseudo-terminal")
+	parser.add_argument("--latency", type=float, default=0.0, help="reply latency in milliseconds")
+	parser.add_argument("--baud", type=int, default=115200, help="baud rate to simulate, 0 for no limit")
+	parser.add_argument("--battery", type=float, default=10.0, help="seconds between battery messages, 0 to disable")
+	args = parser.parse_args()
+
+	simulator = ArduinoSimulator(args.latency / 1000.0, args.baud, args.battery)
+	print("Simulated Arduino on port:", simulator.start())
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		simulator.stop()
@@ -0,0 +1,209 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	async_server.py
+# @brief      	Serve the web-interface from a single asyncio event loop
+#
+# Used instead of the threaded Flask server when "serverMode" in app.py is
+# set to "async" (requires: sudo pip3 install aiohttp).
+#
+# All routes are still the Flask routes in app.py, with the same session
+# login. The control routes, which only queue commands or read the status,
+# are called directly on the event loop, and the WebSocket control channel
+# and the serial link (see AsyncSerialLink) run on the same loop. Routes
+# which can block (connecting the Arduino, starting the camera, rendering
+# pages, playing sounds, loading animations) run in a small thread pool instead of one thread
+# for every request. Static files are sent by aiohttp directly.
+#############################################
+
+import asyncio
+import concurrent.futures
+import io
+import os
+import sys
+from aiohttp import web, WSMsgType
+from itsdangerous import BadSignature
+
+
+# Routes which never block, so they are handled on the event loop itself
+INLINE_ROUTES = {'/motor', '/servoControl', '/arduinoStatus', '/cameraStatus', '/metrics'}
+
+
+##
+# Call a WSGI application and collect the complete response
+#
+# @param  application  The WSGI application (the Flask app)
+# @param  environ      The WSGI environment of the request
+# @return Tuple of (status code, list of headers, body)
+#
+def call_wsgi(application, environ):
+	response = {}
+	body = []
+
+	def start_response(status, headers, exc_info=None):
+		response['status'] = int(status.split(' ', 1)[0])
+		response['headers'] = headers
+		return body.append
+
+	result = application(environ, start_response)
+	try:
+		for chunk in result:
+			body.append(chunk)
+	finally:
+		if hasattr(result, 'close'):
+			result.close()
+	return response['status'], response['headers'], b''.join(body)
+
+
+##
+# Build the WSGI environment of an aiohttp request
+#
+# @param  request  The aiohttp request
+# @param  body     The complete request body
+#
+def wsgi_environ(request, body):
+	host, port = (request.transport.get_extra_info('sockname') or ('', 0))[:2]
+	environ = {
+		'REQUEST_METHOD': request.method,
+		'SCRIPT_NAME': '',
+		'PATH_INFO': request.path,
+		'QUERY_STRING': request.query_string,
+		'SERVER_NAME': str(host),
+		'SERVER_PORT': str(port),
+		'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+		'REMOTE_ADDR': request.remote or '',
+		'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+		'CONTENT_LENGTH': str(len(body)),
+		'wsgi.version': (1, 0),
+		'wsgi.url_scheme': request.scheme,
+		'wsgi.input': io.BytesIO(body),
+		'wsgi.errors': sys.stderr,
+		'wsgi.multithread': True,
+		'wsgi.multiprocess': False,
+		'wsgi.run_once': False
+	}
+	for name, value in request.headers.items():
+		key = 'HTTP_' + name.upper().replace('-', '_')
+		if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+			continue
+		environ[key] = environ[key] + ',' + value if key in environ else value
+	return environ
+
+
+##
+# aiohttp application serving the Flask routes of app.py
+#
+class AsyncServer:
+
+	##
+	# Constructor
+	#
+	# @param  webApp   The app.py module
+	# @param  workers  Number of threads for the routes which can block
+	#
+	def __init__(self, webApp, workers=4):
+		self.webApp = webApp
+		self.flask = webApp.app
+		self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="AsyncServerWorker")
+
+
+	##
+	# Create the aiohttp application
+	#
+	def create_app(self):
+		application = web.Application()
+		application.router.add_static('/static', os.path.join(self.flask.root_path, 'static'))
+		application.router.add_get('/control', self.control)
+		application.router.add_route('*', '/{tail:.*}', self.handle)
+		application.on_shutdown.append(self.shutdown)
+		return application
+
+
+	##
+	# Pass a request on to the Flask application
+	#
+	async def handle(self, request):
+		body = await request.read()
+		environ = wsgi_environ(request, body)
+
+		if request.path in INLINE_ROUTES:
+			status, headers, content = call_wsgi(self.flask, environ)
+		else:
+			loop = asyncio.get_running_loop()
+			status, headers, content = await loop.run_in_executor(self.executor, call_wsgi, self.flask, environ)
+
+		response = web.Response(status=status, body=content)
+		for name, value in headers:
+			if name.lower() != 'content-length':
+				response.headers.add(name, value)
+		return response
+
+
+	##
+	# Check the Flask session cookie of a request
+	#
+	# @return True if the user has logged in
+	#
+	def logged_in(self, request):
+		cookie = request.cookies.get(self.flask.config['SESSION_COOKIE_NAME'])
+		serializer = self.flask.session_interface.get_signing_serializer(self.flask)
+		if cookie is None or serializer is None:
+			return False
+		try:
+			data = serializer.loads(cookie, max_age=int(self.flask.permanent_session_lifetime.total_seconds()))
+		except BadSignature:
+			return False
+		return data.get('active') == True
+
+
+	##
+	# WebSocket control channel, the same as control() in app.py
+	#
+	async def control(self, request):
+		if not self.logged_in(request):
+			raise web.HTTPForbidden()
+
+		ws = web.WebSocketResponse(heartbeat=30)
+		await ws.prepare(request)
+
+		state = {}
+		while not ws.closed:
+			try:
+				message = await ws.receive(timeout=1)
+			except asyncio.TimeoutError:
+				message = None
+
+			if message is not None:
+				if message.type == WSMsgType.TEXT:
+					error = self.webApp.queue_control_message(message.data)
+					if error is not None:
+						await ws.send_json({'status': 'Error','msg':error})
+				elif message.type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED, WSMsgType.ERROR):
+					break
+
+			for update in self.webApp.control_updates(state):
+				await ws.send_str(update)
+		return ws
+
+
+	##
+	# Stop the Arduino link before the event loop closes
+	#
+	async def shutdown(self, application):
+		if self.webApp.arduinoActive:
+			loop = asyncio.get_running_loop()
+			await loop.run_in_executor(self.executor, self.webApp.onoff_arduino, self.webApp.workQueue, None)
+
+
+##
+# Run the web-interface on an asyncio event loop until it is interrupted
+#
+# @param  webApp  The app.py module
+# @param  host    Address to listen on
+# @param  port    Port to listen on
+#
+def run(webApp, host='0.0.0.0', port=5000):
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	webApp.serialLoop = loop
+	web.run_app(AsyncServer(webApp).create_app(), host=host, port=port, loop=loop)
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	broker_load.py
+# @brief      	Control throughput of the web-interface with several worker processes
+#
+# Starts serial_broker.py (connected to the Arduino simulator) and app.py
+# with 1, 2 and 4 worker processes sharing one listening socket (as
+# gunicorn does), all sending their commands through the broker. Several
+# client processes then send joystick and status requests, and the
+# requests per second and latency are reported for each number of workers
+# (requires: sudo pip3 install aiohttp):
+#
+#   python3 benchmarks/broker_load.py [--workers 1,2,4] [--clients 20] [--duration 10]
+#
+# Throughput can only scale up to the number of CPU cores, which are shared
+# by the workers, the broker and the client processes.
+#############################################
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from server_load import load
+
+
+##
+# Run the broker with the simulator connected; runs in a child process
+#
+# @param  path  Path of the Unix socket
+#
+def run_broker(path):
+	from arduino_simulator import ArduinoSimulator
+	from serial_broker import SerialBroker
+
+	simulator = ArduinoSimulator(batteryPeriod=1.0)
+	broker = SerialBroker(log=lambda *args: None)
+	broker.connect(simulator.start())
+	broker.serve(path)
+
+
+##
+# Run one web-interface worker on the shared listening socket; runs in a child process
+#
+# @param  listener  The listening socket
+# @param  path      Path of the broker's Unix socket
+#
+def run_worker(listener, path):
+	# Keep the per-request prints out of the measurement
+	devnull = os.open(os.devnull, os.O_WRONLY)
+	os.dup2(devnull, 1)
+	logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+	import app as webApp
+	from serial_broker import BrokerClient
+	from werkzeug.serving import make_server
+
+	# The same as setting "serialBroker" in app.py
+	webApp.broker = BrokerClient(path)
+	webApp.broker.subscribe(webApp.parseArduinoMessage, webApp.brokerLinkChanged)
+
+	server = make_server('127.0.0.1', listener.getsockname()[1], webApp.app, threaded=True, fd=listener.fileno())
+	server.serve_forever()
+
+
+##
+# Send requests from one client process and return the results through a pipe
+#
+def run_clients(port, password, clients, duration, brokerPid, pipe):
+	pipe.send(asyncio.run(load(port, password, clients, duration, brokerPid))[:2])
+
+
+##
+# Run the load test with a number of worker processes
+#
+# @return Dictionary of the results
+#
+def benchmark(context, workers, path, brokerPid, password, clients, clientProcesses, duration):
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(128)
+	port = listener.getsockname()[1]
+
+	servers = [context.Process(target=run_worker, args=(listener, path), daemon=True) for index in range(workers)]
+	for process in servers:
+		process.start()
+	listener.close()
+
+	try:
+		# Wait until the workers have imported app.py and answer requests
+		deadline = time.monotonic() + 30
+		while True:
+			try:
+				socket.create_connection(('127.0.0.1', port), timeout=1).close()
+				break
+			except OSError:
+				if time.monotonic() > deadline:
+					raise RuntimeError("Workers did not start")
+				time.sleep(0.2)
+		time.sleep(2.0)
+
+		pipes = []
+		clientsList = []
+		for index in range(clientProcesses):
+			receiver, sender = context.Pipe(duplex=False)
+			process = context.Process(target=run_clients,
+				args=(port, password, clients // clientProcesses, duration, brokerPid, sender), daemon=True)
+			process.start()
+			pipes.append(receiver)
+			clientsList.append(process)
+
+		start = time.perf_counter()
+		latencies = []
+		errors = 0
+		for receiver in pipes:
+			times, failed = receiver.recv()
+			latencies += times
+			errors += failed
+		elapsed = time.perf_counter() - start
+		for process in clientsList:
+			process.join()
+	finally:
+		# SDL (used by pygame for the sounds) catches SIGTERM
+		for process in servers:
+			process.kill()
+			process.join()
+
+	latencies.sort()
+	return {
+		'requests': len(latencies),
+		'errors': errors,
+		'rate': len(latencies) / elapsed,
+		'p50': statistics.median(latencies) * 1000,
+		'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Load test of the web-interface with several worker processes")
+	parser.add_argument("--workers", default="1,2,4", help="comma separated list of worker process counts")
+	parser.add_argument("--clients", type=int, default=20, help="number of concurrent clients")
+	parser.add_argument("--client-processes", type=int, default=2, help="number of processes sending the requests")
+	parser.add_argument("--duration", type=float, default=10.0, help="seconds to run each test for")
+	args = parser.parse_args()
+
+	# All workers must accept the login cookie of the session
+	os.environ.setdefault("SECRET_KEY", os.urandom(24).hex())
+	context = multiprocessing.get_context('fork')
+	path = os.path.join(tempfile.mkdtemp(), "walle-serial.sock")
+	brokerProcess = context.Process(target=run_broker, args=(path,), daemon=True)
+	brokerProcess.start()
+	while not os.path.exists(path):
+		time.sleep(0.05)
+
+	import app as webApp
+	password = webApp.loginPassword
+
+	print("%d CPU cores, %d concurrent clients, %gs per test" % (os.cpu_count(), args.clients, args.duration))
+	print("%-8s %9s %7s %8s %8s %8s" % ("workers", "requests", "errors", "req/s", "p50 ms", "p99 ms"))
+	try:
+		for workers in [int(count) for count in args.workers.split(",")]:
+			result = benchmark(context, workers, path, brokerProcess.pid, password, args.clients, args.client_processes, args.duration)
+			print("%-8d %9d %7d %8.0f %8.2f %8.2f" % (
+				workers, result['requests'], result['errors'], result['rate'], result['p50'], result['p99']))
+	finally:
+		brokerProcess.terminate()
+		brokerProcess.join()
+		shutil.rmtree(os.path.dirname(path), ignore_errors=True)
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	line_parser.py
+# @brief      	Micro-benchmark of the Arduino serial line parsing
+#
+# Compares the previous byte-by-byte parsing loop with the bulk LineParser,
+# using the command echoes and battery messages sent by the Arduino:
+#
+#   python3 benchmarks/line_parser.py [--lines 200000] [--chunk 64]
+#############################################
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from serial_link import LineParser
+
+
+##
+# Build a block of serial data, as echoed back by the Arduino
+#
+def make_input(lines):
+	messages = []
+	for i in range(lines):
+		if i % 100 == 99:
+			messages.append("Battery_" + str(i % 100))
+		else:
+			messages.append("XY"[i % 2] + str(i % 201 - 100))
+	return ("\r\n".join(messages) + "\r\n").encode()
+
+
+##
+# The byte-by-byte parsing loop used by app.py before the LineParser
+#
+def parse_bytewise(data, chunk):
+	lines = 0
+	stream = io.BytesIO(data)
+	dataString = ""
+	byte = stream.read(1)
+	while byte:
+		if (byte.decode() == '\n' or byte.decode() == '\r'):
+			if dataString:
+				lines += 1
+			dataString = ""
+		else:
+			dataString += byte.decode()
+		byte = stream.read(1)
+	return lines
+
+
+##
+# Parse the same data in blocks using the LineParser
+#
+def parse_bulk(data, chunk):
+	lines = 0
+	parser = LineParser()
+	stream = io.BytesIO(data)
+	block = stream.read(chunk)
+	while block:
+		lines += len(parser.feed(block))
+		block = stream.read(chunk)
+	return lines
+
+
+def run_benchmark(name, function, data, chunk):
+	start = time.perf_counter()
+	lines = function(data, chunk)
+	duration = time.perf_counter() - start
+	print("{:<14} {:9d} lines in {:6.3f} s = {:12,.0f} lines/s".format(name, lines, duration, lines / duration))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serial line parser benchmark")
+	parser.add_argument("--lines", type=int, default=200000, help="number of lines to parse")
+	parser.add_argument("--chunk", type=int, default=64, help="bytes returned by each serial read")
+	args = parser.parse_args()
+
+	data = make_input(args.lines)
+	run_benchmark("bytewise (old)", parse_bytewise, data, args.chunk)
+	run_benchmark("bulk", parse_bulk, data, args.chunk)
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	protocol_throughput.py
+# @brief      	Throughput comparison of the text and binary serial protocols
+#
+# Sends drive (X+Y) and multi-servo updates through a SerialLink over a
+# pseudo-terminal and decodes them on the other side, reporting the bytes
+# needed per update, the measured throughput and the maximum update rate
+# which fits through a 115200 baud link:
+#
+#   python3 benchmarks/protocol_throughput.py [--updates 20000]
+#############################################
+
+import argparse
+import os
+import queue
+import select
+import sys
+import threading
+import time
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from serial_link import SerialLink, LineParser
+from serial_protocol import TextProtocol, BinaryProtocol, FrameDecoder
+
+BAUD_RATE = 115200
+
+
+##
+# Build the list of updates to send; each update is a list of commands
+#
+def make_updates(kind, count):
+	updates = []
+	for i in range(count):
+		if kind == "drive":
+			updates.append(["X" + str(i % 201 - 100), "Y" + str(100 - i % 201)])
+		else:
+			updates.append([char + str((i + n) % 101) for n, char in enumerate("GTBUELR")])
+	return updates
+
+
+##
+# Send the updates over a pty and decode them on the other side
+#
+# @return Tuple of (bytes sent, seconds taken)
+#
+def run_protocol(protocol, updates):
+	master, slave = os.openpty()
+	ser = serial.Serial(os.ttyname(slave), BAUD_RATE)
+	os.close(slave)
+
+	q = queue.Queue()
+	link = SerialLink(ser, q, lambda message: None, log=lambda message: None)
+	link.protocol = protocol
+	thread = threading.Thread(target=link.run, daemon=True)
+	thread.start()
+
+	expected = sum(len(update) for update in updates)
+	decoder = FrameDecoder() if protocol.name == "binary" else LineParser()
+	received = 0
+	total = 0
+
+	start = time.perf_counter()
+	for update in updates:
+		for command in update:
+			q.put(command)
+
+		# Read back whatever has arrived so far, so the pty buffer never fills up
+		while select.select([master], [], [], 0)[0]:
+			data = os.read(master, 65536)
+			total += len(data)
+			received += len(decoder.feed(data))
+
+	while received < expected:
+		select.select([master], [], [])
+		data = os.read(master, 65536)
+		total += len(data)
+		received += len(decoder.feed(data))
+	duration = time.perf_counter() - start
+
+	link.stop()
+	thread.join()
+	ser.close()
+	os.close(master)
+	return total, duration
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serial protocol throughput benchmark")
+	parser.add_argument("--updates", type=int, default=20000, help="number of updates to send")
+	args = parser.parse_args()
+
+	for kind in ("drive", "servos"):
+		updates = make_updates(kind, args.updates)
+		for protocol in (TextProtocol(), BinaryProtocol()):
+			total, duration = run_protocol(protocol, updates)
+			perUpdate = total / len(updates)
+			# 10 bits are sent on the wire for every byte (start + 8 data + stop)
+			wireRate = BAUD_RATE / 10.0 / perUpdate
+			print("{:<7} {:<7} {:5.1f} bytes/update  {:9,.0f} updates/s over pty  {:6,.0f} updates/s max at {} baud".format(
+				kind, protocol.name, perUpdate, len(updates) / duration, wireRate, BAUD_RATE))
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	serial_latency.py
+# @brief      	Benchmark of command-to-wire latency and idle CPU usage
+#
+# Compares the event-driven SerialLink with the previous 10ms polling loop
+# over a pseudo-terminal, so it can be run on any Linux machine without an
+# Arduino connected:
+#
+#   python3 benchmarks/serial_latency.py [--commands 500] [--idle 5]
+#############################################
+
+import argparse
+import os
+import queue
+import select
+import statistics
+import sys
+import threading
+import time
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from serial_link import SerialLink
+
+
+##
+# The 10ms polling loop used by app.py before the SerialLink was introduced
+#
+class PollingLink:
+
+	def __init__(self, ser, q, onMessage, log=print):
+		self.ser = ser
+		self.q = q
+		self.onMessage = onMessage
+		self.log = log
+		self.running = False
+		self.lock = threading.Lock()
+
+	def run(self):
+		self.running = True
+		dataString = ""
+		while self.running:
+			self.lock.acquire()
+			if not self.q.empty():
+				data = self.q.get() + '\n'
+				self.lock.release()
+				self.ser.write(data.encode())
+				self.log(data)
+			else:
+				self.lock.release()
+
+			while (self.ser.inWaiting() > 0):
+				data = self.ser.read()
+				if (data.decode() == '\n' or data.decode() == '\r'):
+					self.onMessage(dataString)
+					dataString = ""
+				else:
+					dataString += data.decode()
+
+			time.sleep(0.01)
+
+	def stop(self):
+		self.running = False
+
+
+##
+# Start a link on a new pseudo-terminal
+#
+# @param  linkClass  Class of the link to be tested
+# @return Tuple of (link, thread, master file descriptor, queue, serial port)
+#
+def start_link(linkClass):
+	master, slave = os.openpty()
+	ser = serial.Serial(os.ttyname(slave), 115200)
+	os.close(slave)
+	q = queue.Queue()
+	link = linkClass(ser, q, lambda message: None, log=lambda message: None)
+	thread = threading.Thread(target=link.run, daemon=True)
+	thread.start()
+	time.sleep(0.1)
+	return link, thread, master, q, ser
+
+
+##
+# Measure the time from queueing a command until it can be read from the port
+#
+def measure_latency(master, q, commands):
+	latencies = []
+	for i in range(commands):
+		command = "X" + str(i % 100)
+		expected = len(command) + 1
+		start = time.perf_counter()
+		q.put(command)
+		received = 0
+		while received < expected:
+			select.select([master], [], [])
+			received += len(os.read(master, 64))
+		latencies.append((time.perf_counter() - start) * 1000.0)
+		time.sleep(0.002)
+	return latencies
+
+
+##
+# Measure the CPU time used by the process while the link is idle
+#
+def measure_idle_cpu(seconds):
+	startCpu = time.process_time()
+	startWall = time.perf_counter()
+	time.sleep(seconds)
+	return 100.0 * (time.process_time() - startCpu) / (time.perf_counter() - startWall)
+
+
+def run_benchmark(name, linkClass, commands, idle):
+	link, thread, master, q, ser = start_link(linkClass)
+	latencies = sorted(measure_latency(master, q, commands))
+	cpu = measure_idle_cpu(idle)
+	link.stop()
+	thread.join()
+	ser.close()
+	os.close(master)
+
+	p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+	print("{:<14} latency mean {:7.3f} ms  median {:7.3f} ms  p99 {:7.3f} ms  idle CPU {:5.2f} %".format(
+		name, statistics.mean(latencies), statistics.median(latencies), p99, cpu))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serial command latency benchmark")
+	parser.add_argument("--commands", type=int, default=500, help="number of commands to send")
+	parser.add_argument("--idle", type=float, default=5.0, help="seconds to measure idle CPU usage")
+	args = parser.parse_args()
+
+	run_benchmark("polling (old)", PollingLink, args.commands, args.idle)
+	run_benchmark("event-driven", SerialLink, args.commands, args.idle)
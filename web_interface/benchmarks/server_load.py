@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	server_load.py
+# @brief      	Load test of the threaded and the async web server modes
+#
+# Starts app.py in a child process (in each server mode, with the Arduino
+# simulator connected), logs in, and sends joystick and status requests
+# from many concurrent clients. Reports the requests per second, latency
+# percentiles, and the memory, threads and context switches of the server
+# process (requires: sudo pip3 install aiohttp):
+#
+#   python3 benchmarks/server_load.py [--clients 20] [--duration 10]
+#############################################
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+##
+# Run the web-interface in the given server mode; runs in the child process
+#
+# @param  mode  "threaded" or "async"
+# @param  port  Port to listen on
+# @param  pipe  Connection on which the login password is sent once the server is ready
+#
+def serve(mode, port, pipe):
+	# Keep the per-request prints out of the measurement
+	devnull = os.open(os.devnull, os.O_WRONLY)
+	os.dup2(devnull, 1)
+	logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+	import app as webApp
+	from arduino_simulator import ArduinoSimulator
+
+	webApp.simulator = ArduinoSimulator(batteryPeriod=1.0)
+	webApp.simulator.start()
+
+	if mode == "async":
+		from aiohttp import web
+		import async_server
+
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		webApp.serialLoop = loop
+		runner = web.AppRunner(async_server.AsyncServer(webApp).create_app(), access_log=None)
+		loop.run_until_complete(runner.setup())
+		loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+
+		def connect():
+			webApp.onoff_arduino(webApp.workQueue, "simulator")
+			pipe.send(webApp.loginPassword)
+		threading.Thread(target=connect).start()
+		loop.run_forever()
+	else:
+		from werkzeug.serving import make_server
+
+		server = make_server('127.0.0.1', port, webApp.app, threaded=True)
+		webApp.onoff_arduino(webApp.workQueue, "simulator")
+		pipe.send(webApp.loginPassword)
+		server.serve_forever()
+
+
+##
+# Read the memory, thread and context switch counters of a process
+#
+# @param  pid  Process ID
+# @return Dictionary of the counters
+#
+def process_stats(pid):
+	stats = {}
+	with open('/proc/%d/status' % pid) as f:
+		for line in f:
+			key, value = line.split(':', 1)
+			if key in ('VmRSS', 'Threads', 'voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches'):
+				stats[key] = int(value.split()[0])
+	return stats
+
+
+##
+# Send requests from concurrent clients for a fixed time
+#
+# @param  port      Port of the server
+# @param  password  Login password
+# @param  clients   Number of concurrent clients
+# @param  duration  Seconds to send requests for
+# @param  pid       Process ID of the server, for the thread count
+# @return Tuple of (latencies in seconds, number of errors, peak number of server threads)
+#
+async def load(port, password, clients, duration, pid):
+	url = "http://127.0.0.1:%d" % port
+	latencies = []
+	errors = 0
+	peakThreads = 0
+
+	connector = aiohttp.TCPConnector(limit=clients)
+	async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+		async with session.post(url + "/login_request", data={'password': password}, allow_redirects=False) as response:
+			await response.read()
+
+		deadline = time.perf_counter() + duration
+
+		async def client(number):
+			nonlocal errors
+			count = 0
+			while time.perf_counter() < deadline:
+				# Mostly joystick updates, with a status poll now and then
+				if count % 10 == 9:
+					path, data = "/arduinoStatus", {'type': 'battery'}
+				else:
+					path, data = "/motor", {'stickX': str((count % 200 - 100) / 100.0), 'stickY': str(number / 100.0)}
+				count += 1
+
+				start = time.perf_counter()
+				try:
+					async with session.post(url + path, data=data) as response:
+						result = await response.json()
+						if result.get('status') != 'OK':
+							errors += 1
+				except aiohttp.ClientError:
+					errors += 1
+					continue
+				latencies.append(time.perf_counter() - start)
+
+		async def monitor():
+			nonlocal peakThreads
+			while time.perf_counter() < deadline:
+				peakThreads = max(peakThreads, process_stats(pid)['Threads'])
+				await asyncio.sleep(0.2)
+
+		await asyncio.gather(monitor(), *[client(number) for number in range(clients)])
+	return latencies, errors, peakThreads
+
+
+##
+# Run the load test against one server mode
+#
+def benchmark(mode, port, clients, duration):
+	context = multiprocessing.get_context('fork')
+	receiver, sender = context.Pipe(duplex=False)
+	process = context.Process(target=serve, args=(mode, port, sender), daemon=True)
+	process.start()
+	try:
+		if not receiver.poll(30):
+			raise RuntimeError("Server did not start")
+		password = receiver.recv()
+
+		before = process_stats(process.pid)
+		start = time.perf_counter()
+		latencies, errors, peakThreads = asyncio.run(load(port, password, clients, duration, process.pid))
+		elapsed = time.perf_counter() - start
+		after = process_stats(process.pid)
+	finally:
+		# SDL (used by pygame for the sounds) catches SIGTERM
+		process.kill()
+		process.join()
+
+	latencies.sort()
+	return {
+		'requests': len(latencies),
+		'errors': errors,
+		'rate': len(latencies) / elapsed,
+		'p50': statistics.median(latencies) * 1000,
+		'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+		'rss': after['VmRSS'] / 1024.0,
+		'threads': peakThreads,
+		'switches': (after['voluntary_ctxt_switches'] + after['nonvoluntary_ctxt_switches']
+			- before['voluntary_ctxt_switches'] - before['nonvoluntary_ctxt_switches'])
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Load test of the web server modes")
+	parser.add_argument("--clients", type=int, default=20, help="number of concurrent clients")
+	parser.add_argument("--duration", type=float, default=10.0, help="seconds to run each test for")
+	parser.add_argument("--port", type=int, default=5090, help="first port to use for the test servers")
+	args = parser.parse_args()
+
+	print("%d concurrent clients, %gs per mode" % (args.clients, args.duration))
+	print("%-9s %9s %7s %8s %8s %8s %8s %10s" % ("mode", "requests", "errors", "req/s", "p50 ms", "p99 ms", "threads", "ctx sw"))
+	for index, mode in enumerate(("threaded", "async")):
+		result = benchmark(mode, args.port + index, args.clients, args.duration)
+		print("%-9s %9d %7d %8.0f %8.2f %8.2f %8d %10d    (RSS %.1f MB)" % (
+			mode, result['requests'], result['errors'], result['rate'], result['p50'],
+			result['p99'], result['threads'], result['switches'], result['rss']))
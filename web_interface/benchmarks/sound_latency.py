@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	sound_latency.py
+# @brief      	Benchmark of the time taken by the call starting a sound clip
+#
+# Compares loading each clip with pygame.mixer.music (as the web-interface
+# used to do) with playing preloaded clips from the SoundEngine. Only the
+# time until the mixer accepts the clip is measured, not the time until
+# the first sample is heard, which adds the audio buffer of the mixer.
+# Uses the SDL dummy audio driver, so no sound card is needed:
+#
+#   python3 benchmarks/sound_latency.py [--repeat 50]
+#############################################
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sound_catalog import SoundCatalog
+from sound_engine import SoundEngine
+
+SOUND_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "sounds")
+
+
+##
+# Time from the play request until the mixer reports the clip as playing
+#
+# The mixer reports the clip as playing as soon as it was accepted, so
+# this is the latency of the play call.
+#
+# @param  play  Function starting the clip
+# @param  busy  Function returning True once the clip is playing
+# @return Time in milliseconds
+#
+def play_call_latency(play, busy):
+	start = time.perf_counter()
+	play()
+	while not busy():
+		time.sleep(0.0001)
+	return (time.perf_counter() - start) * 1000.0
+
+
+def report(name, times):
+	times = sorted(times)
+	p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+	print("{:<20} mean {:7.3f} ms  median {:7.3f} ms  p99 {:7.3f} ms".format(
+		name, statistics.mean(times), statistics.median(times), p99))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Sound play call latency benchmark")
+	parser.add_argument("--repeat", type=int, default=50, help="number of clips to play")
+	parser.add_argument("--folder", default=SOUND_FOLDER, help="folder containing the .ogg files")
+	args = parser.parse_args()
+
+	pygame.mixer.init()
+	clips = [item[1] for item in SoundCatalog(args.folder).get()]
+	engine = SoundEngine(args.folder)
+
+	musicTimes = []
+	for i in range(args.repeat):
+		clip = os.path.join(args.folder, clips[i % len(clips)] + ".ogg")
+		def play():
+			pygame.mixer.music.load(clip)
+			pygame.mixer.music.set_volume(0.25)
+			pygame.mixer.music.play()
+		musicTimes.append(play_call_latency(play, pygame.mixer.music.get_busy))
+	pygame.mixer.music.stop()
+
+	start = time.perf_counter()
+	engine.preload(clips)
+	print("Preloaded {} clips ({:.1f} MB) in {:.0f} ms".format(
+		len(clips), engine.stats()['memoryUsed'] / 1e6, (time.perf_counter() - start) * 1000.0))
+
+	engineTimes = []
+	for i in range(args.repeat):
+		channel = []
+		clip = clips[i % len(clips)]
+		engineTimes.append(play_call_latency(
+			lambda: channel.append(engine.play(clip, 0.25)),
+			lambda: channel[0].get_busy()))
+
+	report("mixer.music (old)", musicTimes)
+	report("preloaded engine", engineTimes)
@@ -0,0 +1,401 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	command_queue.py
+# @brief      	Command store for messages waiting to be sent to the Arduino
+#############################################
+
+import collections 	# for the ordered list of pending commands
+import queue 		# for the queue.Empty exception
+import threading 	# for thread-safe access
+import time 		# for the time commands wait in the queue
+
+
+# Commands which set an absolute value; only the newest one matters
+COALESCED_CHANNELS = "XYLRBTGEUOS"
+
+# Commands accepted from the web-interface control channel, with their valid range
+CONTROL_RANGES = {
+	'X': (-100, 100), 'Y': (-100, 100),
+	'L': (0, 100), 'R': (0, 100), 'B': (0, 100), 'T': (0, 100),
+	'G': (0, 100), 'E': (0, 100), 'U': (0, 100),
+	'A': (0, 999)
+}
+
+# Priority classes of the commands, from the most to the least urgent
+PRIORITY_STOP = 0
+PRIORITY_DRIVE = 1
+PRIORITY_SERVO = 2
+PRIORITY_BULK = 3
+
+PRIORITY_NAMES = ("stop", "drive", "servo", "bulk")
+
+# Command which stops all movement
+STOP_COMMAND = "q"
+
+# Drive commands: motors, offsets and the keyboard driving commands
+DRIVE_CHANNELS = "XYSOwsad"
+
+# Servo commands: single servos and the keyboard head and arm poses
+SERVO_CHANNELS = "LRBTGEUjlikfghbnm"
+
+# Classes of the waiting commands which are cancelled by a stop command
+STOP_CANCELS = (PRIORITY_DRIVE, PRIORITY_SERVO, PRIORITY_BULK)
+
+# Seconds the commands of each class may wait to be sent before they are
+# dropped; a stop is always sent, however late
+COMMAND_TTL = (None, 0.5, 2.0, 10.0)
+
+# Deadline of the commands which must be sent, however long the link takes to start
+NO_DEADLINE = float("inf")
+
+# Settings commands (deadzone, steering offset, animation mode), which are
+# sent again when the Arduino was reset
+SETTINGS_CHANNELS = "OSM"
+
+
+##
+# Parse a compact control message received from the web-interface
+#
+# A message contains one or more Arduino commands separated by ';',
+# for example "X37;Y-50" or "L80", or the stop command "q".
+#
+# @param  message  The control message string
+# @return List of command strings, ready to be queued
+# @throws ValueError if any of the commands is invalid
+#
+def parse_control_message(message):
+	commands = []
+	for item in message.split(';'):
+		item = item.strip()
+		if not item:
+			continue
+		if item == STOP_COMMAND:
+			commands.append(item)
+			continue
+		limits = CONTROL_RANGES.get(item[0])
+		if limits is None:
+			raise ValueError("Unknown command: " + item)
+		try:
+			value = int(item[1:])
+		except ValueError:
+			raise ValueError("Invalid value: " + item)
+		if value < limits[0] or value > limits[1]:
+			raise ValueError("Value out of range: " + item)
+		commands.append(item[0] + str(value))
+	return commands
+
+
+##
+# Get the priority class of a command
+#
+# A stop command, or a drive motor set to zero ("X0", "Y0"), is a stop.
+# Animations ("A"), modes and all other commands are bulk commands.
+#
+# @param  command  The command string, or None to wake up the reader
+# @return One of the PRIORITY_* classes
+#
+def command_priority(command):
+	if command is None or command == STOP_COMMAND or command in ("X0", "Y0"):
+		return PRIORITY_STOP
+	if command[0] in DRIVE_CHANNELS:
+		return PRIORITY_DRIVE
+	if command[0] in SERVO_CHANNELS:
+		return PRIORITY_SERVO
+	return PRIORITY_BULK
+
+
+##
+# Priority scheduler for the commands waiting to be sent to the Arduino
+#
+# Each command is put in one of the priority classes (see command_priority)
+# and the reader always takes the oldest command of the most urgent class,
+# so a stop is sent before any drive update, servo movement or animation
+# which was queued earlier. A stop command also cancels the drive commands,
+# servo movements and animations which have not been sent yet, so they
+# cannot start moving the robot again after the stop.
+#
+# Commands for motors, servos and offsets (see COALESCED_CHANNELS) only keep
+# their newest value: if a command for the same channel is still waiting to
+# be sent, its value is replaced in place instead of adding a new entry. This
+# prevents stale joystick and slider positions from piling up when the serial
+# link stalls. A newer value of a more urgent class (such as "X0" replacing
+# "X50") moves the channel up to that class. All other commands are kept in
+# FIFO order within their class.
+#
+# The store is bounded: when maxSize commands are waiting, put() raises
+# queue.Full instead of accepting more work, so the web-interface can tell
+# the user that the Arduino is not keeping up. Stop commands and new values
+# of a waiting channel are always accepted. Every command also has a
+# deadline (see COMMAND_TTL); commands which are still waiting after their
+# deadline are dropped instead of being sent late.
+#
+# The class has the same put/get/empty interface as queue.Queue.
+#
+class CommandStore:
+
+	##
+	# Constructor
+	#
+	# @param  observer       Optional function called with every command added (for example a recorder)
+	# @param  waitHistogram  Optional metrics Histogram, observed with (seconds waited, class name)
+	# @param  maxSize        Maximum number of waiting commands, or None for no limit
+	# @param  ttl            Seconds each priority class may wait before it is dropped (None = no deadline)
+	#
+	def __init__(self, observer=None, waitHistogram=None, maxSize=64, ttl=COMMAND_TTL):
+		self.observer = observer
+		self.waitHistogram = waitHistogram
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.listeners = []
+		self.condition = threading.Condition()
+		self.pending = [collections.deque() for name in PRIORITY_NAMES]
+		self.latest = {}
+		self.received = 0
+		self.rejected = 0
+		self.coalesced = collections.Counter()
+		self.cancelled = collections.Counter()
+		self.expired = collections.Counter()
+
+
+	##
+	# Add a command to the store
+	#
+	# @param  command   The command string, for example "X-37"
+	# @param  deadline  time.monotonic() after which the command is dropped
+	#                   instead of sent; the deadline of its class if None
+	# @throws queue.Full if the store is full
+	# @throws ValueError if the command is empty
+	#
+	def put(self, command, deadline=None):
+		if command == "":
+			raise ValueError("Empty command")
+		priority = command_priority(command)
+		now = time.monotonic()
+		if deadline is None and self.ttl[priority] is not None:
+			deadline = now + self.ttl[priority]
+
+		with self.condition:
+			channel = command[0] if command else None
+			replaces = channel is not None and channel in COALESCED_CHANNELS and channel in self.latest
+
+			if not replaces and priority != PRIORITY_STOP and self.full(now):
+				self.rejected += 1
+				raise queue.Full
+
+			# None only wakes up the reader, so it is not counted
+			if command is not None:
+				self.received += 1
+			if command == STOP_COMMAND:
+				for cancelled in STOP_CANCELS:
+					self.cancel_class(cancelled)
+
+			added = True
+			if replaces:
+				# Replace the value of a command which has not been sent yet
+				oldCommand, oldPriority, queued, oldDeadline = self.latest[channel]
+				self.coalesced[channel] += 1
+				if oldPriority <= priority:
+					self.latest[channel] = (command, oldPriority, queued, deadline)
+					added = False
+				else:
+					self.pending[oldPriority].remove(channel)
+					self.latest[channel] = (command, priority, now, deadline)
+					self.pending[priority].append(channel)
+			elif channel is not None and channel in COALESCED_CHANNELS:
+				self.latest[channel] = (command, priority, now, deadline)
+				self.pending[priority].append(channel)
+			else:
+				self.pending[priority].append((command, now, deadline))
+
+			if added:
+				self.condition.notify()
+
+		if self.observer is not None and command is not None:
+			self.observer(command)
+		if added:
+			for listener in self.listeners:
+				listener()
+
+
+	##
+	# Check whether the store is full, after dropping the expired commands;
+	# called with the lock held
+	#
+	# @param  now  The current time.monotonic()
+	#
+	def full(self, now):
+		if self.maxSize is None or self.size() < self.maxSize:
+			return False
+		for priority, pending in enumerate(self.pending):
+			for item in list(pending):
+				deadline = self.entry(item)[2]
+				if deadline is not None and deadline < now:
+					pending.remove(item)
+					self.drop_expired(item, priority)
+		return self.size() >= self.maxSize
+
+
+	##
+	# Get the (command, queued time, deadline) of a waiting item; called with the lock held
+	#
+	def entry(self, item):
+		if isinstance(item, tuple):
+			return item
+		command, priority, queued, deadline = self.latest[item]
+		return command, queued, deadline
+
+
+	##
+	# Count an item which was removed after its deadline; called with the lock held
+	#
+	# @param  item      The item removed from its class
+	# @param  priority  Class of the item
+	#
+	def drop_expired(self, item, priority):
+		if not isinstance(item, tuple):
+			del self.latest[item]
+		self.expired[PRIORITY_NAMES[priority]] += 1
+
+
+	##
+	# Number of waiting commands; called with the lock held
+	#
+	def size(self):
+		return sum(len(pending) for pending in self.pending)
+
+
+	##
+	# Add a function which is called (without arguments) whenever a command is added
+	#
+	# Used to wake up consumers which do not block on get(), such as a
+	# writer running on an asyncio event loop.
+	#
+	# @param  listener  The function to be called
+	#
+	def add_listener(self, listener):
+		with self.condition:
+			self.listeners = self.listeners + [listener]
+
+
+	##
+	# Remove a function added with add_listener()
+	#
+	def remove_listener(self, listener):
+		with self.condition:
+			self.listeners = [item for item in self.listeners if item is not listener]
+
+
+	##
+	# Remove and return the next command, from the most urgent class
+	#
+	# Commands which have passed their deadline are dropped.
+	#
+	# @param  block    Wait until a command is available
+	# @param  timeout  Maximum time in seconds to wait, or None to wait forever
+	# @return The command string
+	# @throws queue.Empty if no command is available
+	#
+	def get(self, block=True, timeout=None):
+		endTime = None if timeout is None else time.monotonic() + timeout
+		with self.condition:
+			while True:
+				if block:
+					remaining = None if endTime is None else max(0, endTime - time.monotonic())
+					if not self.condition.wait_for(lambda: any(self.pending), remaining):
+						raise queue.Empty
+				elif not any(self.pending):
+					raise queue.Empty
+
+				for priority, pending in enumerate(self.pending):
+					if pending:
+						break
+				item = pending.popleft()
+				command, queued, deadline = self.entry(item)
+				now = time.monotonic()
+				if deadline is not None and deadline < now:
+					self.drop_expired(item, priority)
+					continue
+				if not isinstance(item, tuple):
+					del self.latest[item]
+				break
+
+		if self.waitHistogram is not None:
+			self.waitHistogram.observe(now - queued, PRIORITY_NAMES[priority])
+		return command
+
+
+	##
+	# Drop the waiting commands of a class; called with the lock held
+	#
+	# @param  priority  One of the PRIORITY_* classes
+	#
+	def cancel_class(self, priority):
+		pending = self.pending[priority]
+		for item in pending:
+			if not isinstance(item, tuple):
+				del self.latest[item]
+		self.cancelled[PRIORITY_NAMES[priority]] += len(pending)
+		pending.clear()
+
+
+	##
+	# Drop the commands which are waiting to be sent in some classes
+	#
+	# @param  priorities  List of PRIORITY_* classes to be cancelled
+	# @return Number of commands which were dropped
+	#
+	def cancel(self, priorities):
+		with self.condition:
+			count = sum(len(self.pending[priority]) for priority in priorities)
+			for priority in priorities:
+				self.cancel_class(priority)
+			return count
+
+
+	##
+	# Check whether there are no commands waiting
+	#
+	def empty(self):
+		with self.condition:
+			return not any(self.pending)
+
+
+	##
+	# Number of commands waiting to be sent
+	#
+	def qsize(self):
+		with self.condition:
+			return self.size()
+
+
+	##
+	# Remove all waiting commands
+	#
+	def clear(self):
+		with self.condition:
+			for pending in self.pending:
+				pending.clear()
+			self.latest.clear()
+
+
+	##
+	# Get the counters of the command store
+	#
+	# @return Dictionary with the queue depth and capacity, the number of
+	#         coalesced and rejected commands, and the waiting, cancelled
+	#         and expired commands of each priority class
+	#
+	def stats(self):
+		with self.condition:
+			return {
+				'pending': self.size(),
+				'capacity': self.maxSize,
+				'received': self.received,
+				'rejected': self.rejected,
+				'coalesced': sum(self.coalesced.values()),
+				'coalescedPerChannel': dict(self.coalesced),
+				'pendingPerClass': {name: len(pending) for name, pending in zip(PRIORITY_NAMES, self.pending)},
+				'cancelledPerClass': dict(self.cancelled),
+				'expiredPerClass': dict(self.expired)
+			}
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""Fake camera which writes synthetic JPEG frames into the streaming server.
+
+Used to run and measure streaming_server.py without a camera: the frames
+are written to the StreamingOutputs at the configured frame rate, with a
+sensor timestamp taken a simulated encoding time before each write, so the
+pipeline statistics (/stats.json) can be checked against known values:
+
+    python3 fake_camera.py [--framerate 30] [--frame-size 150000] [--encode-delay 0.015] [--stats-interval 5]
+"""
+
+import argparse
+import logging
+import time
+from threading import Event, Thread
+
+import streaming_server
+
+# Huffman table of the DC coefficients (JPEG standard luminance table)
+DC_BITS = bytes([0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0])
+DC_VALUES = bytes(range(12))
+DC_CODES = ['00', '010', '011', '100', '101', '110', '1110', '11110',
+            '111110', '1111110', '11111110', '111111110']
+
+def segment(marker, payload):
+    """A JPEG marker segment."""
+    return bytes([0xFF, marker]) + (len(payload) + 2).to_bytes(2, 'big') + payload
+
+def synthetic_jpeg(width, height, level=128, size=0, comment=b''):
+    """A valid baseline greyscale JPEG of a single grey level.
+
+    Every 8x8 block only has a DC coefficient, so the image data is tiny;
+    comment segments pad the file to size bytes, to give the frames the
+    size of real camera frames.
+    """
+    # DC value of the first block (the level shifted and scaled as by the DCT);
+    # all other blocks have the same value, so their difference is 0
+    value = (max(0, min(255, level)) - 128) * 8
+    category = abs(value).bit_length()
+    bits = DC_CODES[category]
+    if category:
+        bits += format(value if value > 0 else value + (1 << category) - 1, '0%db' % category)
+    # End of block: the only code of the AC table, '0'
+    blocks = ((width + 7) // 8) * ((height + 7) // 8)
+    bits += '0' + '000' * (blocks - 1)
+    bits += '1' * (-len(bits) % 8)
+    data = int(bits, 2).to_bytes(len(bits) // 8, 'big').replace(b'\xff', b'\xff\x00')
+
+    header = (segment(0xDB, bytes([0]) + bytes([1] * 64))
+              + segment(0xC0, bytes([8]) + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + bytes([1, 1, 0x11, 0]))
+              + segment(0xC4, bytes([0x00]) + DC_BITS + DC_VALUES)
+              + segment(0xC4, bytes([0x10, 1] + [0] * 15 + [0x00]))
+              + segment(0xDA, bytes([1, 1, 0x00, 0, 63, 0])))
+    comments = b''
+    padding = size - (len(header) + len(data) + 4 + len(comment) + 4)
+    if comment or padding > 0:
+        comments = segment(0xFE, comment + b' ' * max(0, min(padding, 65533 - len(comment))))
+        padding -= len(comments) - len(comment) - 4
+        while padding > 4:
+            chunk = min(padding - 4, 65533)
+            comments += segment(0xFE, b' ' * chunk)
+            padding -= chunk + 4
+    return b'\xff\xd8' + comments + header + data + b'\xff\xd9'
+
+class FakeCamera:
+    """Writes synthetic frames to the streaming outputs from a background thread."""
+
+    def __init__(self, outputs, framerate=30, frame_size=150000, encode_delay=0.015):
+        self.outputs = outputs
+        self.framerate = framerate
+        self.frame_size = frame_size
+        self.encode_delay = encode_delay
+        self.stop_event = Event()
+        self.thread = None
+        self.frames = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run, name='FakeCamera', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        full_pixels = streaming_server.PROFILES['full'][1][0] * streaming_server.PROFILES['full'][1][1]
+        next_frame = time.monotonic()
+        while not self.stop_event.is_set():
+            next_frame += 1 / self.framerate
+            if self.stop_event.wait(max(0, next_frame - time.monotonic())):
+                break
+            # The frame was exposed, then took encode_delay seconds to encode
+            sensor_time = streaming_server.sensor_clock()
+            time.sleep(self.encode_delay)
+            self.frames += 1
+            for name, output in self.outputs.items():
+                width, height = streaming_server.PROFILES[name][1]
+                size = self.frame_size * width * height // full_pixels
+                output.sensor_timestamp = int(sensor_time * 1000000)
+                output.write(synthetic_jpeg(width, height, self.frames % 256, size, b'frame %d' % self.frames))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming server with synthetic frames instead of the camera")
+    parser.add_argument("--port", type=int, default=8080, help="HTTP port")
+    parser.add_argument("--framerate", type=float, default=30, help="frames per second")
+    parser.add_argument("--frame-size", type=int, default=150000, help="bytes of each frame of the full stream")
+    parser.add_argument("--encode-delay", type=float, default=0.015, help="simulated seconds to encode a frame")
+    parser.add_argument("--stats-interval", type=float, help="log the pipeline statistics every STATS_INTERVAL seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name in streaming_server.PROFILES:
+        streaming_server.outputs[name] = streaming_server.StreamingOutput(name)
+    camera = FakeCamera(streaming_server.outputs, args.framerate, args.frame_size, args.encode_delay)
+    camera.start()
+    if args.stats_interval:
+        streaming_server.start_stats_log(args.stats_interval)
+    try:
+        streaming_server.StreamingServer(('0.0.0.0', args.port), streaming_server.StreamingHandler).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        camera.stop()
@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	latency_tracker.py
+# @brief      	Round-trip latency of the commands sent to the Arduino
+#
+# The Arduino echoes every text command back as <char><number>, and every
+# binary frame as K<type>. The tracker matches the echoes to the commands
+# which were sent, and records the time between sending a command and
+# receiving its echo for each type of command. Commands which are never
+# echoed are counted as lost once they are older than the timeout; a
+# background thread checks for them, so they are also counted while the
+# link is idle.
+#
+# Run on its own, it sends joystick commands at different rates and prints
+# a latency report:
+#
+#   python3 latency_tracker.py [--port /dev/ttyUSB0] [--rates 10,50,200]
+#
+# Without --port, the commands are sent to the Arduino simulator.
+#############################################
+
+import argparse
+import collections
+import threading
+import time
+import serial
+from serial_protocol import FrameDecoder, FRAME_COMMAND, FRAME_DRIVE, FRAME_SERVOS, split_command
+from serial_link import SerialLink
+from command_queue import CommandStore
+from arduino_simulator import ArduinoSimulator
+
+
+# Names of the binary frame types, used as the command type of their echo
+FRAME_NAMES = {FRAME_DRIVE: "drive", FRAME_SERVOS: "servos"}
+
+
+##
+# Matches the Arduino echoes to the commands which were sent
+#
+class RoundTripTracker:
+
+	##
+	# Constructor
+	#
+	# @param  timeout     Seconds after which a command without echo is counted as lost
+	# @param  samples     Number of round-trip times kept for each command type
+	# @param  maxPending  Maximum number of commands waiting for their echo
+	# @param  histogram   Optional metrics Histogram, observed with (seconds, type)
+	# @param  lostCounter Optional metrics counter, increased with (1, type)
+	#
+	def __init__(self, timeout=1.0, samples=1000, maxPending=1000, histogram=None, lostCounter=None):
+		self.timeout = timeout
+		self.samples = samples
+		self.maxPending = maxPending
+		self.histogram = histogram
+		self.lostCounter = lostCounter
+		self.lock = threading.Lock()
+		self.pending = collections.deque()
+		self.expected = collections.Counter()
+		self.types = {}
+		self.recentLost = collections.deque(maxlen=20)
+		self.closed = threading.Event()
+		threading.Thread(target=self.expire_pending, name="RoundTripTracker", daemon=True).start()
+
+
+	##
+	# Record commands which were just written to the serial port
+	#
+	# @param  protocol  Name of the protocol used ("text" or "binary")
+	# @param  commands  List of command strings
+	# @param  data      Bytes which were written
+	# @param  timestamp Time the data was written, the current time if None
+	#
+	def sent(self, protocol, commands, data, timestamp=None):
+		if timestamp is None:
+			timestamp = time.perf_counter()
+
+		if protocol == "binary":
+			echoes = []
+			for frameType, frameCommands in FrameDecoder().feed_frames(data):
+				if frameType == FRAME_COMMAND:
+					name = frameCommands[0][0]
+				else:
+					name = FRAME_NAMES.get(frameType, str(frameType))
+				echoes.append(("K" + str(frameType), name, ";".join(frameCommands)))
+		else:
+			echoes = []
+			for command in commands:
+				char, number = split_command(command)
+				echoes.append((char + str(number), char, command))
+
+		with self.lock:
+			for echo, name, command in echoes:
+				self.pending.append((echo, name, command, timestamp))
+				self.expected[echo] += 1
+				self.stats(name)['sent'] += 1
+			while len(self.pending) > self.maxPending:
+				self.lose(self.pending.popleft())
+
+
+	##
+	# Match a line received from the Arduino to the oldest command it echoes
+	#
+	# Lines which are not the echo of a pending command are ignored. Since
+	# the Arduino echoes the commands in order, commands sent before the
+	# matched one which are still pending were lost.
+	#
+	# @param  line       Line received from the Arduino
+	# @param  timestamp  Time the line was received, the current time if None
+	# @return Round-trip time in seconds, or None if the line is not an echo
+	#
+	def received(self, line, timestamp=None):
+		if timestamp is None:
+			timestamp = time.perf_counter()
+
+		with self.lock:
+			self.expire(timestamp)
+			if not self.expected[line]:
+				return None
+
+			while True:
+				entry = self.pending.popleft()
+				self.expected[entry[0]] -= 1
+				if entry[0] == line:
+					break
+				self.lose(entry)
+
+			echo, name, command, sentTime = entry
+			roundTrip = timestamp - sentTime
+			stats = self.stats(name)
+			stats['echoed'] += 1
+			stats['times'].append(roundTrip)
+
+		if self.histogram is not None:
+			self.histogram.observe(roundTrip, name)
+		return roundTrip
+
+
+	##
+	# Count the commands which have waited longer than the timeout as lost;
+	# called with the lock held
+	#
+	# @param  now  The current time
+	#
+	def expire(self, now):
+		while self.pending and now - self.pending[0][3] > self.timeout:
+			entry = self.pending.popleft()
+			self.expected[entry[0]] -= 1
+			self.lose(entry)
+
+
+	##
+	# Count the commands which timed out without an echo, until close() is called
+	#
+	def expire_pending(self):
+		while not self.closed.wait(self.timeout / 2.0):
+			with self.lock:
+				self.expire(time.perf_counter())
+
+
+	##
+	# Stop checking for the commands which timed out
+	#
+	def close(self):
+		self.closed.set()
+
+
+	##
+	# Count a command as lost; called with the lock held
+	#
+	def lose(self, entry):
+		echo, name, command, sentTime = entry
+		self.stats(name)['lost'] += 1
+		self.recentLost.append({'command': command, 'echo': echo, 'time': sentTime})
+		if self.lostCounter is not None:
+			self.lostCounter.inc(1, name)
+
+
+	##
+	# Get the statistics of a command type; called with the lock held
+	#
+	def stats(self, name):
+		if name not in self.types:
+			self.types[name] = {'sent': 0, 'echoed': 0, 'lost': 0, 'times': collections.deque(maxlen=self.samples)}
+		return self.types[name]
+
+
+	##
+	# Forget the commands waiting for an echo, for example after reconnecting
+	#
+	def clear_pending(self):
+		with self.lock:
+			self.pending.clear()
+			self.expected.clear()
+
+
+	##
+	# Forget all statistics
+	#
+	def reset(self):
+		with self.lock:
+			self.pending.clear()
+			self.expected.clear()
+			self.types = {}
+			self.recentLost.clear()
+
+
+	##
+	# Get the round-trip statistics of each command type
+	#
+	# @return Dictionary with the statistics per type (times in milliseconds),
+	#         the number of pending commands and the recently lost commands
+	#
+	def report(self):
+		with self.lock:
+			self.expire(time.perf_counter())
+			types = {}
+			for name, stats in sorted(self.types.items()):
+				types[name] = dict(summarise(stats['times']), sent=stats['sent'], echoed=stats['echoed'], lost=stats['lost'])
+			return {'types': types, 'pending': len(self.pending), 'lost': list(self.recentLost)}
+
+
+##
+# Summarise round-trip times
+#
+# @param  times  Round-trip times in seconds
+# @return Dictionary of the minimum, mean, percentiles and maximum in milliseconds
+#
+def summarise(times):
+	times = sorted(times)
+	if not times:
+		return {'min': None, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+
+	def percentile(p):
+		return round(times[min(len(times) - 1, int(p * len(times)))] * 1000.0, 3)
+
+	return {
+		'min': round(times[0] * 1000.0, 3),
+		'mean': round(sum(times) / len(times) * 1000.0, 3),
+		'p50': percentile(0.50),
+		'p95': percentile(0.95),
+		'p99': percentile(0.99),
+		'max': round(times[-1] * 1000.0, 3)
+	}
+
+
+##
+# Format a report as a text table
+#
+# @param  report  Dictionary returned by RoundTripTracker.report()
+# @param  title   Title printed above the table
+#
+def format_report(report, title=""):
+	lines = [title] if title else []
+	lines.append("%-8s %7s %7s %5s %8s %8s %8s %8s" % ("type", "sent", "echoed", "lost", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+	for name, stats in report['types'].items():
+		lines.append("%-8s %7d %7d %5d %8s %8s %8s %8s" % (
+			name, stats['sent'], stats['echoed'], stats['lost'],
+			stats['p50'], stats['p95'], stats['p99'], stats['max']))
+	return "\n".join(lines)
+
+
+##
+# Send joystick commands at a fixed rate and measure their round-trip times
+#
+# @param  port      Serial port of the Arduino
+# @param  rate      Commands per second
+# @param  duration  Seconds to send commands for
+# @param  binary    Use the binary protocol
+# @return The latency report
+#
+def measure(port, rate, duration, binary=False):
+	ser = serial.Serial(port, 115200)
+	ser.reset_input_buffer()
+	tracker = RoundTripTracker()
+	q = CommandStore()
+	link = SerialLink(ser, q, lambda line: None, log=lambda *args: None, binary=binary, tracker=tracker)
+	thread = threading.Thread(target=link.run, daemon=True)
+	thread.start()
+
+	# Give the link time to start (and to negotiate the protocol)
+	while not link.running and thread.is_alive():
+		time.sleep(0.01)
+
+	interval = 1.0 / rate
+	start = time.perf_counter()
+	count = 0
+	while time.perf_counter() - start < duration:
+		q.put("X" + str(count % 200 - 100) if count % 2 == 0 else "Y" + str(100 - count % 200))
+		count += 1
+		time.sleep(max(0, start + count * interval - time.perf_counter()))
+
+	# Wait for the last echoes
+	time.sleep(tracker.timeout)
+	link.stop()
+	thread.join()
+	ser.close()
+	tracker.close()
+	return tracker.report()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Measure the round-trip latency of commands sent to the Arduino")
+	parser.add_argument("--port", help="serial port of the Arduino; the simulator is used if not given")
+	parser.add_argument("--rates", default="10,50,200", help="comma separated list of command rates per second")
+	parser.add_argument("--duration", type=float, default=5.0, help="seconds to send commands at each rate")
+	parser.add_argument("--binary", action="store_true", help="use the binary protocol")
+	parser.add_argument("--latency", type=float, default=0.0, help="reply latency of the simulator in milliseconds")
+	args = parser.parse_args()
+
+	simulator = None
+	port = args.port
+	if port is None:
+		simulator = ArduinoSimulator(args.latency / 1000.0, batteryPeriod=0)
+		port = simulator.start()
+
+	try:
+		for rate in [float(rate) for rate in args.rates.split(",")]:
+			report = measure(port, rate, args.duration, args.binary)
+			print(format_report(report, "%g commands/s" % rate))
+			print()
+	finally:
+		if simulator is not None:
+			simulator.stop()
@@ -0,0 +1,201 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	link_supervisor.py
+# @brief      	Keeps the Arduino serial link up, reconnecting when it is lost
+#
+# When the link fails (for example the USB connection browns out and the
+# serial device disappears), the supervisor looks the port up again by its
+# stable identifier (see port_inventory.py), since the device may come back
+# under a different name, and reopens it. While the device is missing, the
+# port is looked up again every minDelay seconds, so the link is reopened
+# as soon as the device is back. Failed attempts to open a device which is
+# present are spaced with an exponential backoff, capped at maxDelay. The
+# time from losing the link to running it again is recorded for each
+# recovery.
+#############################################
+
+import threading
+import time
+
+
+##
+# Supervisor running the serial link on the Arduino thread
+#
+class LinkSupervisor:
+
+	##
+	# Constructor
+	#
+	# @param  resolve      Function returning the device path of a port identifier, or None if it is not present
+	# @param  onConnected  Optional function called with the SerialLink after it was (re)opened, before it runs
+	# @param  onLost       Optional function called with the exception when the link is lost
+	# @param  minDelay     Seconds before the first reconnection attempt
+	# @param  maxDelay     Maximum seconds between reconnection attempts
+	# @param  histogram    Optional metrics Histogram, observed with the seconds taken to recover
+	# @param  log          Function used to print the link events
+	#
+	def __init__(self, resolve, onConnected=None, onLost=None, minDelay=0.1, maxDelay=1.0, histogram=None, log=print):
+		self.resolve = resolve
+		self.onConnected = onConnected
+		self.onLost = onLost
+		self.minDelay = minDelay
+		self.maxDelay = maxDelay
+		self.histogram = histogram
+		self.log = log
+		self.stopEvent = threading.Event()
+		self.link = None
+		self.state = "stopped"
+		self.device = None
+		self.lostTime = None
+		self.lastError = None
+		self.attempts = 0
+		self.losses = 0
+		self.recoveries = 0
+		self.lastRecovery = None
+
+
+	##
+	# Keep the link to a port running until stop() is called
+	#
+	# Blocks the calling thread. The first connection is tried only once;
+	# the supervisor only reconnects a link which was running. Call reset()
+	# before starting the thread, if the supervisor was stopped before.
+	#
+	# @param  portId  Stable identifier of the serial port
+	# @param  open    Function opening a device path and returning the SerialLink to run
+	# @return The exception which prevented the first connection, or None
+	#
+	def run(self, portId, open):
+		delay = self.minDelay
+		firstConnection = True
+
+		while not self.stopEvent.is_set():
+			self.state = "connecting" if firstConnection else "reconnecting"
+			self.attempts += 1
+			try:
+				device = self.resolve(portId)
+				if device is None:
+					raise IOError("Serial port not found: " + str(portId))
+			except Exception as e:
+				if firstConnection:
+					self.state = "stopped"
+					return e
+				# Look for the device again soon, so the link is reopened as soon as it is back
+				self.lastError = str(e)
+				if self.stopEvent.wait(self.minDelay):
+					break
+				continue
+
+			try:
+				link = open(device)
+			except Exception as e:
+				if firstConnection:
+					self.state = "stopped"
+					return e
+				# The device is there but cannot be opened yet, so back off
+				self.lastError = str(e)
+				if self.stopEvent.wait(delay):
+					break
+				delay = min(delay * 2, self.maxDelay)
+				continue
+
+			self.link = link
+			self.device = device
+			if self.lostTime is not None:
+				self.recovered(time.monotonic() - self.lostTime)
+			firstConnection = False
+			delay = self.minDelay
+			self.state = "connected"
+			if self.onConnected is not None:
+				self.onConnected(link)
+
+			# Stop() may have been called while the port was being opened
+			if self.stopEvent.is_set():
+				link.stop()
+			try:
+				error = link.run()
+			except Exception as e:
+				error = e
+			try:
+				link.ser.close()
+			except Exception:
+				pass
+			self.link = None
+
+			if self.stopEvent.is_set():
+				break
+			# The link stopped by itself, so it was lost
+			self.lost(error)
+
+		self.state = "stopped"
+		self.lostTime = None
+		return None
+
+
+	##
+	# Record the loss of the link
+	#
+	# @param  error  The exception which stopped the link, or None
+	#
+	def lost(self, error):
+		self.losses += 1
+		self.lostTime = time.monotonic()
+		self.lastError = str(error) if error is not None else "Link stopped"
+		self.log("Arduino link lost:", self.lastError)
+		if self.onLost is not None:
+			self.onLost(error)
+
+
+	##
+	# Record a recovery
+	#
+	# @param  seconds  Time between losing the link and opening it again
+	#
+	def recovered(self, seconds):
+		self.recoveries += 1
+		self.lastRecovery = seconds
+		self.lostTime = None
+		self.log("Arduino link recovered on %s after %.3f s" % (self.device, seconds))
+		if self.histogram is not None:
+			self.histogram.observe(seconds)
+
+
+	##
+	# Stop the link and the reconnection attempts; can be called from any thread
+	#
+	def stop(self):
+		self.stopEvent.set()
+		link = self.link
+		if link is not None:
+			link.stop()
+
+
+	##
+	# Allow the link to be run again after stop() was called
+	#
+	def reset(self):
+		self.stopEvent.clear()
+
+
+	##
+	# Check whether the link has been lost and is being reopened
+	#
+	def reconnecting(self):
+		return self.state == "reconnecting"
+
+
+	##
+	# Get the state of the link and the recovery counters
+	#
+	def status(self):
+		return {
+			'state': self.state,
+			'device': self.device,
+			'lastError': self.lastError,
+			'downSeconds': None if self.lostTime is None else round(time.monotonic() - self.lostTime, 3),
+			'attempts': self.attempts,
+			'losses': self.losses,
+			'recoveries': self.recoveries,
+			'lastRecoverySeconds': None if self.lastRecovery is None else round(self.lastRecovery, 3)
+		}
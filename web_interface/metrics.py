@@ -0,0 +1,235 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	metrics.py
+# @brief      	Counters and histograms in the Prometheus text format
+#############################################
+
+import bisect
+import threading
+
+
+# Default histogram buckets in seconds, from 1ms to 10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+##
+# Format a set of labels, such as {route="/audio",method="POST"}
+#
+# @param  names   Names of the labels
+# @param  values  Values of the labels
+#
+def format_labels(names, values):
+	if not names:
+		return ""
+	pairs = []
+	for name, value in zip(names, values):
+		value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		pairs.append('%s="%s"' % (name, value))
+	return "{" + ",".join(pairs) + "}"
+
+
+##
+# Format a sample value
+#
+def format_value(value):
+	if value == float('inf'):
+		return "+Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value) if isinstance(value, float) else str(value)
+
+
+##
+# Counter or gauge, with one value for each combination of label values
+#
+class Metric:
+
+	##
+	# Constructor
+	#
+	# @param  name    Name of the metric
+	# @param  help    Description of the metric
+	# @param  type    "counter" or "gauge"
+	# @param  labels  Names of the labels
+	#
+	def __init__(self, name, help, type="counter", labels=()):
+		self.name = name
+		self.help = help
+		self.type = type
+		self.labels = tuple(labels)
+		self.lock = threading.Lock()
+		self.values = {}
+
+
+	##
+	# Increase the value
+	#
+	# @param  amount  Amount to add
+	# @param  labels  Values of the labels, in the order of the label names
+	#
+	def inc(self, amount=1, *labels):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+
+	##
+	# Set the value (for gauges)
+	#
+	# @param  value   The new value
+	# @param  labels  Values of the labels, in the order of the label names
+	#
+	def set(self, value, *labels):
+		with self.lock:
+			self.values[labels] = value
+
+
+	##
+	# Get the (label values, value) pairs of the metric
+	#
+	def samples(self):
+		with self.lock:
+			return list(self.values.items())
+
+
+	##
+	# Render the metric in the Prometheus text format
+	#
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+		for labels, value in sorted(self.samples(), key=lambda sample: [str(v) for v in sample[0]]):
+			lines.append(self.name + format_labels(self.labels, labels) + " " + format_value(value))
+		return lines
+
+
+##
+# Metric whose values are read from a function when the metrics are rendered
+#
+# Used for values which are already counted elsewhere, such as the queue
+# statistics, so the hot paths do not have to update a second counter.
+#
+class CallbackMetric(Metric):
+
+	##
+	# Constructor
+	#
+	# @param  name      Name of the metric
+	# @param  help      Description of the metric
+	# @param  function  Function returning a number, or a dictionary of {label values tuple: number}
+	# @param  type      "counter" or "gauge"
+	# @param  labels    Names of the labels
+	#
+	def __init__(self, name, help, function, type="gauge", labels=()):
+		Metric.__init__(self, name, help, type, labels)
+		self.function = function
+
+
+	def samples(self):
+		values = self.function()
+		if values is None:
+			return []
+		if isinstance(values, dict):
+			return list(values.items())
+		return [((), values)]
+
+
+##
+# Histogram counting observed values (such as request durations) in buckets
+#
+class Histogram(Metric):
+
+	##
+	# Constructor
+	#
+	# @param  name     Name of the metric
+	# @param  help     Description of the metric
+	# @param  labels   Names of the labels
+	# @param  buckets  Upper bounds of the buckets, in increasing order
+	#
+	def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		Metric.__init__(self, name, help, "histogram", labels)
+		self.buckets = tuple(buckets)
+
+
+	##
+	# Add an observed value
+	#
+	# @param  value   The observed value
+	# @param  labels  Values of the labels, in the order of the label names
+	#
+	def observe(self, value, *labels):
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			entry = self.values.get(labels)
+			if entry is None:
+				# Counts per bucket (plus +Inf), sum of the values
+				entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+			entry[0][index] += 1
+			entry[1] += value
+
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+		with self.lock:
+			samples = sorted((labels, list(counts), total) for labels, (counts, total) in self.values.items())
+
+		for labels, counts, total in samples:
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				lines.append(self.name + "_bucket" + format_labels(self.labels + ('le',), labels + (format_value(float(bound)),)) + " " + str(cumulative))
+			lines.append(self.name + "_sum" + format_labels(self.labels, labels) + " " + format_value(total))
+			lines.append(self.name + "_count" + format_labels(self.labels, labels) + " " + str(cumulative))
+		return lines
+
+
+##
+# Collection of metrics which are rendered together
+#
+class MetricsRegistry:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics = []
+
+
+	##
+	# Add a metric to the registry
+	#
+	# @param  metric  The Metric, CallbackMetric or Histogram object
+	# @return The metric
+	#
+	def add(self, metric):
+		with self.lock:
+			self.metrics.append(metric)
+		return metric
+
+
+	def counter(self, name, help, labels=()):
+		return self.add(Metric(name, help, "counter", labels))
+
+
+	def gauge(self, name, help, labels=()):
+		return self.add(Metric(name, help, "gauge", labels))
+
+
+	def callback(self, name, help, function, type="gauge", labels=()):
+		return self.add(CallbackMetric(name, help, function, type, labels))
+
+
+	def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		return self.add(Histogram(name, help, labels, buckets))
+
+
+	##
+	# Render all metrics in the Prometheus text format
+	#
+	def render(self):
+		with self.lock:
+			metrics = list(self.metrics)
+		lines = []
+		for metric in metrics:
+			lines += metric.render()
+		return "\n".join(lines) + "\n"
@@ -0,0 +1,127 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	port_inventory.py
+# @brief      	Cached list of the serial ports the Arduino could use
+#############################################
+
+import collections
+import os
+import threading
+import time
+import serial.tools.list_ports
+
+
+# A serial port with an identifier which does not change between enumerations
+Port = collections.namedtuple('Port', ['id', 'device', 'description'])
+
+
+##
+# Build a stable identifier for a serial port
+#
+# USB devices are identified by their vendor/product ID and serial number
+# (or their position on the USB bus), so the identifier stays the same
+# when other devices are plugged in or the device is renumbered.
+#
+# @param  info  ListPortInfo object from serial.tools.list_ports
+# @return The identifier string
+#
+def port_id(info):
+	if info.vid is not None and info.pid is not None:
+		return "usb:%04x:%04x:%s" % (info.vid, info.pid, info.serial_number or info.location or info.device)
+	return info.device
+
+
+##
+# Inventory of the available serial ports
+#
+# Enumerating the ports walks through sysfs, so the list is cached. It is
+# refreshed when a device node is added to or removed from /dev (which
+# happens when a USB device is plugged in or out), or when the cache is
+# older than the time-to-live.
+#
+class PortInventory:
+
+	##
+	# Constructor
+	#
+	# @param  ttl    Maximum age of the cached list in seconds
+	# @param  extra  Function returning a list of additional Port entries (for example a simulator)
+	#
+	def __init__(self, ttl=30.0, extra=None):
+		self.ttl = ttl
+		self.extra = extra
+		self.lock = threading.Lock()
+		self.cache = []
+		self.updated = None
+		self.devMtime = None
+		self.enumerations = 0
+
+
+	##
+	# Get the list of available serial ports
+	#
+	# @param  refresh  Enumerate the ports again, even if the cache is valid
+	# @return List of Port tuples
+	#
+	def ports(self, refresh=False):
+		with self.lock:
+			devMtime = dev_mtime()
+			if (refresh or self.updated is None or devMtime != self.devMtime
+					or time.monotonic() - self.updated > self.ttl):
+				self.cache = [
+					Port(port_id(p), p.device, p.description)
+					for p in serial.tools.list_ports.comports()
+				]
+				self.updated = time.monotonic()
+				self.devMtime = devMtime
+				self.enumerations += 1
+			ports = list(self.cache)
+
+		if self.extra is not None:
+			ports += self.extra()
+		return ports
+
+
+	##
+	# Find a port by its identifier
+	#
+	# If the port is not in the cached list (for example because it was
+	# just plugged in), the ports are enumerated once more.
+	#
+	# @param  portId  The identifier of the port
+	# @return The Port tuple, or None if it is not available
+	#
+	def find(self, portId):
+		for port in self.ports():
+			if port.id == portId:
+				return port
+		for port in self.ports(refresh=True):
+			if port.id == portId:
+				return port
+		return None
+
+
+	##
+	# Get the identifier of the preferred port
+	#
+	# @param  name  Text which the description of the preferred port contains
+	# @return Identifier of the last matching port, or of the first port if none match
+	#
+	def preferred(self, name):
+		ports = self.ports()
+		selected = ports[0].id if ports else None
+		for port in ports:
+			if name in port.description:
+				selected = port.id
+		return selected
+
+
+##
+# Modification time of /dev, which changes when device nodes are added or removed
+#
+def dev_mtime():
+	try:
+		return os.stat('/dev').st_mtime_ns
+	except OSError:
+		return None
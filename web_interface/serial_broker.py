@@ -0,0 +1,584 @@
+#!/usr/bin/python3
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	serial_broker.py
+# @brief      	Process owning the Arduino serial link, shared over a Unix socket
+#
+# The serial port can only be opened by one process, so normally app.py has
+# to run as a single process. The broker owns the serial link and the
+# command queue instead, and every web-interface process talks to it over a
+# local Unix socket. The web-interface can then run with several worker
+# processes (set "serialBroker" in app.py):
+#
+#   python3 serial_broker.py [--socket /tmp/walle-serial.sock] [--port /dev/ttyUSB0] [--binary] [--simulator]
+#   gunicorn -w 4 -b 0.0.0.0:5000 app:app
+#
+# Each request and reply is one line of JSON:
+#
+#   {"op": "send", "commands": ["X37", "Y-50"]}   queue commands for the Arduino
+#   {"op": "status"}                               link status, battery and queue counters
+#   {"op": "connect", "device": "/dev/ttyUSB0",   open the serial port; the optional
+#    "port": "usb:2341:0043:..."}                 stable port id is used to find it again
+#   {"op": "disconnect"}                           close the serial port
+#   {"op": "subscribe"}                            stream the Arduino messages and link changes
+#
+# Replies contain "status": "OK" or "status": "Error" with a "msg", the
+# same as the routes of the web-interface. After subscribing, the broker
+# sends {"message": line} for every line received from the Arduino and
+# {"link": {...}} whenever the link is connected or disconnected.
+#
+# When the link is lost (for example the USB connection browns out), the
+# broker reconnects it the same way as app.py does (see link_supervisor.py).
+#############################################
+
+import argparse
+import json
+import os
+import queue 		# for the subscriber queues and the queue.Full exception
+import socket
+import socketserver
+import threading
+import time
+import serial
+from command_queue import CommandStore, NO_DEADLINE, SETTINGS_CHANNELS
+from serial_link import SerialLink
+from port_inventory import PortInventory
+from link_supervisor import LinkSupervisor
+
+
+DEFAULT_SOCKET = "/tmp/walle-serial.sock"
+
+
+##
+# Owner of the serial link, serving the web-interface processes
+#
+class SerialBroker:
+
+	##
+	# Constructor
+	#
+	# @param  binary      Try to switch the Arduino to the binary protocol
+	# @param  queueSize   Maximum number of commands waiting to be sent
+	# @param  log         Function used to print the link events
+	# @param  extraPorts  Function returning additional Port entries (for example a simulator)
+	#
+	def __init__(self, binary=False, queueSize=64, log=print, extraPorts=None):
+		self.binary = binary
+		self.log = log
+		self.q = CommandStore(maxSize=queueSize)
+		self.inventory = PortInventory(extra=extraPorts)
+		self.supervisor = LinkSupervisor(self.resolve, onConnected=self.link_connected, onLost=self.link_lost, log=log)
+		self.lock = threading.Lock()
+		self.started = threading.Event()
+		self.link = None
+		self.thread = None
+		self.portId = None
+		self.device = None
+		self.error = None
+		self.battery = None
+		# Last settings command of each channel, sent again when the link is reopened
+		self.settings = {}
+		self.subscribers = []
+		self.server = None
+
+
+	##
+	# Open the serial port and keep the link running until disconnect() is called
+	#
+	# @param  device  Path of the serial port
+	# @param  portId  Stable identifier of the port (see port_inventory.py), used to
+	#                 find the port again after it was lost; the device path if None
+	# @param  timeout Seconds to wait for the port to be opened
+	# @return Error message, or None if the link was started
+	#
+	def connect(self, device, portId=None, timeout=5.0):
+		if not isinstance(device, str) or not device or not isinstance(portId, (str, type(None))):
+			return 'No serial port given'
+		portId = portId or device
+
+		with self.lock:
+			if self.thread is not None and self.thread.is_alive():
+				return None if portId == self.portId else 'Arduino already connected to ' + str(self.device)
+
+			self.q.clear()
+			self.portId = portId
+			self.device = device
+			self.error = None
+			self.started.clear()
+			self.supervisor.reset()
+			self.thread = threading.Thread(target=self.run, args=(portId,), name="BrokerLink", daemon=True)
+			self.thread.start()
+
+			# The first connection is opened on the link thread
+			self.started.wait(timeout)
+			if not self.connected():
+				return self.error or 'Unable to connect to ' + device
+		return None
+
+
+	##
+	# Find the device path of a port
+	#
+	# @param  portId  Stable identifier or device path of the port
+	# @return The device path, or None if the port is not present
+	#
+	def resolve(self, portId):
+		port = self.inventory.find(portId)
+		if port is not None:
+			return port.device
+		return portId if os.path.exists(portId) else None
+
+
+	##
+	# Open the serial port and create the link; called by the supervisor
+	#
+	# @param  device  Path of the serial port
+	# @return The SerialLink
+	#
+	def open(self, device):
+		ser = serial.Serial(device, 115200)
+		ser.reset_input_buffer()
+		return SerialLink(ser, self.q, self.received, log=lambda *args: None, binary=self.binary)
+
+
+	##
+	# Run the link under the supervisor until it is disconnected, then tell the subscribers
+	#
+	def run(self, portId):
+		error = self.supervisor.run(portId, self.open)
+		if error is not None:
+			self.error = str(error)
+			self.log("Unable to connect to", portId, error)
+		self.link = None
+		self.started.set()
+		# This thread is still alive, so the link cannot report itself as stopped yet
+		self.publish({'link': dict(self.link_status(), connected=False)})
+
+
+	##
+	# Called by the supervisor when the link was (re)opened
+	#
+	# The Arduino resets when its port is opened, so the settings are sent
+	# again, without a deadline since the link may take a while to start.
+	#
+	def link_connected(self, link):
+		self.link = link
+		self.device = self.supervisor.device
+		self.error = None
+		for command in self.settings.values():
+			try:
+				self.q.put(command, NO_DEADLINE)
+			except queue.Full:
+				pass
+		self.log("Connected to", self.device)
+		self.started.set()
+		self.publish({'link': self.link_status()})
+
+
+	##
+	# Called by the supervisor when the link was lost
+	#
+	def link_lost(self, error):
+		self.link = None
+		self.battery = None
+		self.error = str(error) if error is not None else 'Link stopped'
+		# Do not send movements which were queued for the old link
+		self.q.clear()
+		# The supervisor reopens the link after this returns
+		self.publish({'link': dict(self.link_status(), connected=False, reconnecting=True)})
+
+
+	##
+	# Stop the link and close the serial port
+	#
+	def disconnect(self):
+		with self.lock:
+			thread = self.thread
+			self.supervisor.stop()
+			if thread is not None:
+				thread.join()
+			self.link = None
+			self.thread = None
+			self.battery = None
+			self.q.clear()
+		if thread is not None:
+			self.log("Disconnected from", self.device)
+
+
+	##
+	# Check whether the link is running
+	#
+	def connected(self):
+		return self.supervisor.state == "connected" and self.link is not None
+
+
+	##
+	# Queue commands for the Arduino
+	#
+	# @param  commands  List of command strings
+	# @return Error message if a command is invalid, the Arduino is not connected
+	#         or the queue is full, or None
+	#
+	def send(self, commands):
+		if not isinstance(commands, list) or not all(isinstance(command, str) and command for command in commands):
+			return 'Invalid command'
+		if self.supervisor.reconnecting():
+			return 'Arduino link lost; reconnecting'
+		if not self.connected():
+			return 'Arduino not connected'
+		try:
+			for command in commands:
+				self.q.put(command)
+				if command[0] in SETTINGS_CHANNELS:
+					self.settings[command[0]] = command
+		except queue.Full:
+			return 'Command queue full; the Arduino is not keeping up'
+		return None
+
+
+	##
+	# Handle a line received from the Arduino
+	#
+	def received(self, line):
+		if line.startswith("Battery"):
+			try:
+				self.battery = int(line[line.find('_') + 1:])
+			except ValueError:
+				pass
+		self.publish({'message': line})
+
+
+	##
+	# Get the state of the link
+	#
+	def link_status(self):
+		return {'connected': self.connected(), 'reconnecting': self.supervisor.reconnecting(),
+			'device': self.device, 'error': self.error}
+
+
+	##
+	# Get the status of the link, the battery and the command queue
+	#
+	def status(self):
+		link = self.link
+		return dict(self.link_status(), battery=self.battery, queue=self.q.stats(),
+			link=link.stats() if link is not None else None, supervisor=self.supervisor.status(),
+			subscribers=len(self.subscribers))
+
+
+	##
+	# Send an event to all subscribers
+	#
+	# Each subscriber has a bounded queue, so a stuck subscriber loses
+	# events instead of slowing down the serial link.
+	#
+	def publish(self, event):
+		for subscriber in self.subscribers:
+			try:
+				subscriber.put_nowait(event)
+			except queue.Full:
+				pass
+
+
+	##
+	# Add a subscriber queue
+	#
+	def subscribe(self):
+		subscriber = queue.Queue(maxsize=256)
+		with self.lock:
+			self.subscribers = self.subscribers + [subscriber]
+		return subscriber
+
+
+	##
+	# Remove a subscriber queue
+	#
+	def unsubscribe(self, subscriber):
+		with self.lock:
+			self.subscribers = [item for item in self.subscribers if item is not subscriber]
+
+
+	##
+	# Handle one request
+	#
+	# @param  request  Dictionary decoded from the request line
+	# @return Dictionary to be sent as the reply
+	#
+	def handle(self, request):
+		op = request.get('op')
+		if op == "send":
+			error = self.send(request.get('commands') or [])
+		elif op == "status":
+			return dict(self.status(), status='OK')
+		elif op == "connect":
+			error = self.connect(request.get('device'), request.get('port'))
+		elif op == "disconnect":
+			self.disconnect()
+			error = None
+		else:
+			error = 'Unknown operation: ' + str(op)
+
+		if error is not None:
+			return {'status': 'Error', 'msg': error}
+		return {'status': 'OK'}
+
+
+	##
+	# Serve the Unix socket until shutdown() is called
+	#
+	# @param  path  Path of the Unix socket
+	#
+	def serve(self, path=DEFAULT_SOCKET):
+		if os.path.exists(path):
+			os.unlink(path)
+		self.server = BrokerServer(path, self)
+		self.log("Serial broker listening on", path)
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			os.unlink(path)
+			self.disconnect()
+
+
+	##
+	# Stop serving the socket
+	#
+	def shutdown(self):
+		if self.server is not None:
+			self.server.shutdown()
+
+
+##
+# Handler for one client connection, which can send any number of requests
+#
+class BrokerHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		broker = self.server.broker
+		for line in self.rfile:
+			try:
+				request = json.loads(line)
+			except ValueError:
+				self.reply({'status': 'Error', 'msg': 'Invalid request'})
+				continue
+
+			if not isinstance(request, dict):
+				self.reply({'status': 'Error', 'msg': 'Invalid request'})
+				continue
+			if request.get('op') == "subscribe":
+				self.stream(broker)
+				return
+			try:
+				reply = broker.handle(request)
+			except Exception as e:
+				reply = {'status': 'Error', 'msg': str(e)}
+			self.reply(reply)
+
+
+	##
+	# Write a reply line
+	#
+	def reply(self, data):
+		self.wfile.write(json.dumps(data).encode() + b'\n')
+
+
+	##
+	# Send the events to a subscriber until it disconnects
+	#
+	def stream(self, broker):
+		subscriber = broker.subscribe()
+		try:
+			self.reply({'status': 'OK', 'link': broker.link_status()})
+			while True:
+				try:
+					self.reply(subscriber.get(timeout=10))
+				except queue.Empty:
+					# Keep-alive, which also notices clients which have gone away
+					self.reply({})
+		except OSError:
+			pass
+		finally:
+			broker.unsubscribe(subscriber)
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path, broker):
+		self.broker = broker
+		socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+
+
+##
+# Client of the broker, used by each web-interface process
+#
+# Connections are kept open and reused, one for each request in progress,
+# so a request costs a single round trip over the socket.
+#
+class BrokerClient:
+
+	##
+	# Constructor
+	#
+	# @param  path     Path of the broker's Unix socket
+	# @param  timeout  Seconds to wait for a reply
+	#
+	def __init__(self, path=DEFAULT_SOCKET, timeout=2.0):
+		self.path = path
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.idle = []
+
+
+	##
+	# Send a request to the broker
+	#
+	# @param  op    Name of the operation
+	# @param  args  Fields of the request
+	# @return Dictionary of the reply; an Error reply if the broker cannot be reached
+	#
+	def request(self, op, **args):
+		data = json.dumps(dict(args, op=op)).encode() + b'\n'
+		# An idle connection may have been closed by a restarted broker, so try a new one once
+		for attempt in range(2):
+			with self.lock:
+				connection = self.idle.pop() if self.idle else None
+			try:
+				if connection is None:
+					connection = self.open()
+				sock, reader = connection
+				sock.sendall(data)
+				line = reader.readline()
+				if not line:
+					raise OSError("Connection closed by the broker")
+				reply = json.loads(line)
+			except (OSError, ValueError) as e:
+				if connection is not None:
+					connection[0].close()
+				error = e
+				continue
+			with self.lock:
+				self.idle.append(connection)
+			return reply
+		return {'status': 'Error', 'msg': 'Serial broker not available: ' + str(error)}
+
+
+	##
+	# Open a connection to the broker
+	#
+	def open(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(self.timeout)
+		sock.connect(self.path)
+		return sock, sock.makefile('rb')
+
+
+	##
+	# Queue commands for the Arduino
+	#
+	# @param  commands  List of command strings
+	# @return Error message, or None if the commands were queued
+	#
+	def send(self, commands):
+		reply = self.request("send", commands=commands)
+		return reply.get('msg') if reply.get('status') != 'OK' else None
+
+
+	##
+	# Get the status of the link, the battery and the command queue
+	#
+	def status(self):
+		return self.request("status")
+
+
+	##
+	# Ask the broker to open a serial port
+	#
+	# @param  device  Path of the serial port
+	# @param  portId  Stable identifier of the port, to find it again after it was lost
+	# @return Error message, or None if the link was started
+	#
+	def connect(self, device, portId=None):
+		reply = self.request("connect", device=device, port=portId)
+		return reply.get('msg') if reply.get('status') != 'OK' else None
+
+
+	##
+	# Ask the broker to close the serial port
+	#
+	def disconnect(self):
+		self.request("disconnect")
+
+
+	##
+	# Receive the Arduino messages and link changes on a background thread
+	#
+	# The subscription is opened again if the broker restarts.
+	#
+	# @param  onMessage  Function called with every line received from the Arduino
+	# @param  onLink     Function called with the link status dictionary when it changes
+	#
+	def subscribe(self, onMessage, onLink):
+		thread = threading.Thread(target=self.listen, args=(onMessage, onLink), name="BrokerSubscriber", daemon=True)
+		thread.start()
+		return thread
+
+
+	##
+	# Read the subscription stream, reconnecting when it is lost
+	#
+	def listen(self, onMessage, onLink):
+		while True:
+			try:
+				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				sock.connect(self.path)
+				sock.sendall(b'{"op": "subscribe"}\n')
+				for line in sock.makefile('rb'):
+					event = json.loads(line)
+					if 'message' in event:
+						onMessage(event['message'])
+					elif 'link' in event:
+						onLink(event['link'])
+			except (OSError, ValueError):
+				pass
+			finally:
+				sock.close()
+			onLink({'connected': False, 'device': None, 'error': 'Serial broker not available'})
+			time.sleep(1.0)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Share the Arduino serial link between web-interface processes")
+	parser.add_argument("--socket", default=DEFAULT_SOCKET, help="path of the Unix socket")
+	parser.add_argument("--port", help="serial port of the Arduino to connect to at start-up")
+	parser.add_argument("--binary", action="store_true", help="use the binary protocol if the Arduino supports it")
+	parser.add_argument("--queue-size", type=int, default=64, help="maximum number of commands waiting to be sent")
+	parser.add_argument("--simulator", action="store_true", help="connect to a simulated Arduino")
+	args = parser.parse_args()
+
+	simulator = None
+	extraPorts = None
+	port = args.port
+	if args.simulator:
+		from arduino_simulator import ArduinoSimulator, SIMULATOR_DESCRIPTION
+		from port_inventory import Port
+		simulator = ArduinoSimulator()
+		port = simulator.start()
+		# The simulated port keeps its identifier when simulator.drop() reopens it under a new name
+		extraPorts = lambda: [Port("simulator", simulator.port, SIMULATOR_DESCRIPTION)] if simulator.port else []
+
+	broker = SerialBroker(args.binary, args.queue_size, extraPorts=extraPorts)
+	if port is not None:
+		error = broker.connect(port, "simulator" if simulator is not None else None)
+		if error is not None:
+			print("Unable to connect to", port, error)
+
+	try:
+		broker.serve(args.socket)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if simulator is not None:
+			simulator.stop()
@@ -0,0 +1,427 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	serial_link.py
+# @brief      	Event-driven serial communication with the Arduino
+#############################################
+
+import asyncio 		# for the event loop version of the link
+import collections 	# for counting the commands sent
+import queue 		# for the queue.Empty exception
+import threading 	# for the reader/writer threads
+import time
+from serial_protocol import TextProtocol, BinaryProtocol, PROTOCOL_REPLY, command_frame
+
+
+##
+# Incremental parser splitting the serial input into lines
+#
+# Bytes are collected in a bytearray and only complete lines (ended by
+# '\n' or '\r') are decoded, so a whole block of received data can be
+# processed in one call instead of one byte at a time.
+#
+class LineParser:
+
+	##
+	# Constructor
+	#
+	# @param  maxLength  Maximum line length; longer lines are discarded
+	#
+	def __init__(self, maxLength=256):
+		self.buffer = bytearray()
+		self.maxLength = maxLength
+		self.overflows = 0
+
+
+	##
+	# Add received bytes to the parser
+	#
+	# @param  data  Bytes read from the serial port
+	# @return List of the complete lines which were received
+	#
+	def feed(self, data):
+		self.buffer += data
+		end = max(self.buffer.rfind(b'\n'), self.buffer.rfind(b'\r'))
+
+		# No complete line yet; make sure the buffer cannot grow forever
+		if end < 0:
+			if len(self.buffer) > self.maxLength:
+				self.buffer.clear()
+				self.overflows += 1
+			return []
+
+		block = self.buffer[:end].replace(b'\r', b'\n')
+		del self.buffer[:end + 1]
+		return [line.decode(errors='replace') for line in block.split(b'\n') if line]
+
+
+##
+# Event-driven link between the command queue and the Arduino serial port
+#
+# Instead of polling the queue and the serial port every few milliseconds,
+# the link uses two blocking threads: the writer sleeps on the command queue
+# and sends each command as soon as it is queued, while the reader sleeps
+# inside the serial read (select on the port) and only wakes up when bytes
+# arrive, reading all waiting bytes at once. Stopping the link wakes both
+# threads up immediately.
+#
+# Commands are sent using the text protocol, unless the binary protocol was
+# requested and the Arduino confirmed that it supports it (see
+# serial_protocol.py).
+#
+class SerialLink:
+
+	##
+	# Constructor
+	#
+	# @param  ser        Open serial.Serial object connected to the Arduino
+	# @param  q          Queue containing the messages to be sent
+	# @param  onMessage  Function called with each complete line received
+	# @param  log        Function used to print sent/received messages
+	# @param  binary     Try to switch the Arduino to the binary protocol
+	# @param  tracker    Optional RoundTripTracker matching the echoes to the sent commands
+	#
+	def __init__(self, ser, q, onMessage, log=print, binary=False, tracker=None):
+		self.ser = ser
+		self.q = q
+		self.onMessage = onMessage
+		self.log = log
+		self.binary = binary
+		self.tracker = tracker
+		self.protocol = TextProtocol()
+		self.running = False
+		# Set by stop(), even if the link is not running yet
+		self.stopRequested = threading.Event()
+		self.stateLock = threading.Lock()
+		self.error = None
+		self.writer = None
+		self.parser = LineParser()
+
+		# Counters, read by the /metrics endpoint
+		self.bytesSent = 0
+		self.bytesReceived = 0
+		self.commandsSent = collections.Counter()
+
+
+	##
+	# Run the link until it is stopped or an error occurs
+	#
+	# The writer is started in its own thread and the reader runs in the
+	# calling thread, so this function blocks until the link has shut down.
+	#
+	# @return The exception which stopped the link, or None
+	#
+	def run(self):
+		if self.binary and not self.stopRequested.is_set():
+			self.negotiate_binary()
+		if self.tracker is not None:
+			self.tracker.clear_pending()
+
+		# Stop() may have been called while the port was being set up
+		with self.stateLock:
+			if self.stopRequested.is_set():
+				return self.error
+			self.running = True
+		self.writer = threading.Thread(target=self.write_loop, name="ArduinoWriter", daemon=True)
+		self.writer.start()
+		self.read_loop()
+		self.stop()
+		self.writer.join()
+
+		# Leave the Arduino in text mode for the next connection
+		if self.protocol.name == "binary" and self.error is None:
+			try:
+				self.ser.write(command_frame('P', 0))
+			except Exception:
+				pass
+		return self.error
+
+
+	##
+	# Ask the Arduino to switch to the binary protocol
+	#
+	# The request is repeated until the Arduino replies, since it may still
+	# be starting up after the port was opened, or until the link is
+	# stopped. Older firmware only echoes the command, in which case the
+	# text protocol is kept.
+	#
+	# @param  timeout  Maximum time in seconds to wait for a reply
+	# @return True if the binary protocol is used
+	#
+	def negotiate_binary(self, timeout=3.0):
+		parser = LineParser()
+		reply = PROTOCOL_REPLY + "1"
+		deadline = time.monotonic() + timeout
+		self.ser.timeout = 0.5
+
+		try:
+			while time.monotonic() < deadline and not self.stopRequested.is_set():
+				self.ser.write(b"P1\n")
+				for dataString in parser.feed(self.ser.read(max(1, self.ser.in_waiting))):
+					if dataString == reply:
+						self.protocol = BinaryProtocol()
+						self.log("Using binary serial protocol")
+						return True
+					self.onMessage(dataString)
+		finally:
+			self.ser.timeout = None
+
+		if self.stopRequested.is_set():
+			return False
+		self.log("Arduino does not support the binary protocol; using text protocol")
+		return False
+
+
+	##
+	# Stop both threads of the link
+	#
+	def stop(self):
+		with self.stateLock:
+			self.stopRequested.set()
+			if not self.running:
+				return
+			self.running = False
+
+		# Wake up the writer waiting on the queue
+		self.q.put(None)
+
+		# Wake up the reader waiting in the serial read
+		try:
+			self.ser.cancel_read()
+		except Exception:
+			pass
+
+
+	##
+	# Send commands from the queue as soon as they arrive
+	#
+	def write_loop(self):
+		while self.running:
+			commands = [self.q.get()]
+
+			# Send all other commands which are already waiting in one go
+			while commands[-1] is not None:
+				try:
+					commands.append(self.q.get(block=False))
+				except queue.Empty:
+					break
+
+			if None in commands or not self.running:
+				break
+			try:
+				self.send(commands)
+			except Exception as e:
+				self.fail(e)
+				break
+
+
+	##
+	# Block on the serial port and parse incoming messages
+	#
+	def read_loop(self):
+		while self.running:
+			try:
+				# Wait for the first byte, then take everything that has arrived
+				self.receive(self.ser.read(max(1, self.ser.in_waiting)))
+			except Exception as e:
+				self.fail(e)
+				break
+
+
+	##
+	# Encode and write a batch of commands
+	#
+	# @param  commands  List of command strings
+	#
+	def send(self, commands):
+		data = self.protocol.encode(commands)
+		sendTime = time.perf_counter()
+		self.ser.write(data)
+		self.bytesSent += len(data)
+		if self.tracker is not None:
+			self.tracker.sent(self.protocol.name, commands, data, sendTime)
+		for command in commands:
+			self.commandsSent[command[0]] += 1
+			self.log(command)
+
+
+	##
+	# Parse received bytes and pass on the complete messages
+	#
+	# @param  data  Bytes read from the serial port
+	#
+	def receive(self, data):
+		receiveTime = time.perf_counter()
+		self.bytesReceived += len(data)
+		for dataString in self.parser.feed(data):
+			if self.tracker is not None:
+				self.tracker.received(dataString, receiveTime)
+			self.log(dataString)
+			self.onMessage(dataString)
+
+
+	##
+	# Get the counters of the link
+	#
+	def stats(self):
+		return {
+			'protocol': self.protocol.name,
+			'bytesSent': self.bytesSent,
+			'bytesReceived': self.bytesReceived,
+			'commandsSent': dict(self.commandsSent),
+			'parseErrors': self.parser.overflows
+		}
+
+
+	##
+	# Record an error and shut down the link
+	#
+	# @param  e  The exception which occurred
+	#
+	def fail(self, e):
+		if self.running:
+			self.log(e)
+			self.error = e
+		self.stop()
+
+
+##
+# Serial link running on an asyncio event loop
+#
+# Instead of a reader and a writer thread, the serial port is watched by the
+# event loop (add_reader), and queued commands wake up a writer coroutine
+# through a listener of the command store. The web server, the status push
+# and the serial I/O then all run on the same thread.
+#
+class AsyncSerialLink(SerialLink):
+
+	##
+	# Constructor
+	#
+	# @param  ser        Open serial.Serial object connected to the Arduino
+	# @param  q          CommandStore containing the messages to be sent
+	# @param  onMessage  Function called with each complete line received
+	# @param  loop       The asyncio event loop running the link
+	# @param  log        Function used to print sent/received messages
+	# @param  binary     Try to switch the Arduino to the binary protocol
+	# @param  tracker    Optional RoundTripTracker matching the echoes to the sent commands
+	#
+	def __init__(self, ser, q, onMessage, loop, log=print, binary=False, tracker=None):
+		SerialLink.__init__(self, ser, q, onMessage, log, binary, tracker)
+		self.loop = loop
+		self.wakeup = None
+
+
+	##
+	# Run the link until it is stopped or an error occurs
+	#
+	# Must be awaited on the event loop, for example with
+	# asyncio.run_coroutine_threadsafe() from the Arduino thread.
+	#
+	# @return The exception which stopped the link, or None
+	#
+	async def run_async(self):
+		if self.binary and not self.stopRequested.is_set():
+			# The handshake waits for the Arduino, so keep it off the event loop
+			await self.loop.run_in_executor(None, self.negotiate_binary)
+		if self.tracker is not None:
+			self.tracker.clear_pending()
+
+		# Stop() may have been called while the port was being set up
+		with self.stateLock:
+			if self.stopRequested.is_set():
+				return self.error
+			self.wakeup = asyncio.Event()
+			# Send the commands which were queued before the link started
+			self.wakeup.set()
+			self.running = True
+		self.ser.timeout = 0
+		fileno = self.ser.fileno()
+		self.q.add_listener(self.notify)
+		self.loop.add_reader(fileno, self.on_readable)
+		try:
+			await self.write_async()
+		finally:
+			self.loop.remove_reader(fileno)
+			self.q.remove_listener(self.notify)
+			try:
+				self.ser.timeout = None
+			except Exception:
+				# The port has gone away; the error was already recorded
+				pass
+
+		# Leave the Arduino in text mode for the next connection
+		if self.protocol.name == "binary" and self.error is None:
+			try:
+				self.ser.write(command_frame('P', 0))
+			except Exception:
+				pass
+		return self.error
+
+
+	##
+	# Run the link on its event loop until it is stopped or an error occurs
+	#
+	# Called from another thread (such as the Arduino thread), which waits
+	# until the link has shut down.
+	#
+	# @return The exception which stopped the link, or None
+	#
+	def run(self):
+		return asyncio.run_coroutine_threadsafe(self.run_async(), self.loop).result()
+
+
+	##
+	# Wake up the writer; called by the command store from any thread
+	#
+	def notify(self):
+		self.loop.call_soon_threadsafe(self.wakeup.set)
+
+
+	##
+	# Send the queued commands each time the writer is woken up
+	#
+	async def write_async(self):
+		while self.running:
+			await self.wakeup.wait()
+			self.wakeup.clear()
+
+			commands = []
+			while True:
+				try:
+					commands.append(self.q.get(block=False))
+				except queue.Empty:
+					break
+			commands = [command for command in commands if command is not None]
+
+			if commands and self.running:
+				try:
+					self.send(commands)
+				except Exception as e:
+					self.fail(e)
+
+
+	##
+	# Read all waiting bytes when the event loop reports the port as readable
+	#
+	def on_readable(self):
+		try:
+			data = self.ser.read(max(1, self.ser.in_waiting))
+			if not data:
+				raise IOError("Serial port closed")
+			self.receive(data)
+		except Exception as e:
+			self.fail(e)
+
+
+	##
+	# Stop the link; can be called from any thread
+	#
+	def stop(self):
+		with self.stateLock:
+			self.stopRequested.set()
+			if not self.running:
+				return
+			self.running = False
+		if self.wakeup is not None:
+			self.loop.call_soon_threadsafe(self.wakeup.set)
@@ -0,0 +1,272 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	serial_protocol.py
+# @brief      	Text and binary encodings of the Arduino serial commands
+#
+# Text protocol (default):
+#   One command per line, for example "X-37\n"
+#
+# Binary protocol (enabled with the "P1" command):
+#   [SYNC 0xA5] [TYPE] [LENGTH] [PAYLOAD...] [CHECKSUM]
+#   The checksum is the XOR of the type, length and payload bytes.
+#
+#   FRAME_COMMAND  char, int16 (little-endian)     any single command
+#   FRAME_DRIVE    int8 X, int8 Y                  both drive axes at once
+#   FRAME_SERVOS   uint8 mask, uint8 value...      one value per set bit,
+#                                                  in the order of SERVO_ORDER
+#############################################
+
+import struct 		# for packing the frame payloads
+
+
+FRAME_SYNC = 0xA5
+FRAME_COMMAND = 0x01
+FRAME_DRIVE = 0x02
+FRAME_SERVOS = 0x03
+MAX_PAYLOAD = 8
+
+# Servo commands which can be combined into a FRAME_SERVOS packet (bit 0 first)
+SERVO_ORDER = "GTBUELR"
+
+# Reply sent by the Arduino when it has switched protocol
+PROTOCOL_REPLY = "Protocol_"
+
+
+##
+# Split a text command into its command character and number
+#
+# @param  command  The command string, for example "X-37"
+# @return Tuple of (character, number)
+#
+def split_command(command):
+	try:
+		number = int(command[1:])
+	except ValueError:
+		number = 0
+	return command[0], number
+
+
+##
+# Limit a value to the range which fits into a frame field
+#
+# @param  value  The value to be limited
+# @param  low    Minimum allowed value
+# @param  high   Maximum allowed value
+#
+def clamp(value, low, high):
+	return max(low, min(high, value))
+
+
+##
+# Encoder for the original text protocol
+#
+class TextProtocol:
+
+	name = "text"
+
+	##
+	# Encode a list of commands into the bytes to be sent
+	#
+	# @param  commands  List of command strings
+	# @return Bytes to write to the serial port
+	#
+	def encode(self, commands):
+		return ''.join(command + '\n' for command in commands).encode()
+
+
+##
+# Encoder for the compact binary protocol
+#
+# Runs of consecutive drive commands are combined into one FRAME_DRIVE and
+# runs of consecutive servo commands into one FRAME_SERVOS, so that a full
+# joystick or multi-servo update is sent as a single packet. A new frame is
+# started whenever a channel repeats, so no command is ever dropped.
+#
+class BinaryProtocol:
+
+	name = "binary"
+
+	##
+	# Encode a list of commands into the bytes to be sent
+	#
+	# @param  commands  List of command strings
+	# @return Bytes to write to the serial port
+	#
+	def encode(self, commands):
+		data = bytearray()
+		drive = {}
+		servos = {}
+
+		for command in commands:
+			char, number = split_command(command)
+
+			if char in "XY":
+				if servos:
+					data += self.servo_frame(servos)
+				if char in drive:
+					data += self.drive_frame(drive)
+				drive[char] = number
+			elif char in SERVO_ORDER:
+				if drive:
+					data += self.drive_frame(drive)
+				if char in servos:
+					data += self.servo_frame(servos)
+				servos[char] = number
+			else:
+				if drive:
+					data += self.drive_frame(drive)
+				if servos:
+					data += self.servo_frame(servos)
+				data += command_frame(char, number)
+
+		if drive:
+			data += self.drive_frame(drive)
+		if servos:
+			data += self.servo_frame(servos)
+		return bytes(data)
+
+
+	##
+	# Encode pending drive values; a single axis is sent as a normal command
+	#
+	# @param  drive  Dictionary of the X/Y values, which is cleared afterwards
+	#
+	def drive_frame(self, drive):
+		if len(drive) == 2:
+			frame = encode_frame(FRAME_DRIVE, struct.pack('<bb', clamp(drive['X'], -128, 127), clamp(drive['Y'], -128, 127)))
+		else:
+			frame = command_frame(*drive.popitem())
+		drive.clear()
+		return frame
+
+
+	##
+	# Encode pending servo values into one frame
+	#
+	# @param  servos  Dictionary of the servo values, which is cleared afterwards
+	#
+	def servo_frame(self, servos):
+		mask = 0
+		values = bytearray()
+		for bit, char in enumerate(SERVO_ORDER):
+			if char in servos:
+				mask |= 1 << bit
+				values.append(clamp(servos[char], 0, 255))
+		servos.clear()
+		return encode_frame(FRAME_SERVOS, bytes([mask]) + values)
+
+
+##
+# Build a binary frame
+#
+# @param  frameType  One of the FRAME_* types
+# @param  payload    Bytes of the payload
+# @return The complete frame
+#
+def encode_frame(frameType, payload):
+	checksum = frameType ^ len(payload)
+	for byte in payload:
+		checksum ^= byte
+	return bytes([FRAME_SYNC, frameType, len(payload)]) + payload + bytes([checksum])
+
+
+##
+# Build a frame containing a single command
+#
+# @param  char    The command character
+# @param  number  The command value
+# @return The complete frame
+#
+def command_frame(char, number):
+	return encode_frame(FRAME_COMMAND, struct.pack('<ch', char.encode(), clamp(number, -32768, 32767)))
+
+
+##
+# Incremental decoder for binary frames
+#
+# Used by the Arduino simulator and the benchmarks to check what the
+# BinaryProtocol has sent.
+#
+class FrameDecoder:
+
+	def __init__(self):
+		self.buffer = bytearray()
+		self.errors = 0
+
+
+	##
+	# Add received bytes to the decoder
+	#
+	# @param  data  Bytes received
+	# @return List of the text commands contained in the complete frames
+	#
+	def feed(self, data):
+		return [command for frameType, commands in self.feed_frames(data) for command in commands]
+
+
+	##
+	# Add received bytes to the decoder, keeping the commands of each frame together
+	#
+	# @param  data  Bytes received
+	# @return List of (frame type, list of commands) tuples
+	#
+	def feed_frames(self, data):
+		self.buffer += data
+		frames = []
+
+		while True:
+			# Skip everything up to the next sync byte
+			start = self.buffer.find(bytes([FRAME_SYNC]))
+			if start < 0:
+				self.buffer.clear()
+				break
+			del self.buffer[:start]
+
+			if len(self.buffer) < 3:
+				break
+			length = self.buffer[2]
+			if length > MAX_PAYLOAD:
+				self.errors += 1
+				del self.buffer[:1]
+				continue
+			if len(self.buffer) < length + 4:
+				break
+
+			frame = bytes(self.buffer[:length + 4])
+			checksum = 0
+			for byte in frame[1:-1]:
+				checksum ^= byte
+			if checksum != frame[-1]:
+				self.errors += 1
+				del self.buffer[:1]
+				continue
+
+			del self.buffer[:length + 4]
+			frames.append((frame[1], decode_payload(frame[1], frame[3:-1])))
+
+		return frames
+
+
+##
+# Convert the payload of a frame back into text commands
+#
+# @param  frameType  One of the FRAME_* types
+# @param  payload    Bytes of the payload
+# @return List of command strings
+#
+def decode_payload(frameType, payload):
+	if frameType == FRAME_COMMAND and len(payload) == 3:
+		char, number = struct.unpack('<ch', payload)
+		return [char.decode() + str(number)]
+	elif frameType == FRAME_DRIVE and len(payload) == 2:
+		x, y = struct.unpack('<bb', payload)
+		return ["X" + str(x), "Y" + str(y)]
+	elif frameType == FRAME_SERVOS and len(payload) >= 1:
+		commands = []
+		values = iter(payload[1:])
+		for bit, char in enumerate(SERVO_ORDER):
+			if payload[0] & (1 << bit):
+				commands.append(char + str(next(values, 0)))
+		return commands
+	return []
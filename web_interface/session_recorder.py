@@ -0,0 +1,335 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	session_recorder.py
+# @brief      	Recording and timed playback of control sessions
+#
+# A recording is an append-only text file. The first line is a header, and
+# each following line is one event:
+#
+#   <microseconds since start> <type> <value>
+#
+# where the type is "C" for an Arduino command (such as "X37" or "A2") and
+# "S" for an audio clip. Lines are written as the events happen, so a
+# recording survives the app being stopped, and playback reads the file one
+# line at a time, so long sessions are never loaded into memory.
+#############################################
+
+import os
+import threading
+import time
+
+
+RECORDING_HEADER = "# walle-recording 1"
+RECORDING_EXTENSION = ".rec"
+
+EVENT_COMMAND = "C"
+EVENT_SOUND = "S"
+
+
+##
+# Journal of the commands sent to the Arduino and the audio clips played
+#
+class SessionRecorder:
+
+	##
+	# Constructor
+	#
+	# @param  folder  Folder where the recordings are stored
+	#
+	def __init__(self, folder):
+		self.folder = folder
+		self.lock = threading.Lock()
+		self.file = None
+		self.path = None
+		self.start = None
+		self.events = 0
+
+
+	##
+	# Start a new recording
+	#
+	# A recording never overwrites or appends to an existing one, since its
+	# events would be replayed with the wrong time base.
+	#
+	# @param  name  File name of the recording, generated from the date if None
+	# @return Path of the recording file
+	# @throws FileExistsError if a recording with that name already exists
+	#
+	def start_recording(self, name=None):
+		with self.lock:
+			os.makedirs(self.folder, exist_ok=True)
+			if name is None:
+				# Add a number if a recording was already started in the same second
+				name = time.strftime("session-%Y%m%d-%H%M%S")
+				path = os.path.join(self.folder, name + RECORDING_EXTENSION)
+				number = 1
+				while os.path.exists(path):
+					number += 1
+					path = os.path.join(self.folder, name + "-" + str(number) + RECORDING_EXTENSION)
+			else:
+				path = os.path.join(self.folder, os.path.basename(name) + RECORDING_EXTENSION)
+
+			# Line buffered, so every event is on disk as soon as it is recorded
+			newFile = open(path, 'x', buffering=1)
+			self.close()
+			self.file = newFile
+			self.file.write(RECORDING_HEADER + " " + time.strftime("%Y-%m-%dT%H:%M:%S") + "\n")
+			self.path = path
+			self.start = time.monotonic()
+			self.events = 0
+		return path
+
+
+	##
+	# Stop the current recording
+	#
+	# @return Path of the recording file, or None if nothing was being recorded
+	#
+	def stop_recording(self):
+		with self.lock:
+			path = self.path
+			self.close()
+			return path
+
+
+	##
+	# Close the recording file; called with the lock held
+	#
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+		self.file = None
+		self.path = None
+
+
+	##
+	# Check whether a recording is in progress
+	#
+	def recording(self):
+		return self.file is not None
+
+
+	##
+	# Add an event to the recording, if one is in progress
+	#
+	# @param  eventType  EVENT_COMMAND or EVENT_SOUND
+	# @param  value      The command or the name of the audio clip
+	#
+	def record(self, eventType, value):
+		if self.file is None or value is None:
+			return
+		with self.lock:
+			if self.file is None:
+				return
+			offset = int((time.monotonic() - self.start) * 1000000)
+			self.file.write("%d %s %s\n" % (offset, eventType, value))
+			self.events += 1
+
+
+	##
+	# Add an Arduino command to the recording
+	#
+	# @param  command  The command string, for example "X-37"
+	#
+	def record_command(self, command):
+		self.record(EVENT_COMMAND, command)
+
+
+	##
+	# Add an audio clip to the recording
+	#
+	# @param  clip  Name of the clip (file name without the extension)
+	#
+	def record_sound(self, clip):
+		self.record(EVENT_SOUND, clip)
+
+
+	##
+	# Get the list of recordings, newest first
+	#
+	# @return List of dictionaries with the name, size and modification time
+	#
+	def list(self):
+		try:
+			items = os.listdir(self.folder)
+		except OSError:
+			return []
+
+		recordings = []
+		for item in items:
+			if item.endswith(RECORDING_EXTENSION):
+				stat = os.stat(os.path.join(self.folder, item))
+				recordings.append({'name': recording_name(item), 'size': stat.st_size, 'modified': stat.st_mtime})
+		return sorted(recordings, key=lambda recording: recording['modified'], reverse=True)
+
+
+	##
+	# Get the path of a recording
+	#
+	# @param  name  Name of the recording, or None for the newest one
+	# @return Path of the file, or None if it does not exist
+	#
+	def find(self, name=None):
+		if name is None:
+			recordings = self.list()
+			if not recordings:
+				return None
+			name = recordings[0]['name']
+		path = os.path.join(self.folder, os.path.basename(name) + RECORDING_EXTENSION)
+		return path if os.path.isfile(path) else None
+
+
+	##
+	# Get the status of the recorder
+	#
+	def status(self):
+		with self.lock:
+			return {
+				'recording': self.file is not None,
+				'file': recording_name(self.path),
+				'events': self.events,
+				'duration': 0 if self.start is None or self.file is None else round(time.monotonic() - self.start, 3)
+			}
+
+
+##
+# Get the name of a recording from its path
+#
+# @param  path  Path of the recording file, or None
+# @return File name without the folder and extension, or None
+#
+def recording_name(path):
+	if path is None:
+		return None
+	return os.path.splitext(os.path.basename(path))[0]
+
+
+##
+# Read the events of a recording, one line at a time
+#
+# @param  path  Path of the recording file
+# @return Generator of (offset in seconds, type, value) tuples
+#
+def read_events(path):
+	with open(path) as f:
+		for line in f:
+			if line.startswith('#'):
+				continue
+			parts = line.rstrip('\n').split(' ', 2)
+			if len(parts) != 3 or not parts[0].isdigit():
+				continue
+			yield int(parts[0]) / 1000000.0, parts[1], parts[2]
+
+
+##
+# Plays recordings back on a dedicated thread
+#
+# Every event is scheduled at an absolute time (start of playback plus the
+# recorded offset), so the delays do not add up over a long recording the
+# way they would with a sleep between events. Waiting is done on an Event,
+# so playback stops immediately when requested.
+#
+class SessionPlayer:
+
+	##
+	# Constructor
+	#
+	# @param  onCommand  Function called with each Arduino command
+	# @param  onSound    Function called with each audio clip
+	#
+	def __init__(self, onCommand, onSound):
+		self.onCommand = onCommand
+		self.onSound = onSound
+		self.lock = threading.Lock()
+		self.thread = None
+		self.stopEvent = threading.Event()
+		self.path = None
+		self.events = 0
+		self.maxLateness = 0.0
+		self.totalLateness = 0.0
+
+
+	##
+	# Start playing a recording, stopping any recording which is playing
+	#
+	# @param  path  Path of the recording file
+	# @param  loop  Start again from the beginning when the end is reached
+	#
+	def play(self, path, loop=False):
+		self.stop()
+		with self.lock:
+			self.stopEvent = threading.Event()
+			self.path = path
+			self.events = 0
+			self.maxLateness = 0.0
+			self.totalLateness = 0.0
+			self.thread = threading.Thread(target=self.run, args=(path, loop, self.stopEvent), name="SessionPlayer", daemon=True)
+			self.thread.start()
+
+
+	##
+	# Stop the playback and wait for the thread to finish
+	#
+	def stop(self):
+		with self.lock:
+			thread = self.thread
+			self.stopEvent.set()
+		if thread is not None and thread is not threading.current_thread():
+			thread.join()
+
+
+	##
+	# Check whether a recording is playing
+	#
+	def playing(self):
+		thread = self.thread
+		return thread is not None and thread.is_alive()
+
+
+	##
+	# Play the events of the recording at their recorded times
+	#
+	# @param  path       Path of the recording file
+	# @param  loop       Start again from the beginning when the end is reached
+	# @param  stopEvent  Event which is set to stop the playback
+	#
+	def run(self, path, loop, stopEvent):
+		try:
+			while not stopEvent.is_set():
+				start = time.perf_counter()
+				for offset, eventType, value in read_events(path):
+					delay = start + offset - time.perf_counter()
+					if delay > 0 and stopEvent.wait(delay):
+						return
+					if stopEvent.is_set():
+						return
+
+					lateness = max(0.0, time.perf_counter() - start - offset)
+					self.maxLateness = max(self.maxLateness, lateness)
+					self.totalLateness += lateness
+					self.events += 1
+
+					if eventType == EVENT_COMMAND:
+						self.onCommand(value)
+					elif eventType == EVENT_SOUND:
+						self.onSound(value)
+
+				# Nothing to repeat if the recording has no events
+				if not loop or not self.events:
+					break
+		except Exception as e:
+			print("Unable to play recording", path, e)
+
+
+	##
+	# Get the status of the player
+	#
+	def status(self):
+		return {
+			'playing': self.playing(),
+			'file': recording_name(self.path),
+			'events': self.events,
+			'maxLatenessMs': round(self.maxLateness * 1000.0, 3),
+			'meanLatenessMs': round(self.totalLateness / self.events * 1000.0, 3) if self.events else 0
+		}
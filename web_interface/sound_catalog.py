@@ -0,0 +1,167 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	sound_catalog.py
+# @brief      	Cached list of the audio files which can be played
+#############################################
+
+import hashlib 		# for the catalog ETag
+import json
+import os
+import struct 		# for reading the OGG headers
+import threading
+
+
+##
+# Split an audio file name into its group, name and duration
+#
+# File names have the format "[group_]name[_milliseconds].ogg", for
+# example "Voice_Walle-1_1950.ogg" or "Sound_Wow.ogg".
+#
+# @param  audiofile  Name of the file without the extension
+# @return Tuple of (group, name, duration in seconds or None)
+#
+def parse_filename(audiofile):
+	parts = audiofile.split('_')
+
+	if len(parts) == 2:
+		if parts[1].isdigit():
+			return "Other", parts[0], float(parts[1]) / 1000.0
+		return parts[0], parts[1], None
+	elif len(parts) == 3:
+		duration = float(parts[2]) / 1000.0 if parts[2].isdigit() else None
+		return parts[0], parts[1], duration
+	return "Other", audiofile, None
+
+
+##
+# Read the duration of an OGG Vorbis or Opus file from its headers
+#
+# The sample rate is taken from the identification header on the first
+# page and the total number of samples from the granule position of the
+# last page, so only the start and the end of the file are read.
+#
+# @param  path  Path of the OGG file
+# @return Duration in seconds, or 0 if it could not be determined
+#
+def ogg_duration(path):
+	try:
+		with open(path, 'rb') as f:
+			head = f.read(128)
+			f.seek(0, os.SEEK_END)
+			size = f.tell()
+			f.seek(max(0, size - 65536))
+			tail = f.read()
+	except OSError:
+		return 0
+
+	if not head.startswith(b'OggS'):
+		return 0
+
+	# The first packet starts after the page header and segment table
+	packet = head[27 + head[26]:]
+	preSkip = 0
+	if packet.startswith(b'\x01vorbis'):
+		sampleRate = struct.unpack_from('<I', packet, 12)[0]
+	elif packet.startswith(b'OpusHead'):
+		preSkip = struct.unpack_from('<H', packet, 10)[0]
+		sampleRate = 48000
+	else:
+		return 0
+
+	last = tail.rfind(b'OggS')
+	if last < 0 or last + 14 > len(tail) or not sampleRate:
+		return 0
+	granule = struct.unpack_from('<q', tail, last + 6)[0]
+	return max(0, granule - preSkip) / float(sampleRate)
+
+
+##
+# Catalog of the audio files in the sound folder
+#
+# The folder is only scanned again when its modification time changes (a
+# file was added, removed or renamed), and the OGG headers of a file are
+# only read once for each file size and modification time.
+#
+class SoundCatalog:
+
+	##
+	# Constructor
+	#
+	# @param  folder  Folder containing the audio files
+	#
+	def __init__(self, folder):
+		self.folder = folder
+		self.lock = threading.Lock()
+		self.mtime = None
+		self.files = []
+		self.etag = None
+		self.durations = {}
+
+
+	##
+	# Get the list of audio files, rescanning the folder if it has changed
+	#
+	# @return List of (group, file, name, duration) tuples, sorted by file name
+	#
+	def get(self):
+		with self.lock:
+			try:
+				mtime = os.stat(self.folder).st_mtime_ns
+			except OSError:
+				mtime = None
+
+			if mtime != self.mtime or self.etag is None:
+				self.files = self.scan()
+				self.mtime = mtime
+				self.etag = hashlib.sha1(json.dumps(self.files).encode()).hexdigest()
+			return self.files
+
+
+	##
+	# Get the ETag identifying the current version of the catalog
+	#
+	def get_etag(self):
+		self.get()
+		return self.etag
+
+
+	##
+	# Build the list of audio files in the folder
+	#
+	def scan(self):
+		files = []
+		try:
+			items = sorted(os.listdir(self.folder))
+		except OSError:
+			return files
+
+		for item in items:
+			if not item.endswith(".ogg"):
+				continue
+			audiofile = os.path.splitext(item)[0]
+			audiogroup, audioname, audiotime = parse_filename(audiofile)
+
+			# Read the duration from the file if it is not part of the name
+			if audiotime is None:
+				audiotime = self.file_duration(item)
+
+			files.append((audiogroup, audiofile, audioname, audiotime))
+		return files
+
+
+	##
+	# Get the duration of a file, reusing the value read previously
+	#
+	# @param  item  File name in the sound folder
+	#
+	def file_duration(self, item):
+		path = os.path.join(self.folder, item)
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return 0
+		key = (item, stat.st_size, stat.st_mtime_ns)
+		if key not in self.durations:
+			self.durations[key] = ogg_duration(path)
+		return self.durations[key]
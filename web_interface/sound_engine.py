@@ -0,0 +1,141 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	sound_engine.py
+# @brief      	Low-latency playback of preloaded sound clips
+#############################################
+
+import collections 	# for the least-recently-used cache
+import os
+import threading
+import pygame		# for sound
+
+
+##
+# Sound engine playing preloaded clips on a pool of mixer channels
+#
+# Clips are decoded into pygame.mixer.Sound objects in advance, so playing
+# a clip does not have to read and decode the file first. Each clip plays on
+# its own mixer channel, so short effects can overlap instead of cutting
+# each other off. To limit memory usage on large sound libraries, the least
+# recently used clips are unloaded once the memory limit is reached.
+#
+class SoundEngine:
+
+	##
+	# Constructor
+	#
+	# @param  folder       Folder containing the audio files
+	# @param  channels     Number of clips which can play at the same time
+	# @param  memoryLimit  Maximum memory in bytes used by the decoded clips
+	#
+	def __init__(self, folder, channels=8, memoryLimit=64 * 1024 * 1024):
+		self.folder = folder
+		self.memoryLimit = memoryLimit
+		self.memoryUsed = 0
+		self.lock = threading.Lock()
+		self.cache = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		pygame.mixer.set_num_channels(channels)
+
+
+	##
+	# Decode clips in advance, until the memory limit is reached
+	#
+	# @param  clips  List of clip names (file names without the extension)
+	#
+	def preload(self, clips):
+		for clip in clips:
+			with self.lock:
+				if self.memoryUsed >= self.memoryLimit:
+					break
+			try:
+				self.get(clip)
+			except Exception as e:
+				print("Unable to load sound clip", clip, e)
+
+
+	##
+	# Get the decoded clip, loading it if it is not in the cache
+	#
+	# @param  clip  Name of the clip (file name without the extension)
+	# @return The pygame.mixer.Sound object
+	#
+	def get(self, clip):
+		path = os.path.join(self.folder, clip + ".ogg")
+		mtime = os.stat(path).st_mtime_ns
+
+		with self.lock:
+			entry = self.cache.get(clip)
+			if entry is not None and entry[1] == mtime:
+				self.cache.move_to_end(clip)
+				self.hits += 1
+				return entry[0]
+
+		# Decode outside of the lock, since this is the slow part
+		sound = pygame.mixer.Sound(path)
+		size = sound_size(sound)
+
+		with self.lock:
+			self.misses += 1
+			if clip in self.cache:
+				self.memoryUsed -= self.cache.pop(clip)[2]
+			self.cache[clip] = (sound, mtime, size)
+			self.memoryUsed += size
+
+			# Unload the least recently used clips
+			while self.memoryUsed > self.memoryLimit and len(self.cache) > 1:
+				self.memoryUsed -= self.cache.popitem(last=False)[1][2]
+		return sound
+
+
+	##
+	# Play a clip
+	#
+	# @param  clip    Name of the clip (file name without the extension)
+	# @param  volume  Volume between 0.0 and 1.0
+	# @return The mixer channel which is playing the clip
+	#
+	def play(self, clip, volume):
+		sound = self.get(clip)
+
+		# If all channels are busy, the clip which started first is stopped.
+		# The volume is set on the channel, since the Sound object is shared
+		# with the other channels which may still be playing the same clip.
+		channel = pygame.mixer.find_channel(True)
+		channel.play(sound)
+		channel.set_volume(volume)
+		return channel
+
+
+	##
+	# Stop all clips which are playing
+	#
+	def stop(self):
+		pygame.mixer.stop()
+
+
+	##
+	# Get the counters of the sound engine
+	#
+	def stats(self):
+		with self.lock:
+			return {
+				'loaded': len(self.cache),
+				'memoryUsed': self.memoryUsed,
+				'memoryLimit': self.memoryLimit,
+				'hits': self.hits,
+				'misses': self.misses
+			}
+
+
+##
+# Estimate the memory used by a decoded clip
+#
+# @param  sound  The pygame.mixer.Sound object
+# @return Size in bytes
+#
+def sound_size(sound):
+	frequency, sampleFormat, channels = pygame.mixer.get_init()
+	return int(sound.get_length() * frequency * channels * (abs(sampleFormat) // 8))
@@ -207,6 +207,10 @@ VirtualJoystick.prototype._updateValues = function(){
 	var text = this._updateText;
 
 	// Send data to python app, so that it can be passed on
+	if (sendControl("X" + Math.round(stickNormalizedX*100) + ";Y" + Math.round(stickNormalizedY*100))) {
+		text.style.color = "#3498DB";
+		return true;
+	}
 	$.ajax({
 		url: "/motor",
 		type: "POST",
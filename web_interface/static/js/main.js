@@ -22,6 +22,124 @@ var jsJoystick;
 // Timer to periodically check if Arduino has sent a message
 var arduinoTimer;
 
+// Timer to periodically check the camera stream status
+var cameraTimer;
+
+// WebSocket used to send control commands (POST routes are used as fallback)
+var controlSocket = null;
+
+
+/*
+ * Open the persistent control channel to the python backend
+ */
+function openControlSocket() {
+	if (!("WebSocket" in window)) return;
+
+	var protocol = (window.location.protocol == "https:") ? "wss://" : "ws://";
+	var socket = new WebSocket(protocol + window.location.host + "/control");
+
+	socket.onopen = function() {
+		controlSocket = socket;
+	};
+	socket.onmessage = function(event) {
+		var data = JSON.parse(event.data);
+		if (data.status == "Error") {
+			showAlert(1, 'Error!', data.msg, 0);
+		} else if (data.telemetry) {
+			updateDischargeRate(data.telemetry.battery);
+		} else if (data.arduino == "Connected") {
+			updateBattery(parseInt(data.battery));
+		}
+	};
+	socket.onclose = function() {
+		// Fall back to the POST routes and try again later
+		controlSocket = null;
+		setTimeout(openControlSocket, 5000);
+	};
+}
+
+
+/*
+ * Show the smoothed battery level and discharge rate as the battery tooltip
+ */
+function updateDischargeRate(battery) {
+	if (battery == null || battery.smoothed == null) return;
+	var title = 'Battery: ' + battery.smoothed.toFixed(1) + '%';
+	if (battery.rate != null) title += ', ' + (-battery.rate * 3600).toFixed(1) + '% per hour';
+	$('#batt-area').attr('data-original-title', title);
+}
+
+
+/*
+ * Send a control message, such as "X37;Y-50", over the WebSocket
+ * Returns false if the WebSocket is not available
+ */
+function sendControl(message) {
+	if (controlSocket == null || controlSocket.readyState != WebSocket.OPEN) return false;
+	controlSocket.send(message);
+	return true;
+}
+
+
+/*
+ * Get the address of the camera stream, using the profile selected on this device
+ */
+function streamUrl() {
+	var profile = localStorage.getItem("streamProfile") || "full";
+	return "http:/" + "/" + window.location.hostname + ":8080/stream.mjpg?profile=" + profile;
+}
+
+
+/*
+ * Show the camera stream as active or offline
+ */
+function showStreamer(active) {
+	if (active) {
+		$('#conn-streamer').html('End Stream');
+		$('#conn-streamer').removeClass('btn-outline-info');
+		$('#conn-streamer').addClass('btn-outline-danger');
+		$("#stream").attr("src",streamUrl());
+		clearInterval(cameraTimer);
+		cameraTimer = setInterval(checkCameraStatus, 10000);
+	} else {
+		$('#conn-streamer').html('Reactivate');
+		$('#conn-streamer').addClass('btn-outline-info');
+		$('#conn-streamer').removeClass('btn-outline-danger');
+		$("#stream").attr("src","/static/streamimage.jpg");
+		clearInterval(cameraTimer);
+	}
+}
+
+
+/*
+ * Check that the camera is still producing frames
+ */
+function checkCameraStatus() {
+	$.ajax({
+		url: "/cameraStatus",
+		type: "POST",
+		dataType: "json",
+		success: function(data){
+			if (data.streamer == "Offline") {
+				showStreamer(false);
+			} else if (data.camera.health == "stalled") {
+				showAlert(1, 'Camera Error!', 'The camera has stopped sending new images.', 1);
+			}
+		}
+	});
+}
+
+
+/*
+ * Switch between the full resolution and the low-bandwidth preview stream
+ */
+function changeStreamProfile(profile) {
+	localStorage.setItem("streamProfile", profile);
+	if ($('#conn-streamer').hasClass('btn-outline-danger')) {
+		$("#stream").attr("src",streamUrl());
+	}
+}
+
 
 /*
  * Update Web-Interface Settings
@@ -55,15 +173,9 @@ function sendSettings(type, value) {
 				// If setting related to the camera stream, show/hide the video stream
 				if(typeof data.streamer !== "undefined"){
 						if(data.streamer == "Active"){
-							$('#conn-streamer').html('End Stream');
-							$('#conn-streamer').removeClass('btn-outline-info');
-							$('#conn-streamer').addClass('btn-outline-danger');
-							$("#stream").attr("src","http:/" + "/" + window.location.hostname + ":8080/?action=stream");
+							showStreamer(true);
 						} else if(data.streamer == "Offline"){
-							$('#conn-streamer').html('Reactivate');
-							$('#conn-streamer').addClass('btn-outline-info');
-							$('#conn-streamer').removeClass('btn-outline-danger');
-							$("#stream").attr("src","/static/streamimage.jpg");
+							showStreamer(false);
 						}
 				}
 				return 1;
@@ -175,10 +287,10 @@ function updateSerialList(alertActive) {
 				
 				if (listLength > 0) {
 					for (var i = 0; i < listLength; i++) {
-						if (data.portSelect == i) {
-							$('#port-select').append('<option value="' + i + '" selected>' + portList[i] + '</option>');
+						if (data.portSelect == portList[i].id) {
+							$('#port-select').append('<option value="' + portList[i].id + '" selected>' + portList[i].name + '</option>');
 						} else {
-							$('#port-select').append('<option value="' + i + '">' + portList[i] + '</option>');
+							$('#port-select').append('<option value="' + portList[i].id + '">' + portList[i].name + '</option>');
 						}
 					}
 					
@@ -212,6 +324,13 @@ function updateSerialList(alertActive) {
  * Play a servo motor animation
  */
 function anime(clip, time) {
+	// Keyframe animations (named files) are played from the Raspberry Pi, so they always use the POST route
+	if (/^\d+$/.test(clip) && sendControl("A" + clip)) {
+		$('#anime-progress').stop();
+		$('#anime-progress').removeClass('bg-danger');
+		$('#anime-progress').css("width", "0%").animate({width: 100+"%"}, time*1000);
+		return true;
+	}
 	$.ajax({
 		url: "/animate",
 		type: "POST",
@@ -292,6 +411,11 @@ function playAudio(clip, time) {
  * Send a manual servo control command
  */
 function servoControl(item, servo, value) {
+	if (sendControl(servo + value)) {
+		item.value = value;
+		item.oldvalue = value;
+		return true;
+	}
 	$.ajax({
 		url: "/servoControl",
 		type: "POST",
@@ -450,11 +574,50 @@ function servoInputs(enabled) {
 }
 
 
+/*
+ * Show the battery level received from the Arduino
+ */
+function updateBattery(batteryLevel) {
+	if (batteryLevel != -999) {
+		if (batteryLevel < 0) batteryLevel = 0;
+		$('#batt-area').removeClass('d-none');
+		$('#batt-text').html(batteryLevel + '%');
+		if (batteryLevel > 65 && !$('#batt-icon').hasClass('fa-battery-full')) {
+			$('#batt-icon').removeClass('fa-battery-quarter');
+			$('#batt-icon').removeClass('fa-battery-half');
+			$('#batt-icon').addClass('fa-battery-full');
+			$('#batt-area').removeClass('bg-danger');
+			$('#batt-area').removeClass('bg-warning');
+			$('#batt-area').addClass('bg-success');
+		} else if (batteryLevel > 35 && batteryLevel <= 65  && !$('#batt-icon').hasClass('fa-battery-half')) {
+			$('#batt-icon').removeClass('fa-battery-quarter');
+			$('#batt-icon').addClass('fa-battery-half');
+			$('#batt-icon').removeClass('fa-battery-full');
+			$('#batt-area').removeClass('bg-danger');
+			$('#batt-area').addClass('bg-warning');
+			$('#batt-area').removeClass('bg-success');
+		} if (batteryLevel <= 35 && !$('#batt-icon').hasClass('fa-battery-quarter')) {
+			$('#batt-icon').addClass('fa-battery-quarter');
+			$('#batt-icon').removeClass('fa-battery-half');
+			$('#batt-icon').removeClass('fa-battery-full');
+			$('#batt-area').addClass('bg-danger');
+			$('#batt-area').removeClass('bg-warning');
+			$('#batt-area').removeClass('bg-success');
+		}
+	} else {
+		$('#batt-area').addClass('d-none');
+	}
+}
+
+
 /*
  * This function checks if the Arduino has sent any messages to the 
  * Raspberry Pi; for example, the current battery level
  */
 function checkArduinoStatus() {
+	// Status updates are pushed over the WebSocket when it is open
+	if (controlSocket != null) return;
+
 	$.ajax({
 		url: "/arduinoStatus",
 		type: "POST",
@@ -462,36 +625,7 @@ function checkArduinoStatus() {
 		dataType: "json",
 		success: function(data){
 			if(data.status != "Error"){
-				var batteryLevel = parseInt(data.battery);
-				if (batteryLevel != -999) {
-					if (batteryLevel < 0) batteryLevel = 0;
-					$('#batt-area').removeClass('d-none');
-					$('#batt-text').html(batteryLevel + '%');
-					if (batteryLevel > 65 && !$('#batt-icon').hasClass('fa-battery-full')) {
-						$('#batt-icon').removeClass('fa-battery-quarter');
-						$('#batt-icon').removeClass('fa-battery-half');
-						$('#batt-icon').addClass('fa-battery-full');
-						$('#batt-area').removeClass('bg-danger');
-						$('#batt-area').removeClass('bg-warning');
-						$('#batt-area').addClass('bg-success');
-					} else if (batteryLevel > 35 && batteryLevel <= 65  && !$('#batt-icon').hasClass('fa-battery-half')) {
-						$('#batt-icon').removeClass('fa-battery-quarter');
-						$('#batt-icon').addClass('fa-battery-half');
-						$('#batt-icon').removeClass('fa-battery-full');
-						$('#batt-area').removeClass('bg-danger');
-						$('#batt-area').addClass('bg-warning');
-						$('#batt-area').removeClass('bg-success');
-					} if (batteryLevel <= 35 && !$('#batt-icon').hasClass('fa-battery-quarter')) {
-						$('#batt-icon').addClass('fa-battery-quarter');
-						$('#batt-icon').removeClass('fa-battery-half');
-						$('#batt-icon').removeClass('fa-battery-full');
-						$('#batt-area').addClass('bg-danger');
-						$('#batt-area').removeClass('bg-warning');
-						$('#batt-area').removeClass('bg-success');
-					}
-				} else {
-					$('#batt-area').addClass('d-none');
-				}
+				updateBattery(parseInt(data.battery));
 				return true;
 			} else {
 				showAlert(1, 'Error!', data.msg, 1);
@@ -701,6 +835,7 @@ function sendMovementValues() {
 		$('#joytext').html('x: ' + Math.round(moveXY[1]*100) + ', y: ' + Math.round(moveXY[3]*-100));
 		
 		// Send data to python app, so that it can be passed on
+		if (sendControl("X" + Math.round(moveXY[1]*100) + ";Y" + Math.round(-moveXY[3]*100))) return;
 		$.ajax({
 			url: "/motor",
 			type: "POST",
@@ -875,12 +1010,11 @@ $(document).ready(function () {
 	// If camera stream has already been started, show it on the web-interface
 	if ($('#stream').hasClass('starting')) {
 		$('#stream').removeClass('starting');
-		$('#conn-streamer').html('End Stream');
-		$('#conn-streamer').removeClass('btn-outline-info');
-		$('#conn-streamer').addClass('btn-outline-danger');
-		$("#stream").attr("src","http:/" + "/" + window.location.hostname + ":8080/?action=stream");
+		showStreamer(true);
 	}
 
+	$('#stream-profile').val(localStorage.getItem("streamProfile") || "full");
+	openControlSocket();
 	controllerOn();
 	if (joypad.instances[0] != null && joypad.instances[0].connected) updateInfo(joypad.instances[0]);
 	
@@ -1,13 +1,27 @@
 #!/usr/bin/python3
 
+import argparse
+import collections
 import io
+import json
 import logging
+import os
 import socketserver
+import struct
+import time
 from http import server
-from threading import Condition
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
+from threading import Condition, Lock, Thread
+from urllib.parse import urlparse, parse_qs
+try:
+    from picamera2 import Picamera2
+    from picamera2.encoders import MJPEGEncoder, Quality
+    from picamera2.outputs import FileOutput
+except ImportError:
+    # No camera library (not a Raspberry Pi); frames can still be written
+    # to the outputs by another source, such as fake_camera.py
+    Picamera2 = None
+    FileOutput = object
+from metrics import MetricsRegistry, CONTENT_TYPE
 
 PAGE = """\
 <html>
@@ -17,76 +31,955 @@ PAGE = """\
 <body>
 <h1>Picamera2 MJPEG Streaming Demo</h1>
 <img src="stream.mjpg" width="1280" height="720" />
+<p><a href="preview.mjpg">Low-bandwidth preview stream</a></p>
+<p><a href="snapshot.jpg">Latest frame</a></p>
+<p><a href="recording.json">Recording status</a></p>
+<p><a href="stats.json">Camera pipeline statistics</a></p>
 </body>
 </html>
 """
 
+# Stream profiles: name -> (Picamera2 stream, resolution)
+# The full stream uses the main camera output and the preview stream the
+# low-resolution (lores) output, so both are produced from one capture.
+PROFILES = {
+    'full': ('main', (1920, 1080)),
+    'preview': ('lores', (640, 360)),
+}
+DEFAULT_PROFILE = 'full'
+
 streaming = False
 output = None
+outputs = {}
 picam2 = None
+settings = {'framerate': 30, 'quality': 80}
+camera_lock = Lock()
+http_server = None
+server_thread = None
+toggle_times = {'start': None, 'stop': None}
+recorder = None
+recording_dir = None
+stats_thread = None
+# Seconds between the pipeline statistics written to the log once
+# the stream has been started (None = not logged)
+stats_interval = None
+
+# Seconds without a new frame after which a running stream is reported as stalled
+STALL_TIMEOUT = 2.0
+
+# Longest time a snapshot request may wait for the next frame
+MAX_SNAPSHOT_WAIT = 30.0
+
+# Prefix of the snapshot ETags, so the frame sequence numbers of an earlier
+# run of the server never match
+ETAG_PREFIX = '%x-%x' % (os.getpid(), int(time.time()))
+
+# Recording defaults: profile recorded, seconds per segment file, disk budget
+# in bytes and frames which may wait for the writer before frames are dropped
+RECORD_PROFILE = DEFAULT_PROFILE
+SEGMENT_SECONDS = 60
+RECORD_BUDGET = 2 * 1024 ** 3
+RECORD_BACKLOG = 60
+
+# Seconds of history kept by the rolling pipeline statistics
+STATS_WINDOW = 10.0
+
+# Frame latencies above this many seconds mean the sensor timestamp uses
+# another clock than sensor_clock(), so they are not recorded
+MAX_LATENCY = 10.0
+
+# Seconds the wall clock may step, relative to the monotonic clock, before
+# the recorder starts a new segment
+CLOCK_STEP = 1.0
+
+# Index entry of a recorded frame: wall-clock time, offset and length in the segment
+INDEX_ENTRY = struct.Struct('<dQI')
+
+def sensor_clock():
+    """Current time of the clock used for the libcamera sensor timestamps, in seconds."""
+    return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+class RollingStats:
+    """Values added during the last window seconds, with summary statistics."""
+
+    def __init__(self, window=STATS_WINDOW, max_samples=2000):
+        self.window = window
+        self.samples = collections.deque(maxlen=max_samples)
+        self.lock = Lock()
+
+    def add(self, value, now=None):
+        with self.lock:
+            self.samples.append((time.monotonic() if now is None else now, value))
+
+    def values(self):
+        """Values of the samples in the window, oldest first."""
+        start = time.monotonic() - self.window
+        with self.lock:
+            while self.samples and self.samples[0][0] < start:
+                self.samples.popleft()
+            return [value for added, value in self.samples]
+
+    def summary(self, scale=1.0):
+        """Count, mean, minimum, median, 95th percentile and maximum of the
+        values in the window, multiplied by scale (for example 1000 for ms)."""
+        values = sorted(self.values())
+        if not values:
+            return {'count': 0}
+        return {'count': len(values),
+                'mean': round(sum(values) / len(values) * scale, 3),
+                'min': round(values[0] * scale, 3),
+                'p50': round(values[len(values) // 2] * scale, 3),
+                'p95': round(values[min(len(values) - 1, len(values) * 95 // 100)] * scale, 3),
+                'max': round(values[-1] * scale, 3)}
+
+    def rate(self, since=None):
+        """Sum of the values in the window per second; since is the
+        time.monotonic() at which the measurement started, if it is shorter
+        than the window."""
+        period = self.window
+        if since is not None:
+            period = min(period, time.monotonic() - since)
+        return sum(self.values()) / period if period > 0 else 0.0
+
+class Frame:
+    """A JPEG frame together with its pre-built multipart headers."""
+
+    def __init__(self, sequence, data, sensor_time=None, profile=''):
+        self.sequence = sequence
+        self.timestamp = time.time()
+        self.monotonic = time.monotonic()
+        self.sensor_time = sensor_time
+        self.data = memoryview(data)
+        self.etag = frame_etag(profile, sequence)
+        self.header = (b'--FRAME\r\n'
+                       b'Content-Type: image/jpeg\r\n'
+                       b'Content-Length: ' + str(len(data)).encode() + b'\r\n\r\n')
+        self.parts = (self.header, self.data, b'\r\n')
+
+class ClientSlot:
+    """Latest-frame slot of one streaming client.
+
+    A new frame replaces the one waiting to be sent, so a slow client skips
+    frames instead of building up a queue or delaying the other clients.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.condition = Condition()
+        self.frame = None
+        self.sent = 0
+        self.dropped = 0
+        self.connected = time.monotonic()
+        self.bytes = RollingStats()
+        self.stalls = RollingStats()
+        self.latency = RollingStats()
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None, timeout)
+            frame = self.frame
+            self.frame = None
+            return frame
+
+    def record(self, frame, start, end):
+        """Record a frame written to the socket between two time.monotonic() times."""
+        self.sent += 1
+        self.bytes.add(len(frame.data), end)
+        self.stalls.add(end - start, end)
+        if frame.sensor_time is not None:
+            latency = sensor_clock() - frame.sensor_time
+            if 0 <= latency <= MAX_LATENCY:
+                self.latency.add(latency, end)
+
+    def stats(self):
+        return {'client': '%s:%d' % self.address[:2],
+                'sent': self.sent,
+                'dropped': self.dropped}
+
+    def pipeline_stats(self):
+        """Throughput, socket write times and frame latency of the client."""
+        stats = self.stats()
+        stats.update({'bytesPerSecond': round(self.bytes.rate(self.connected)),
+                      'stallFraction': round(self.stalls.rate(self.connected), 4),
+                      'writeMs': self.stalls.summary(1000),
+                      'latencyMs': self.latency.summary(1000)})
+        return stats
 
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, profile=''):
+        self.profile = profile
         self.frame = None
+        self.sequence = 0
+        self.last_write = None
         self.condition = Condition()
+        self.clients = []
+        self.clients_lock = Lock()
+        self.recorder = None
+        # Sensor timestamp in microseconds of the frame being written, if known
+        self.sensor_timestamp = None
+        self.intervals = RollingStats()
+        self.sizes = RollingStats()
+        self.encode_latency = RollingStats()
+        # Frames sent/dropped by clients which have disconnected
+        self.sent = 0
+        self.dropped = 0
 
     def write(self, buf):
+        now = time.monotonic()
+        sensor_time = None
+        if self.sensor_timestamp is not None:
+            sensor_time = self.sensor_timestamp / 1000000
+            self.sensor_timestamp = None
+            latency = sensor_clock() - sensor_time
+            if 0 <= latency <= MAX_LATENCY:
+                self.encode_latency.add(latency, now)
+        if self.last_write is not None:
+            self.intervals.add(now - self.last_write, now)
+        self.sizes.add(len(buf), now)
         with self.condition:
-            self.frame = buf
+            self.sequence += 1
+            self.frame = Frame(self.sequence, buf, sensor_time, self.profile)
+            self.last_write = now
             self.condition.notify_all()
+        with self.clients_lock:
+            for client in self.clients:
+                client.put(self.frame)
+        frame_recorder = self.recorder
+        if frame_recorder is not None:
+            frame_recorder.put(self.frame)
+
+    def wait_for_frame(self, after, timeout):
+        """Latest frame, waiting up to timeout seconds for one newer than
+        the sequence number after; None if there is no frame yet."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None and self.frame.sequence > after, timeout)
+            return self.frame
+
+    def add_client(self, address):
+        client = ClientSlot(address)
+        with self.clients_lock:
+            self.clients.append(client)
+        return client
+
+    def remove_client(self, client):
+        with self.clients_lock:
+            self.clients.remove(client)
+            self.sent += client.sent
+            self.dropped += client.dropped
+
+    def totals(self):
+        """Frames sent and dropped by all clients, including disconnected ones."""
+        with self.clients_lock:
+            return (self.sent + sum(client.sent for client in self.clients),
+                    self.dropped + sum(client.dropped for client in self.clients))
+
+    def client_stats(self):
+        with self.clients_lock:
+            return [client.stats() for client in self.clients]
+
+    def pipeline_stats(self):
+        """Rolling statistics of the frames produced and of each client."""
+        intervals = self.intervals.summary(1000)
+        with self.clients_lock:
+            clients = [client.pipeline_stats() for client in self.clients]
+        return {'frames': self.sequence,
+                'fps': round(1000 / intervals['mean'], 2) if intervals['count'] else 0.0,
+                'intervalMs': intervals,
+                'frameBytes': self.sizes.summary(),
+                'encodeLatencyMs': self.encode_latency.summary(1000),
+                'clients': clients}
+
+class Recorder:
+    """Writes the frames of a stream to time-segmented files.
+
+    Frames are handed over by StreamingOutput.write and written by a
+    background thread, so a slow SD card never delays the encoder or the
+    live clients: when more than backlog frames are waiting, new frames are
+    dropped and counted instead. Each segment is a plain MJPEG file (the
+    JPEG frames one after another, playable with ffmpeg -f mjpeg) named
+    with a sequence number, with an index file holding the wall-clock time,
+    offset and length of every frame (see find_recorded_frame). Segments are
+    numbered and rotated on the monotonic clock, so a clock step (such as
+    NTP setting the time after boot) cannot reorder or overwrite them; a
+    clock step also starts a new segment, so the times in the index of each
+    segment always increase. The
+    oldest segments, and if needed the segment being written, are deleted
+    to keep the recordings within budget bytes.
+    """
+
+    def __init__(self, directory, segment_seconds=SEGMENT_SECONDS, budget=RECORD_BUDGET, backlog=RECORD_BACKLOG):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.budget = budget
+        self.backlog = backlog
+        self.condition = Condition()
+        self.pending = collections.deque()
+        self.running = False
+        self.thread = None
+        self.segments = collections.deque()  # closed segments: (name, bytes)
+        self.segment = None
+        self.segment_start = None
+        self.segment_clock = None
+        self.segment_number = 0
+        self.segment_bytes = 0
+        self.disk_bytes = 0
+        self.frames = 0
+        self.dropped = 0
+        self.written = 0
+        self.deleted = 0
+        self.error = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name, size in recorded_segments(self.directory):
+            self.segments.append((name, size))
+            self.disk_bytes += size
+            self.segment_number = max(self.segment_number, int(name))
+        self.running = True
+        self.thread = Thread(target=self.run, name='Recorder', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Write the frames which are still waiting and close the segment."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, frame):
+        """Queue a frame for writing; never blocks."""
+        with self.condition:
+            if not self.running or len(self.pending) >= self.backlog:
+                self.dropped += 1
+                return
+            self.pending.append(frame)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or not self.running)
+                if not self.pending:
+                    break
+                frames = list(self.pending)
+                self.pending.clear()
+            written = 0
+            try:
+                for frame in frames:
+                    self.write(frame)
+                    written += 1
+                # Flush when the writer has caught up, so little is lost on a power cut;
+                # no segment is open if all the frames were dropped
+                if self.segment is not None:
+                    self.segment[0].flush()
+                    self.segment[1].flush()
+            except OSError as e:
+                with self.condition:
+                    self.dropped += len(frames) - written
+                self.error = str(e)
+                logging.warning('Recording error: %s', e)
+                self.close_segment()
+        self.close_segment()
+
+    def write(self, frame):
+        size = len(frame.data) + INDEX_ENTRY.size
+        if size > self.budget:
+            with self.condition:
+                self.dropped += 1
+            return
+        clock = frame.timestamp - frame.monotonic
+        if self.segment is not None and (frame.monotonic - self.segment_start >= self.segment_seconds
+                                         or abs(clock - self.segment_clock) > CLOCK_STEP):
+            self.close_segment()
+        self.enforce_budget(size)
+        if self.segment is None:
+            self.segment_start = frame.monotonic
+            self.segment_clock = clock
+            self.segment_number += 1
+            name = '%010d' % self.segment_number
+            path = os.path.join(self.directory, name)
+            self.segment = (open(path + '.mjpeg', 'xb'), open(path + '.idx', 'xb'), name)
+            self.segment_bytes = 0
+        data_file, index_file, name = self.segment
+        index_file.write(INDEX_ENTRY.pack(frame.timestamp, data_file.tell(), len(frame.data)))
+        data_file.write(frame.data)
+        self.segment_bytes += len(frame.data) + INDEX_ENTRY.size
+        self.disk_bytes += len(frame.data) + INDEX_ENTRY.size
+        self.frames += 1
+        self.written += len(frame.data)
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        data_file, index_file, name = self.segment
+        self.segment = None
+        for segment_file in (data_file, index_file):
+            try:
+                segment_file.close()
+            except OSError:
+                pass
+        self.segments.append((name, self.segment_bytes))
+
+    def enforce_budget(self, incoming):
+        """Delete the oldest segments until incoming more bytes fit in the
+        budget; the segment being written is closed and deleted as well if
+        it alone is too large."""
+        while self.disk_bytes + incoming > self.budget:
+            if not self.segments:
+                if self.segment is None:
+                    break
+                self.close_segment()
+            name, size = self.segments.popleft()
+            for extension in ('.mjpeg', '.idx'):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
+            self.disk_bytes -= size
+            self.deleted += 1
+
+    def stats(self):
+        with self.condition:
+            return {'recording': self.running,
+                    'directory': self.directory,
+                    'frames': self.frames,
+                    'dropped': self.dropped,
+                    'backlog': len(self.pending),
+                    'bytesWritten': self.written,
+                    'segments': len(self.segments) + (self.segment is not None),
+                    'diskBytes': self.disk_bytes,
+                    'budget': self.budget,
+                    'segmentsDeleted': self.deleted,
+                    'error': self.error}
+
+class SensorTimestampOutput(FileOutput):
+    """FileOutput which also gives the sensor timestamp of each frame to the StreamingOutput.
+
+    The encoder passes timestamps relative to its first frame; the
+    SensorTimestamp of that frame's request metadata is kept by the encoder
+    (firsttimestamp, in microseconds), so adding it back gives the absolute
+    sensor timestamp, on the clock of sensor_clock().
+    """
+
+    def __init__(self, stream_output, encoder):
+        super().__init__(stream_output)
+        self.stream_output = stream_output
+        self.encoder = encoder
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        first = getattr(self.encoder, 'firsttimestamp', None)
+        if timestamp is not None and first is not None:
+            self.stream_output.sensor_timestamp = first + timestamp
+        super().outputframe(frame, keyframe, timestamp, *args, **kwargs)
+
+def recorded_segments(directory):
+    """(name, bytes) of the recorded segments in a directory, oldest first."""
+    segments = []
+    for entry in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(entry)
+        if extension == '.idx' and name.isdigit():
+            size = 0
+            for segment_extension in ('.mjpeg', '.idx'):
+                try:
+                    size += os.path.getsize(os.path.join(directory, name + segment_extension))
+                except OSError:
+                    pass
+            segments.append((name, size))
+    return segments
+
+def find_recorded_frame(directory, when):
+    """Locate the recorded frame shown at a wall-clock time.
+
+    The segment is the newest one whose frames span that time (or else the
+    one with the latest frame before it), and the frame is found with a
+    binary search of its index, so only a few index entries are read.
+
+    :return: (segment path, offset, length, frame time), or None if there
+             is no recording at or before that time
+    """
+    def entry(index_file, number):
+        index_file.seek(number * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+
+    found = None
+    for name, size in reversed(recorded_segments(directory)):
+        path = os.path.join(directory, name)
+        with open(path + '.idx', 'rb') as index_file:
+            count = os.fstat(index_file.fileno()).st_size // INDEX_ENTRY.size
+            # Skip the segments without frames and those starting after that time
+            if count == 0 or entry(index_file, 0)[0] > when:
+                continue
+            last = entry(index_file, count - 1)
+            if last[0] <= when:
+                # The segment ended before that time; keep it if it ended the latest
+                if found is None or last[0] > found[3]:
+                    found = (path + '.mjpeg', last[1], last[2], last[0])
+                continue
+            low, high = 1, count - 1
+            while low < high:
+                middle = (low + high) // 2
+                if entry(index_file, middle)[0] <= when:
+                    low = middle + 1
+                else:
+                    high = middle
+            timestamp, offset, length = entry(index_file, low - 1)
+            return (path + '.mjpeg', offset, length, timestamp)
+    return found
+
+def profile_values(function):
+    """Metric values of each stream profile, keyed by the profile label."""
+    return lambda: {(name,): function(profile_output) for name, profile_output in outputs.items()}
+
+metrics = MetricsRegistry()
+metrics.callback('walle_camera_streaming', 'Whether the camera is encoding frames',
+                 lambda: int(streaming))
+metrics.callback('walle_camera_frames_total', 'Frames produced by the camera encoder',
+                 profile_values(lambda o: o.sequence), 'counter', ('profile',))
+metrics.callback('walle_stream_clients', 'Connected streaming clients',
+                 profile_values(lambda o: len(o.clients)), 'gauge', ('profile',))
+metrics.callback('walle_stream_frames_sent_total', 'Frames sent to all clients',
+                 profile_values(lambda o: o.totals()[0]), 'counter', ('profile',))
+metrics.callback('walle_stream_frames_dropped_total', 'Frames skipped because a client was too slow',
+                 profile_values(lambda o: o.totals()[1]), 'counter', ('profile',))
+metrics.callback('walle_recorder_frames_total', 'Frames written to the recording',
+                 lambda: recorder.frames if recorder is not None else 0, 'counter')
+metrics.callback('walle_recorder_frames_dropped_total', 'Frames not recorded because the writer was too slow',
+                 lambda: recorder.dropped if recorder is not None else 0, 'counter')
+metrics.callback('walle_recorder_disk_bytes', 'Disk space used by the recorded segments',
+                 lambda: recorder.disk_bytes if recorder is not None else 0)
+snapshot_requests = metrics.counter('walle_snapshot_requests_total', 'Snapshot requests by response status',
+                                    ('profile', 'status'))
+
+def frame_etag(profile, sequence):
+    """ETag of a frame: the profile is included, since the frame sequence
+    numbers of the profiles are the same but their images differ."""
+    return '"%s-%s-%d"' % (ETAG_PREFIX, profile, sequence)
+
+def etag_sequence(header, profile):
+    """Newest frame sequence number of a profile named in an If-None-Match
+    header, or 0 if none of its ETags was sent for that profile by this server."""
+    sequence = 0
+    prefix = frame_etag(profile, 0)[:-2]
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag.startswith(prefix) and tag.endswith('"'):
+            try:
+                sequence = max(sequence, int(tag[len(prefix):-1]))
+            except ValueError:
+                pass
+    return sequence
+
+def send_buffers(sock, buffers):
+    """Send all buffers with vectored writes, handling partial sends."""
+    buffers = [memoryview(buf).cast('B') for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/':
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/' and query.get('action') == ['stream']:
+            self.stream(query.get('profile', [DEFAULT_PROFILE])[0])
+        elif url.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
-        elif self.path == '/index.html':
+        elif url.path == '/index.html':
             content = PAGE.encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
+        elif url.path == '/clients.json':
+            stats = []
+            for name, profile_output in outputs.items():
+                for client in profile_output.client_stats():
+                    client['profile'] = name
+                    stats.append(client)
+            self.send_json(stats)
+        elif url.path == '/stats.json':
+            self.send_json(pipeline_stats())
+        elif url.path == '/settings.json':
+            self.send_json(settings)
+        elif url.path == '/metrics':
+            content = metrics.render().encode('utf-8')
             self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', len(content))
             self.end_headers()
+            self.wfile.write(content)
+        elif url.path == '/recording.json':
+            self.send_json(recorder.stats() if recorder is not None else {'recording': False})
+        elif url.path == '/recorded.jpg':
+            self.recorded_frame(query.get('time', [''])[0])
+        elif url.path == '/stream.mjpg':
+            self.stream(query.get('profile', [DEFAULT_PROFILE])[0])
+        elif url.path == '/preview.mjpg':
+            self.stream('preview')
+        elif url.path == '/snapshot.jpg':
             try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
+                wait = min(max(float(query.get('wait', ['0'])[0]), 0.0), MAX_SNAPSHOT_WAIT)
+            except ValueError:
+                self.send_error(400, 'Invalid wait time')
+                return
+            self.snapshot(query.get('profile', [DEFAULT_PROFILE])[0], wait)
         else:
             self.send_error(404)
             self.end_headers()
 
+    def do_POST(self):
+        # Settings may only be changed by the web-interface running on the robot
+        path = urlparse(self.path).path
+        if path not in ('/settings', '/recording'):
+            self.send_error(404)
+            return
+        if self.client_address[0] not in ('127.0.0.1', '::1'):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            values = json.loads(self.rfile.read(length) or b'{}')
+            if path == '/recording':
+                if values.get('enabled'):
+                    start_recording(values.get('directory'))
+                else:
+                    stop_recording()
+            else:
+                apply_settings(values.get('framerate'), values.get('quality'))
+        except (ValueError, TypeError, OSError) as e:
+            self.send_error(400, str(e))
+            return
+        if path == '/recording':
+            self.send_json(recorder.stats() if recorder is not None else {'recording': False})
+        else:
+            self.send_json(settings)
+
+    def send_json(self, data):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def snapshot(self, profile, wait):
+        """Send the latest frame of a profile as a single JPEG image.
+
+        The profile and frame sequence number are the ETag, so a client
+        sending it back in If-None-Match gets 304 Not Modified until there
+        is a new frame. With wait > 0 the request is held (long-polling) for
+        up to that many seconds until a newer frame than the client's one,
+        or the first frame, is available.
+        """
+        if profile not in outputs:
+            self.send_error(404, 'Unknown stream profile')
+            return
+        known = etag_sequence(self.headers.get('If-None-Match'), profile)
+        frame = outputs[profile].wait_for_frame(known, wait)
+        if frame is None:
+            snapshot_requests.inc(1, profile, '503')
+            self.send_response(503)
+            self.send_header('Retry-After', 1)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+        if frame.sequence <= known:
+            snapshot_requests.inc(1, profile, '304')
+            self.send_response(304)
+            self.send_header('ETag', frame.etag)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.end_headers()
+            return
+        snapshot_requests.inc(1, profile, '200')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', len(frame.data))
+        self.send_header('ETag', frame.etag)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.end_headers()
+        self.wfile.write(frame.data)
+
+    def recorded_frame(self, when):
+        """Send the recorded frame shown at a wall-clock time (seconds since the epoch)."""
+        try:
+            when = float(when)
+        except ValueError:
+            self.send_error(400, 'Invalid time')
+            return
+        found = find_recorded_frame(recording_dir, when) if recording_dir is not None else None
+        if found is None:
+            self.send_error(404, 'No recording at that time')
+            return
+        path, offset, length, timestamp = found
+        with open(path, 'rb') as segment_file:
+            segment_file.seek(offset)
+            data = segment_file.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', len(data))
+        self.send_header('X-Frame-Time', '%.3f' % timestamp)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, profile):
+        if profile not in outputs:
+            self.send_error(404, 'Unknown stream profile')
+            return
+        profile_output = outputs[profile]
+        self.send_response(200)
+        self.send_header('Age', 0)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        self.end_headers()
+        client = profile_output.add_client(self.client_address)
+        try:
+            while True:
+                frame = client.get()
+                start = time.monotonic()
+                send_buffers(self.connection, frame.parts)
+                client.record(frame, start, time.monotonic())
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s: %s',
+                self.client_address, str(e))
+        finally:
+            profile_output.remove_client(client)
+            logging.info('Client %s: %d frames sent, %d dropped',
+                         self.client_address, client.sent, client.dropped)
+
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
-def start_streaming_server():
-    global streaming
+def frame_duration_limits(framerate):
+    """Shortest frame time for the frame rate, allowing up to 100ms exposures."""
+    shortest = int(1000000 / framerate)
+    return (shortest, max(shortest, 100000))
+
+def encoder_quality(quality):
+    """Map a JPEG quality of 1-100 onto the Picamera2 encoder quality levels."""
+    levels = [Quality.VERY_LOW, Quality.LOW, Quality.MEDIUM, Quality.HIGH, Quality.VERY_HIGH]
+    return levels[min(len(levels) - 1, quality * len(levels) // 101)]
+
+def start_encoders():
+    for name, (stream, size) in PROFILES.items():
+        encoder = MJPEGEncoder()
+        picam2.start_encoder(encoder, SensorTimestampOutput(outputs[name], encoder),
+                             quality=encoder_quality(settings['quality']), name=stream)
+
+def apply_settings(framerate=None, quality=None):
+    """Change the frame rate and/or JPEG quality of the running camera."""
+    if framerate is not None:
+        framerate = int(framerate)
+        if not 1 <= framerate <= 60:
+            raise ValueError('Frame rate must be between 1 and 60')
+    if quality is not None:
+        quality = int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError('Quality must be between 1 and 100')
+
+    with camera_lock:
+        if framerate is not None:
+            settings['framerate'] = framerate
+            if picam2 is not None:
+                picam2.set_controls({"FrameDurationLimits": frame_duration_limits(framerate)})
+        if quality is not None and quality != settings['quality']:
+            settings['quality'] = quality
+            # The encoders have to be restarted, but the camera keeps running
+            if streaming:
+                picam2.stop_encoder()
+                start_encoders()
+
+def open_camera():
+    """Open and start the camera, without encoding any frames yet."""
     global output
     global picam2
+    if picam2 is not None:
+        return
+    if Picamera2 is None:
+        raise RuntimeError('picamera2 is not installed')
+    for name in PROFILES:
+        if name not in outputs:
+            outputs[name] = StreamingOutput(name)
+    output = outputs[DEFAULT_PROFILE]
     picam2 = Picamera2()
-    output = StreamingOutput()
-    picam2.configure(picam2.create_video_configuration(main={"size": (1920, 1080)}))
-    picam2.set_controls({"FrameDurationLimits":(33333,100000),"ExposureValue":6.0, "Brightness":0.1})
-    picam2.start_recording(MJPEGEncoder(), FileOutput(output))
+    picam2.configure(picam2.create_video_configuration(
+        main={"size": PROFILES['full'][1]},
+        lores={"size": PROFILES['preview'][1]}))
+    picam2.set_controls({"FrameDurationLimits": frame_duration_limits(settings['framerate']), "ExposureValue": 6.0, "Brightness": 0.1})
+    picam2.start()
+
+def start_streaming():
+    """Start encoding frames; the camera stays open between streams, so
+    only the first start pays for the camera initialisation."""
+    global streaming
+    with camera_lock:
+        start = time.perf_counter()
+        open_camera()
+        if not streaming:
+            start_encoders()
+            streaming = True
+        toggle_times['start'] = time.perf_counter() - start
+    if stats_interval:
+        start_stats_log(stats_interval)
+
+def stop_streaming():
+    """Stop encoding frames, while keeping the camera running."""
+    global streaming
+    with camera_lock:
+        start = time.perf_counter()
+        if streaming:
+            picam2.stop_encoder()
+            streaming = False
+        toggle_times['stop'] = time.perf_counter() - start
+
+def close_camera():
+    """Stop encoding and release the camera."""
+    global streaming
+    global picam2
+    with camera_lock:
+        if picam2 is None:
+            return
+        if streaming:
+            picam2.stop_encoder()
+            streaming = False
+        picam2.stop()
+        picam2.close()
+        picam2 = None
+
+def start_server(address=('0.0.0.0', 8080)):
+    """Run the HTTP streaming server in a background thread."""
+    global http_server
+    global server_thread
+    if server_thread is not None and server_thread.is_alive():
+        return
+    http_server = StreamingServer(address, StreamingHandler)
+    server_thread = Thread(target=http_server.serve_forever, name='StreamingServer', daemon=True)
+    server_thread.start()
+
+def stop_server():
+    """Shut down the background HTTP streaming server."""
+    global server_thread
+    if server_thread is not None:
+        http_server.shutdown()
+        http_server.server_close()
+        server_thread = None
+
+def start_recording(directory=None, segment_seconds=SEGMENT_SECONDS, budget=RECORD_BUDGET):
+    """Start recording the RECORD_PROFILE stream; the frames are recorded
+    while the camera is streaming."""
+    global recorder
+    global recording_dir
+    directory = directory or recording_dir
+    if directory is None:
+        raise ValueError('No recording directory')
+    with camera_lock:
+        if recorder is not None:
+            return
+        for name in PROFILES:
+            if name not in outputs:
+                outputs[name] = StreamingOutput(name)
+        recorder = Recorder(directory, segment_seconds, budget)
+        recorder.start()
+        recording_dir = directory
+        outputs[RECORD_PROFILE].recorder = recorder
+
+def stop_recording():
+    """Stop recording, after writing the frames which are still waiting."""
+    global recorder
+    with camera_lock:
+        if recorder is None:
+            return
+        outputs[RECORD_PROFILE].recorder = None
+        stopped = recorder
+        recorder = None
+    stopped.stop()
+
+def pipeline_stats():
+    """Rolling statistics of the camera pipeline, for each stream profile."""
+    return {'window': STATS_WINDOW,
+            'settings': dict(settings),
+            'profiles': {name: profile_output.pipeline_stats() for name, profile_output in outputs.items()}}
+
+def stats_line(name, stats):
+    """One line summary of the pipeline statistics of a profile."""
+    line = '%s: %.1f fps' % (name, stats['fps'])
+    if stats['intervalMs']['count']:
+        line += ', interval p95 %.1f ms' % stats['intervalMs']['p95']
+    if stats['frameBytes']['count']:
+        line += ', %.0f KB/frame' % (stats['frameBytes']['mean'] / 1024)
+    if stats['encodeLatencyMs']['count']:
+        line += ', encode p50 %.1f ms' % stats['encodeLatencyMs']['p50']
+    line += ', %d clients' % len(stats['clients'])
+    for client in stats['clients']:
+        line += ' [%s %.0f KB/s, write p95 %s ms, latency p95 %s ms]' % (
+            client['client'], client['bytesPerSecond'] / 1024,
+            client['writeMs'].get('p95', '-'), client['latencyMs'].get('p95', '-'))
+    return line
+
+def start_stats_log(interval):
+    """Log a summary of the pipeline statistics every interval seconds."""
+    global stats_thread
+    if stats_thread is not None:
+        return
+
+    def log_stats():
+        while True:
+            time.sleep(interval)
+            for name, stats in pipeline_stats()['profiles'].items():
+                logging.info('%s', stats_line(name, stats))
+
+    stats_thread = Thread(target=log_stats, name='StreamingStats', daemon=True)
+    stats_thread.start()
+
+def camera_status():
+    """Report the real state of the camera, encoders and HTTP server."""
+    last_write = output.last_write if output is not None else None
+    frame_age = time.monotonic() - last_write if last_write is not None else None
+    if picam2 is None:
+        health = 'off'
+    elif not streaming:
+        health = 'paused'
+    elif frame_age is None or frame_age > STALL_TIMEOUT:
+        health = 'stalled'
+    else:
+        health = 'ok'
+    return {'health': health,
+            'cameraOpen': picam2 is not None,
+            'streaming': streaming,
+            'server': server_thread is not None and server_thread.is_alive(),
+            'frames': output.sequence if output is not None else 0,
+            'frameAge': frame_age,
+            'clients': sum(len(profile_output.clients) for profile_output in outputs.values()),
+            'recording': recorder is not None,
+            'startTime': toggle_times['start'],
+            'stopTime': toggle_times['stop']}
+
+def start_streaming_server(framerate=30, quality=80, record=None, segment_seconds=SEGMENT_SECONDS, budget=RECORD_BUDGET):
+    settings['framerate'] = framerate
+    settings['quality'] = quality
+    if record is not None:
+        start_recording(record, segment_seconds, budget)
+    start_streaming()
 
     try:
         address = ('0.0.0.0', 8080) # Replace 0.0.0.0 with the IP adress of your WALL-E in your network 
@@ -95,8 +988,21 @@ def start_streaming_server():
     except KeyboardInterrupt:
         streaming_server.shutdown()
     finally:
-        picam2.stop_recording()
-        picam2.close()
+        close_camera()
+        stop_recording()
 
 if __name__ == "__main__":
-    start_streaming_server()
+    parser = argparse.ArgumentParser(description="Picamera2 MJPEG streaming server")
+    parser.add_argument("--framerate", type=int, default=30, help="maximum frame rate")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality (1-100)")
+    parser.add_argument("--stats-interval", type=float, help="log the pipeline statistics every STATS_INTERVAL seconds")
+    parser.add_argument("--record", metavar="DIR", help="record the stream into segment files in this directory")
+    parser.add_argument("--segment-seconds", type=float, default=SEGMENT_SECONDS, help="length of each recorded segment")
+    parser.add_argument("--record-budget", type=float, default=RECORD_BUDGET / 1024 ** 2,
+                        help="disk space for the recordings in MB; the oldest segments are deleted")
+    args = parser.parse_args()
+    if args.stats_interval:
+        logging.basicConfig(level=logging.INFO)
+        stats_interval = args.stats_interval
+    start_streaming_server(args.framerate, args.quality, args.record, args.segment_seconds,
+                           int(args.record_budget * 1024 ** 2))
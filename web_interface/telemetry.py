@@ -0,0 +1,187 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       	telemetry.py
+# @brief      	Time-series store for the readings received from the Arduino
+#############################################
+
+import collections
+import math
+import threading
+import time
+
+
+##
+# Bounded history of timestamped numeric readings
+#
+# Gauges (such as the battery level) store the measured value, counters
+# (such as the number of command echoes) store the running total, so the
+# rate of change is the number of events per second.
+#
+class TelemetryChannel:
+
+	##
+	# Constructor
+	#
+	# @param  name      Name of the channel
+	# @param  unit      Unit of the readings, for display only
+	# @param  capacity  Maximum number of readings kept
+	# @param  counter   True if the readings are a running total
+	# @param  smoothing Time constant of the exponential smoothing in seconds
+	#
+	def __init__(self, name, unit="", capacity=720, counter=False, smoothing=60.0):
+		self.name = name
+		self.unit = unit
+		self.counter = counter
+		self.smoothing = smoothing
+		self.readings = collections.deque(maxlen=capacity)
+		self.smoothed = None
+		self.total = 0
+
+
+	##
+	# Add a reading
+	#
+	# @param  value      The measured value, or the increment for counters
+	# @param  timestamp  Time of the reading in seconds since the epoch
+	#
+	def add(self, value, timestamp):
+		if self.counter:
+			self.total += value
+			value = self.total
+
+		if self.smoothed is None or not self.readings:
+			self.smoothed = float(value)
+		else:
+			interval = max(0.0, timestamp - self.readings[-1][0])
+			alpha = 1.0 - math.exp(-interval / self.smoothing) if self.smoothing else 1.0
+			self.smoothed += alpha * (value - self.smoothed)
+		self.readings.append((timestamp, value))
+
+
+	##
+	# Rate of change, as the least-squares slope of the recent readings
+	#
+	# @param  window  Number of seconds of history to use
+	# @return Change per second, or None if there are not enough readings
+	#
+	def rate(self, window):
+		if len(self.readings) < 2:
+			return None
+		start = self.readings[-1][0] - window
+		points = [reading for reading in self.readings if reading[0] >= start]
+		if len(points) < 2:
+			points = list(self.readings)[-2:]
+
+		count = len(points)
+		meanTime = sum(t for t, v in points) / count
+		meanValue = sum(v for t, v in points) / count
+		variance = sum((t - meanTime) ** 2 for t, v in points)
+		if variance == 0:
+			return None
+		return sum((t - meanTime) * (v - meanValue) for t, v in points) / variance
+
+
+	##
+	# Get the latest, smoothed and rate values of the channel
+	#
+	# @param  window  Number of seconds of history used for the rate
+	#
+	def summary(self, window):
+		latest = self.readings[-1] if self.readings else (None, None)
+		rate = self.rate(window)
+		return {
+			'value': latest[1],
+			'time': latest[0],
+			'smoothed': None if self.smoothed is None else round(self.smoothed, 3),
+			'rate': None if rate is None else round(rate, 6),
+			'unit': self.unit,
+			'count': len(self.readings)
+		}
+
+
+##
+# Thread-safe store of telemetry channels
+#
+# The version is increased with every reading, so the control channels
+# (which check it about once a second) only send the telemetry to their
+# clients when there are new readings.
+#
+class TelemetryStore:
+
+	##
+	# Constructor
+	#
+	# @param  window  Number of seconds of history used to compute rates
+	#
+	def __init__(self, window=600.0):
+		self.window = window
+		self.channels = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.version = 0
+
+
+	##
+	# Add a channel to the store
+	#
+	# @param  name    Name of the channel
+	# @param  kwargs  Options of the TelemetryChannel
+	#
+	def add_channel(self, name, **kwargs):
+		with self.lock:
+			self.channels[name] = TelemetryChannel(name, **kwargs)
+
+
+	##
+	# Record a reading
+	#
+	# @param  name       Name of the channel
+	# @param  value      The measured value, or the increment for counters
+	# @param  timestamp  Time of the reading, the current time if None
+	#
+	def record(self, name, value, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		with self.lock:
+			self.channels[name].add(value, timestamp)
+			self.version += 1
+
+
+	##
+	# Get the latest value of a channel
+	#
+	# @param  name     Name of the channel
+	# @param  default  Value returned if there are no readings
+	#
+	def latest(self, name, default=None):
+		with self.lock:
+			readings = self.channels[name].readings
+			return readings[-1][1] if readings else default
+
+
+	##
+	# Get the summary of the channels
+	#
+	# @param  names  Names of the channels, or None for all channels
+	# @return Dictionary of channel summaries
+	#
+	def summary(self, names=None):
+		with self.lock:
+			if names is None:
+				names = list(self.channels)
+			return {name: self.channels[name].summary(self.window) for name in names}
+
+
+	##
+	# Get the history of a channel as a compact array
+	#
+	# @param  name   Name of the channel
+	# @param  since  Only return readings after this time (seconds since the epoch)
+	# @return List of [time, value] pairs, with the time rounded to milliseconds
+	#
+	def history(self, name, since=None):
+		with self.lock:
+			readings = list(self.channels[name].readings)
+		if since is not None:
+			readings = [reading for reading in readings if reading[0] > since]
+		return [[round(t, 3), v] for t, v in readings]